@@ -0,0 +1,120 @@
+"""
+Accounting of the resources used by jobs, which are reported to the queue
+server as the `resource_usage` of each job, in the units in which the quotas
+of the platform are given (see `usage_in_units()`), with the details in the
+provenance of the job.
+
+The usage of a job is a dict with its wall time and CPU time in seconds
+("wall_time", "cpu_time"), its peak resident set size in bytes ("max_rss"),
+and the number of cores it was given ("cores"). Values which are not known
+are None. For jobs run through SLURM it is taken from SLURM's accounting
+database, with one call to `sacct` for many jobs (see `sacct_usage()`), and
+for jobs run as local processes from the resource usage of the process
+(see nmpi_local).
+
+"""
+
+import subprocess
+import logging
+from nmpi.nmpi_files import to_text
+from nmpi.nmpi_cache import parse_size
+
+logger = logging.getLogger("NMPI")
+
+SACCT_FORMAT = "JobIDRaw,State,ElapsedRaw,TotalCPU,MaxRSS,AllocCPUS"
+# states in which the usage of a job is not final yet
+SLURM_ACTIVE_STATES = ("PENDING", "CONFIGURING", "RUNNING", "COMPLETING", "SUSPENDED",
+                       "REQUEUED", "RESIZING")
+UNITS = ("hours", "core-hours", "wafer-hours")
+
+
+def parse_slurm_duration(text):
+    """Convert a duration as given by SLURM, e.g. "1-02:03:04" or "03:04.567", to seconds."""
+    text = text.strip()
+    if not text:
+        return None
+    days = 0
+    if "-" in text:
+        days, text = text.split("-", 1)
+    seconds = 0.0
+    for part in text.split(":"):
+        seconds = seconds * 60 + float(part)
+    return int(days) * 86400 + seconds
+
+
+def sacct_usage(native_job_ids):
+    """
+    Return the usage of the SLURM jobs with the given IDs which have ended,
+    as a dict mapping job IDs to usage dicts, using a single call to sacct.
+    Jobs which are still pending or running, or which sacct does not know
+    (yet), are left out.
+    """
+    if not native_job_ids:
+        return {}
+    output = subprocess.check_output(["sacct", "--noheader", "--parsable2",
+                                      "--jobs", ",".join(str(job_id) for job_id in native_job_ids),
+                                      "--format", SACCT_FORMAT])
+    usage = {}
+    max_rss = {}
+    for line in to_text(output).splitlines():
+        fields = line.split("|")
+        if len(fields) != 6:
+            continue
+        job_id, state, elapsed, total_cpu, rss, cpus = [field.strip() for field in fields]
+        base_id, _, step = job_id.partition(".")
+        if rss:
+            # the peak memory is only given for the steps of the job
+            max_rss[base_id] = max(max_rss.get(base_id, 0), parse_size(rss))
+        if step or not state or state.split()[0] in SLURM_ACTIVE_STATES:
+            continue
+        usage[base_id] = {"wall_time": float(elapsed) if elapsed else None,
+                          "cpu_time": parse_slurm_duration(total_cpu),
+                          "max_rss": None,
+                          "cores": int(cpus) if cpus else None}
+    for job_id, job_usage in usage.items():
+        job_usage["max_rss"] = max_rss.get(job_id)
+    return usage
+
+
+def rusage_usage(rusage, wall_time, cores=1):
+    """Return the usage of a local process from its `resource.struct_rusage` (or a dict of the same fields)."""
+    if isinstance(rusage, dict):
+        utime, stime, maxrss = rusage["ru_utime"], rusage["ru_stime"], rusage["ru_maxrss"]
+    else:
+        utime, stime, maxrss = rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss
+    return {"wall_time": wall_time,
+            "cpu_time": utime + stime,
+            "max_rss": maxrss * 1024,  # kilobytes on Linux
+            "cores": cores}
+
+
+def platform_units(platform, units=None):
+    """
+    Return the units in which the usage of jobs is reported: `units` if
+    given, otherwise those of the quotas of `platform` (see
+    nmpi_admin.TEST_QUOTAS), or "hours" for other platforms.
+    """
+    if units:
+        return units
+    from nmpi.nmpi_admin import TEST_QUOTAS
+    return TEST_QUOTAS.get(platform, {}).get("units", "hours")
+
+
+def usage_in_units(usage, units, hardware_config=None):
+    """
+    Convert the usage of a job to the units of the platform's quotas:
+    "hours" of wall time, "core-hours" (wall time times the number of cores)
+    or "wafer-hours" (wall time times the number of wafers in the job's
+    `hardware_config`, given as a number or a list of wafers, 1 by default).
+    """
+    hours = (usage.get("wall_time") or 0.0) / 3600.0
+    if units == "hours":
+        return hours
+    if units == "core-hours":
+        return hours * (usage.get("cores") or 1)
+    if units == "wafer-hours":
+        wafers = (hardware_config or {}).get("wafers", 1)
+        if isinstance(wafers, (list, tuple)):
+            wafers = len(wafers)
+        return hours * float(wafers)
+    raise ValueError("Unknown resource units {}, supported: {}".format(units, ", ".join(UNITS)))
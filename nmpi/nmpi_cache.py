@@ -0,0 +1,563 @@
+"""
+Caches kept on the runner host and shared between jobs, so that things
+needed by many jobs are only fetched once.
+
+Each cache is a directory. Every entry in it has a name derived from its
+key, and a small JSON sidecar file, ``<name>.meta``, recording its size
+(and anything else the cache needs to remember). The modification time of
+the sidecar is the time the entry was last used, and the least recently
+used entries are removed when the cache grows beyond its size limit.
+Since all the state is on disk, the caches survive restarts of the runner.
+
+"""
+
+import os
+from os import path
+import errno
+import hashlib
+import json
+import logging
+import shutil
+import subprocess
+import tempfile
+import time
+try:
+    from urlparse import urlparse
+except ImportError:  # Py3
+    from urllib.parse import urlparse
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+from nmpi.nmpi_files import (open_url, extract_archive, link_tree, make_read_only,
+                             copy_file, copy_files, COPY_CHUNK_SIZE)
+
+logger = logging.getLogger("NMPI")
+
+SIZE_UNITS = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+VCS_DIRECTORIES = (".git", ".hg", ".svn", ".bzr")  # differ between clones of the same code
+
+
+def parse_size(value):
+    """
+    Convert a size such as "500M" or "20G" (or a plain number of bytes)
+    to a number of bytes. None means no limit and is returned unchanged.
+    """
+    if value is None or isinstance(value, (int, float)):
+        return value
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in SIZE_UNITS:
+        return int(float(value[:-1]) * SIZE_UNITS[value[-1]])
+    return int(value)
+
+
+def directory_size(root):
+    """Return the total size in bytes of all files below root."""
+    if not path.isdir(root):
+        return path.getsize(root) if path.exists(root) else 0
+    total = 0
+    for dirpath, dirs, files in os.walk(root):
+        for file in files:
+            try:
+                total += os.lstat(path.join(dirpath, file)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def remove_path(target):
+    """Remove a file or directory tree, if it exists."""
+    if path.isdir(target) and not path.islink(target):
+        shutil.rmtree(target, ignore_errors=True)
+    elif path.lexists(target):
+        try:
+            os.remove(target)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+
+def tree_digest(root, ignoredirs=VCS_DIRECTORIES, ignore_files=()):
+    """
+    Return the SHA-256 hash of the names and contents of all files below
+    root, other than those in `ignoredirs` directories and the relative
+    paths in `ignore_files`. The result does not depend on file timestamps.
+    """
+    digest = hashlib.sha256()
+    length_root = len(root) + len(path.sep)
+    for dirpath, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if d not in ignoredirs)
+        for file_name in sorted(files):
+            full_path = path.join(dirpath, file_name)
+            relative_path = full_path[length_root:]
+            if relative_path in ignore_files:
+                continue
+            digest.update(relative_path.encode("utf-8") + b"\0")
+            with open(full_path, "rb") as fp:
+                while True:
+                    chunk = fp.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class FileLock(object):
+    """
+    Exclusive lock on a file, held for the duration of a `with` block.
+    The lock is advisory, and works across processes on the same host.
+    """
+
+    def __init__(self, lock_path, blocking=True):
+        self.lock_path = lock_path
+        self.blocking = blocking
+        self._fp = None
+
+    def __enter__(self):
+        self._fp = open(self.lock_path, "a")
+        if fcntl is not None:
+            flags = fcntl.LOCK_EX
+            if not self.blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(self._fp.fileno(), flags)
+            except IOError:
+                self._fp.close()
+                self._fp = None
+                raise
+        return self
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.flock(self._fp.fileno(), fcntl.LOCK_UN)
+        self._fp.close()
+        self._fp = None
+
+
+class DiskCache(object):
+    """
+    Base class for the caches. Entries are keyed by an arbitrary string
+    (e.g. a URL), and the total size of the cache is kept below `max_size`
+    bytes (no limit if None) by evicting the least recently used entries.
+    """
+    suffix = ""
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = parse_size(max_size)
+        if not path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+
+    def entry_name(self, key):
+        return hashlib.sha1(key.encode("utf-8")).hexdigest() + self.suffix
+
+    def entry_path(self, key):
+        return path.join(self.cache_dir, self.entry_name(key))
+
+    def lock(self, name, blocking=True):
+        return FileLock(path.join(self.cache_dir, name + ".lock"), blocking)
+
+    def read_meta(self, name):
+        try:
+            with open(path.join(self.cache_dir, name + ".meta")) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return None
+
+    def write_meta(self, name, **meta):
+        """Record metadata (including the current size) for an entry."""
+        meta["size"] = directory_size(path.join(self.cache_dir, name))
+        meta_path = path.join(self.cache_dir, name + ".meta")
+        tmp_path = "{}.tmp{}".format(meta_path, os.getpid())
+        with open(tmp_path, "w") as fp:
+            json.dump(meta, fp)
+        os.rename(tmp_path, meta_path)
+        return meta
+
+    def touch(self, name):
+        """Mark an entry as recently used."""
+        try:
+            os.utime(path.join(self.cache_dir, name + ".meta"), None)
+        except OSError:
+            pass
+
+    def remove(self, name):
+        remove_path(path.join(self.cache_dir, name))
+        remove_path(path.join(self.cache_dir, name + ".meta"))
+
+    def entries(self):
+        """
+        Return a list of (last used, size, name) tuples for all entries,
+        least recently used first.
+        """
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith(".meta"):
+                continue
+            name = file_name[:-len(".meta")]
+            try:
+                last_used = os.stat(path.join(self.cache_dir, file_name)).st_mtime
+            except OSError:
+                continue
+            meta = self.read_meta(name) or {}
+            entries.append((last_used, meta.get("size", 0), name))
+        return sorted(entries)
+
+    def evict(self, keep=()):
+        """
+        Remove least recently used entries until the cache fits in
+        `max_size`. Entries named in `keep`, and entries currently locked
+        by someone else, are not removed.
+        """
+        if self.max_size is None:
+            return []
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = []
+        for last_used, size, name in entries:
+            if total <= self.max_size:
+                break
+            if name in keep:
+                continue
+            try:
+                with self.lock(name, blocking=False):
+                    self.remove(name)
+            except IOError:
+                continue  # in use
+            total -= size
+            removed.append(name)
+        if removed:
+            logger.info("Evicted {} entries from cache {}".format(len(removed), self.cache_dir))
+        return removed
+
+
+class GitMirrorCache(DiskCache):
+    """
+    Bare mirrors of the Git repositories from which job code is taken,
+    updated incrementally with `git fetch` each time they are used.
+
+    Jobs are cloned from the local mirror, which hard-links the objects
+    rather than copying them when on the same filesystem. The clone does
+    not depend on the mirror afterwards, so mirrors can be evicted at any
+    time. Submodules, at any depth, are checked out from mirrors of their
+    own repositories in the same way.
+    """
+    suffix = ".git"
+
+    def update(self, url):
+        """
+        Create or update the mirror of the repository at `url`.
+        Returns the path of the mirror. Must be called with the entry locked.
+        """
+        name = self.entry_name(url)
+        mirror = path.join(self.cache_dir, name)
+        if path.isdir(mirror):
+            logger.info("Updating mirror of {}".format(url))
+            err = subprocess.call(["git", "--git-dir", mirror, "remote", "update", "--prune"])
+            if err:
+                # the mirror may be corrupt, so start again
+                logger.info("Failed to update mirror of {}, re-cloning".format(url))
+                self.remove(name)
+        if not path.isdir(mirror):
+            logger.info("Creating mirror of {}".format(url))
+            err = subprocess.call(["git", "clone", "--mirror", "--quiet", url, mirror])
+            if err:
+                self.remove(name)
+                return None
+        self.write_meta(name, url=url, updated=time.time())
+        return mirror
+
+    def clone(self, url, target):
+        """
+        Clone the repository at `url` into `target`, via the mirror.
+        Returns 0 on success, like `subprocess.call()`.
+        """
+        name = self.entry_name(url)
+        with self.lock(name):
+            mirror = self.update(url)
+            if mirror is None:
+                return 1
+            err = subprocess.call(["git", "clone", "--quiet", mirror, target])
+        if err:
+            self.evict(keep=(name,))
+            return err
+        # point the clone back at the original repository, so that relative
+        # submodule URLs are resolved correctly
+        err = subprocess.call(["git", "-C", target, "remote", "set-url", "origin", url])
+        used = [name]
+        if not err:
+            err = self._update_submodules(target, used)
+        self.evict(keep=used)
+        return err
+
+    def _update_submodules(self, repository, used):
+        """
+        Check out the submodules of the clone `repository`, and theirs, each
+        from a mirror of its repository. If a repository cannot be mirrored,
+        its submodule is cloned from the repository itself. The names of the
+        mirrors are appended to `used`.
+        Returns 0 on success, like `subprocess.call()`.
+        """
+        if not path.exists(path.join(repository, ".gitmodules")):
+            return 0
+        # resolves relative URLs, and records the URLs in .git/config
+        err = subprocess.call(["git", "-C", repository, "submodule", "--quiet", "init"])
+        if err:
+            return err
+        for name, submodule_path in _submodule_paths(repository):
+            url_key = "submodule.{}.url".format(name)
+            try:
+                url = subprocess.check_output(["git", "-C", repository, "config", url_key]).decode().strip()
+            except subprocess.CalledProcessError:
+                continue  # not initialised, so not to be checked out
+            entry_name = self.entry_name(url)
+            with self.lock(entry_name):
+                mirror = self.update(url)
+                if mirror is not None:
+                    used.append(entry_name)
+                    subprocess.call(["git", "-C", repository, "config", url_key, mirror])
+                else:
+                    logger.info("Failed to mirror {}, cloning it directly".format(url))
+                # recent versions of Git only clone submodules from local paths if told to
+                err = subprocess.call(["git", "-C", repository, "-c", "protocol.file.allow=always",
+                                       "submodule", "--quiet", "update", "--", submodule_path])
+            if mirror is not None:
+                subprocess.call(["git", "-C", repository, "config", url_key, url])
+                if not err:
+                    err = subprocess.call(["git", "-C", path.join(repository, submodule_path),
+                                           "remote", "set-url", "origin", url])
+            if not err:
+                err = self._update_submodules(path.join(repository, submodule_path), used)
+            if err:
+                return err
+        return 0
+
+
+def _submodule_paths(repository):
+    """Return a list of (name, path) tuples for the submodules listed in .gitmodules."""
+    try:
+        output = subprocess.check_output(["git", "-C", repository, "config", "--file", ".gitmodules",
+                                          "--get-regexp", r"^submodule\..*\.path$"])
+    except subprocess.CalledProcessError:
+        return []  # no submodules
+    submodules = []
+    for line in output.decode().splitlines():
+        key, _, submodule_path = line.partition(" ")
+        submodules.append((key[len("submodule."):-len(".path")], submodule_path))
+    return submodules
+
+
+class ArchiveCache(DiskCache):
+    """
+    Extracted copies of the archives (.tar.gz, .zip) from which job code is
+    taken.
+
+    Each time an archive is used, the server is asked whether it has changed
+    (using its ETag or, failing that, its Last-Modified date); it is only
+    downloaded again if it has. The cached files are read-only, and jobs get
+    copies of them (reflinks where the filesystem supports them), which they
+    are free to modify. Archives served with neither an ETag nor a
+    Last-Modified date are not cached.
+    """
+
+    def fetch(self, url, target):
+        """Place the contents of the archive at `url` in the directory `target`."""
+        name = self.entry_name(url)
+        entry = path.join(self.cache_dir, name)
+        with self.lock(name):
+            meta = self.read_meta(name)
+            validator = meta.get("validator") if (meta and path.isdir(entry)) else None
+            fileobj, new_validator = open_url(url, validator)
+            if fileobj is None:
+                logger.info("Using cached copy of {}".format(url))
+                self.touch(name)
+            elif new_validator is None:
+                try:
+                    extract_archive(fileobj, urlparse(url).path, target)
+                finally:
+                    fileobj.close()
+                return
+            else:
+                tmp_dir = "{}.tmp{}".format(entry, os.getpid())
+                remove_path(tmp_dir)
+                os.makedirs(tmp_dir)
+                try:
+                    extract_archive(fileobj, urlparse(url).path, tmp_dir)
+                except Exception:
+                    remove_path(tmp_dir)
+                    raise
+                finally:
+                    fileobj.close()
+                make_read_only(tmp_dir)
+                self.remove(name)
+                os.rename(tmp_dir, entry)
+                self.write_meta(name, url=url, validator=new_validator)
+            link_tree(entry, target, use_hardlinks=False)
+        self.evict(keep=(name,))
+
+
+class InputDataCache(DiskCache):
+    """
+    Content-addressed store of the input data files of jobs.
+
+    Files are stored under the SHA-256 hash of their content, so identical
+    files from different URLs are only stored once. A small index file per
+    URL, ``<name>.url``, records which file the URL last pointed to and its
+    validator (see `open_url()`), so that a file is only downloaded again if
+    the server says it has changed.
+
+    Jobs get copies of the stored files (reflinks where the file system
+    supports them), which they may modify without affecting the cache.
+    """
+
+    def _index_path(self, url):
+        return path.join(self.cache_dir, self.entry_name(url) + ".url")
+
+    def _read_index(self, url):
+        try:
+            with open(self._index_path(url)) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_index(self, url, **index):
+        index_path = self._index_path(url)
+        tmp_path = "{}.tmp{}".format(index_path, os.getpid())
+        with open(tmp_path, "w") as fp:
+            json.dump(index, fp)
+        os.rename(tmp_path, index_path)
+
+    def _store(self, fileobj, url):
+        """Copy the contents of `fileobj` into the store, returning their hash."""
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                while True:
+                    chunk = fileobj.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    fp.write(chunk)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        name = digest.hexdigest()
+        stored = path.join(self.cache_dir, name)
+        with self.lock(name):
+            if path.exists(stored):
+                os.remove(tmp_path)
+            else:
+                os.chmod(tmp_path, 0o444)
+                os.rename(tmp_path, stored)
+            self.write_meta(name, url=url)
+        return name
+
+    def fetch(self, url, target):
+        """Place the file at `url` at the path `target`."""
+        name = None
+        with self.lock(self.entry_name(url)):
+            index = self._read_index(url)
+            validator = index.get("validator")
+            if index.get("digest") and path.exists(path.join(self.cache_dir, index["digest"])):
+                fileobj, new_validator = open_url(url, validator)
+                if fileobj is None:
+                    try:
+                        copy_file(path.join(self.cache_dir, index["digest"]), target, use_hardlinks=False)
+                    except (IOError, OSError) as exc:
+                        if exc.errno != errno.ENOENT:
+                            raise
+                        # evicted in the meantime
+                        fileobj, new_validator = open_url(url)
+                    else:
+                        logger.info("Using cached copy of {}".format(url))
+                        name = index["digest"]
+                        self.touch(name)
+            else:
+                fileobj, new_validator = open_url(url)
+            if name is None:
+                try:
+                    name = self._store(fileobj, url)
+                finally:
+                    fileobj.close()
+                self._write_index(url, digest=name, validator=new_validator)
+                copy_file(path.join(self.cache_dir, name), target, use_hardlinks=False)
+        self.evict(keep=(name,))
+
+
+class ResultCache(DiskCache):
+    """
+    Results of jobs on deterministic platforms, so that a job identical to
+    one which has already run can be given the same results without
+    running it again.
+
+    Entries are keyed by a hash of everything that determines the result of
+    a job (see `job_key()`). Each entry holds a copy of the output files of
+    the job, under ``outputs``, and of its log files.
+    """
+
+    def job_key(self, parameters, working_directory, ignore_files=()):
+        """
+        Return the key for a job, from a JSON-serializable dict of the
+        parameters of the job (command line, hardware_config, ...) and the
+        contents of its working directory (code and input data).
+        """
+        digest = hashlib.sha256(json.dumps(parameters, sort_keys=True).encode("utf-8"))
+        digest.update(tree_digest(working_directory, ignore_files=ignore_files).encode("ascii"))
+        return digest.hexdigest()
+
+    def store(self, key, output_dir, output_files, log_files, **meta):
+        """
+        Store the files with the given paths relative to `output_dir`, and
+        the log files given as a dict of label: path. Returns True if the
+        result was stored.
+        """
+        name = self.entry_name(key)
+        entry = path.join(self.cache_dir, name)
+        with self.lock(name):
+            tmp_dir = "{}.tmp{}".format(entry, os.getpid())
+            remove_path(tmp_dir)
+            os.makedirs(path.join(tmp_dir, "outputs"))
+            failures = copy_files(output_dir, path.join(tmp_dir, "outputs"), output_files, use_hardlinks=False)
+            try:
+                for label, log_file in log_files.items():
+                    if path.exists(log_file):
+                        copy_file(log_file, path.join(tmp_dir, label), use_hardlinks=False)
+            except (IOError, OSError) as exc:
+                failures.append((log_file, repr(exc)))
+            if failures:
+                logger.warning("Could not cache the results of a job: {}".format(failures))
+                remove_path(tmp_dir)
+                return False
+            self.remove(name)
+            os.rename(tmp_dir, entry)
+            self.write_meta(name, key=key, files=list(output_files), stored=time.time(), **meta)
+        self.evict(keep=(name,))
+        return True
+
+    def fetch(self, key, output_dir, log_files):
+        """
+        Copy the cached output files of a job to `output_dir`, and its log
+        files to the paths given as a dict of label: path. Returns the
+        metadata stored with the result, or None if it is not in the cache.
+        """
+        name = self.entry_name(key)
+        entry = path.join(self.cache_dir, name)
+        with self.lock(name):
+            meta = self.read_meta(name)
+            if meta is None or meta.get("key") != key or not path.isdir(entry):
+                return None
+            failures = copy_files(path.join(entry, "outputs"), output_dir, meta["files"], use_hardlinks=False)
+            if failures:
+                raise IOError("Failed to copy cached results: {}".format(failures))
+            for label, log_file in log_files.items():
+                if path.exists(path.join(entry, label)):
+                    copy_file(path.join(entry, label), log_file, use_hardlinks=False)
+            self.touch(name)
+        logger.info("Using cached results {}".format(key))
+        return meta
@@ -0,0 +1,510 @@
+"""
+Filesystem helpers used by the job runner (see nmpi_saga) for moving
+job data around.
+
+These functions do not depend on SAGA, so they can be used and tested
+independently of a batch system.
+
+"""
+
+import os
+from os import path
+import errno
+import gzip
+import hashlib
+import stat
+import shutil
+import logging
+import tarfile
+import tempfile
+import zipfile
+from multiprocessing.pool import ThreadPool
+try:
+    from urlparse import urlparse
+except ImportError:  # Py3
+    from urllib.parse import urlparse
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+try:
+    from hashlib import blake2b
+except ImportError:  # Python 2
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+import requests
+
+logger = logging.getLogger("NMPI")
+
+DEFAULT_COPY_THREADS = 8
+FICLONE = 0x40049409  # from linux/fs.h
+COPY_CHUNK_SIZE = 2**24
+HASH_CHUNK_SIZE = 2**20
+# checksums are given as "<algorithm>:<hex digest>"
+CHECKSUM_ALGORITHM = "blake2b" if blake2b is not None else "sha256"
+ARCHIVE_EXTENSIONS = (".tar.gz", ".tgz", ".zip")
+DOWNLOAD_TIMEOUT = 60  # seconds without data before a download is abandoned
+ZIP_SPOOL_SIZE = 2**26  # zip archives larger than this are spooled to disk
+LAST_MODIFIED_PREFIX = "last-modified:"
+TRUNCATION_MARKER = "\n\n... truncated...\n\n"
+
+# errors which mean that a copy method is not available for this pair of
+# files (different filesystems, no kernel support, ...) rather than that
+# something is wrong with the files themselves
+_UNSUPPORTED = set(getattr(errno, name) for name in
+                   ("EXDEV", "EPERM", "EOPNOTSUPP", "ENOTSUP", "ENOTTY", "EINVAL",
+                    "ENOSYS", "EBADF", "EMLINK")
+                   if hasattr(errno, name))
+
+
+def make_directories(directories):
+    """
+    Create all the given directories (and their parents), skipping any
+    already created by an earlier entry.
+    """
+    created = set()
+    for directory in sorted(set(directories), key=len, reverse=True):
+        if directory in created:
+            continue
+        try:
+            os.makedirs(directory)
+        except OSError as exc:
+            if not (exc.errno == errno.EEXIST and path.isdir(directory)):
+                raise
+        while directory and directory not in created:
+            created.add(directory)
+            directory = path.dirname(directory)
+
+
+def _hardlink(src, dst):
+    os.link(src, dst)
+
+
+def _reflink(src, dst):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "reflinks not supported")
+    with open(src, "rb") as fsrc:
+        with open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def _kernel_copy(src, dst):
+    """Copy within the kernel, using copy_file_range() or sendfile()."""
+    copy_range = getattr(os, "copy_file_range", None)
+    sendfile = getattr(os, "sendfile", None)
+    if copy_range is None and sendfile is None:
+        raise OSError(errno.ENOSYS, "in-kernel copy not supported")
+    with open(src, "rb") as fsrc:
+        with open(dst, "wb") as fdst:
+            in_fd, out_fd = fsrc.fileno(), fdst.fileno()
+            remaining = os.fstat(in_fd).st_size
+            offset = 0
+            while remaining > 0:
+                count = min(remaining, COPY_CHUNK_SIZE)
+                if copy_range is not None:
+                    sent = copy_range(in_fd, out_fd, count)
+                else:
+                    sent = sendfile(out_fd, in_fd, offset, count)
+                if sent == 0:
+                    break
+                offset += sent
+                remaining -= sent
+
+
+def _byte_copy(src, dst):
+    shutil.copyfile(src, dst)
+
+
+def new_checksum():
+    """Return a hash object for the checksums of output files."""
+    if blake2b is not None:
+        return blake2b()
+    return hashlib.sha256()
+
+
+def format_checksum(hash_object, algorithm=CHECKSUM_ALGORITHM):
+    return "{}:{}".format(algorithm, hash_object.hexdigest())
+
+
+def _update_from_file(hash_object, file_path):
+    with open(file_path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b""):
+            hash_object.update(chunk)
+
+
+def _hashing_copy(src, dst, hash_object):
+    """Copy a file through user space, hashing the data on the way."""
+    with open(src, "rb") as fsrc:
+        with open(dst, "wb") as fdst:
+            for chunk in iter(lambda: fsrc.read(HASH_CHUNK_SIZE), b""):
+                hash_object.update(chunk)
+                fdst.write(chunk)
+    shutil.copymode(src, dst)
+
+
+def file_checksum(file_path, algorithm=CHECKSUM_ALGORITHM):
+    """
+    Return the checksum of a file, as "<algorithm>:<hex digest>", reading
+    it in chunks. Raises ValueError if `algorithm` is not available.
+    """
+    if algorithm == CHECKSUM_ALGORITHM:
+        hash_object = new_checksum()
+    else:
+        hash_object = hashlib.new(algorithm)
+    _update_from_file(hash_object, file_path)
+    return format_checksum(hash_object, algorithm)
+
+
+# from cheapest to most expensive
+COPY_METHODS = (
+    ("hardlink", _hardlink),
+    ("reflink", _reflink),
+    ("kernel", _kernel_copy),
+    ("copy", _byte_copy),
+)
+
+
+def copy_file(src, dst, use_hardlinks=True, disabled=None, hash_object=None):
+    """
+    Copy the file `src` to `dst`, using the cheapest method that works.
+
+    Hard links are tried first (unless `use_hardlinks` is False), then
+    reflinks, then an in-kernel copy and finally a plain byte copy.
+    Methods found not to work are added to the set `disabled`, if given,
+    so that they are not tried again for other files.
+
+    If `hash_object` is given, it is updated with the contents of the file.
+    Links are made and the file then read once; otherwise the data is
+    hashed as it is copied, instead of being copied within the kernel, so
+    that it is only read once.
+
+    Returns the name of the method used.
+    """
+    if disabled is None:
+        disabled = set()
+    if path.lexists(dst):
+        os.remove(dst)
+    for name, method in COPY_METHODS:
+        if name in disabled or (name == "hardlink" and not use_hardlinks):
+            continue
+        if hash_object is not None and name == "kernel":
+            continue
+        if name == "copy":
+            if hash_object is not None:
+                _hashing_copy(src, dst, hash_object)
+            else:
+                method(src, dst)
+            return name
+        try:
+            method(src, dst)
+        except (IOError, OSError) as exc:
+            if exc.errno not in _UNSUPPORTED:
+                raise
+            logger.debug("Copy method '{}' not available for {}: {}".format(name, dst, exc))
+            if exc.errno in (errno.EXDEV, errno.ENOSYS):
+                # won't work for any other file either
+                disabled.add(name)
+            if path.lexists(dst):
+                os.remove(dst)
+            continue
+        if hash_object is not None:
+            _update_from_file(hash_object, dst)
+        return name
+
+
+def copy_files(source_dir, target_dir, relative_paths,
+               threads=DEFAULT_COPY_THREADS, use_hardlinks=True, checksums=None):
+    """
+    Copy the files with the given paths, relative to `source_dir`, to the
+    same relative locations under `target_dir`.
+
+    Directories are created up front, then the files are copied by a pool
+    of at most `threads` threads. A failure to copy one file does not stop
+    the others being copied.
+
+    If a dict is given as `checksums`, the checksum of each file copied
+    (see `file_checksum()`) is added to it, by relative path, computed in
+    the same pass as the copy (see `copy_file()`).
+
+    Returns a list of (relative_path, error message) tuples, one for each
+    file that could not be copied.
+    """
+    failures = []
+    if not relative_paths:
+        return failures
+    try:
+        make_directories(path.dirname(path.join(target_dir, p)) for p in relative_paths)
+    except OSError as exc:
+        return [(p, repr(exc)) for p in relative_paths]
+
+    disabled = set()
+
+    def _copy(relative_path):
+        hash_object = new_checksum() if checksums is not None else None
+        try:
+            copy_file(path.join(source_dir, relative_path),
+                      path.join(target_dir, relative_path),
+                      use_hardlinks=use_hardlinks, disabled=disabled, hash_object=hash_object)
+        except Exception as exc:
+            return relative_path, repr(exc)
+        if hash_object is not None:
+            checksums[relative_path] = format_checksum(hash_object)
+        return None
+
+    failures = [result for result in _map(_copy, relative_paths, threads) if result is not None]
+    for relative_path, message in failures:
+        logger.warning("Failed to copy {}: {}".format(relative_path, message))
+    return failures
+
+
+def checksum_files(root, relative_paths, threads=DEFAULT_COPY_THREADS):
+    """
+    Compute the checksums of the files with the given paths, relative to
+    `root`, with a pool of at most `threads` threads, for files which need
+    no copying. Returns a dict of checksums by relative path, and a list of
+    (relative_path, error message) tuples for the files which could not be read.
+    """
+    def _checksum(relative_path):
+        try:
+            return relative_path, file_checksum(path.join(root, relative_path)), None
+        except Exception as exc:
+            return relative_path, None, repr(exc)
+
+    checksums = {}
+    failures = []
+    for relative_path, checksum, error in _map(_checksum, relative_paths, threads):
+        if error:
+            logger.warning("Failed to compute the checksum of {}: {}".format(relative_path, error))
+            failures.append((relative_path, error))
+        else:
+            checksums[relative_path] = checksum
+    return checksums, failures
+
+
+def _map(func, items, threads):
+    """`map()` with a pool of at most `threads` threads."""
+    threads = max(1, min(threads, len(items)))
+    if threads == 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def link_tree(source_dir, target_dir, use_hardlinks=True):
+    """
+    Reproduce the tree `source_dir` under `target_dir`, hard-linking the
+    files where possible (see `copy_file()`). Symbolic links are recreated
+    as they are.
+
+    With `use_hardlinks` False, the files are copies (reflinks where the
+    filesystem supports them), with the permissions of the originals plus
+    write permission for the owner.
+    """
+    disabled = set()
+    length_root = len(source_dir) + len(path.sep)
+    for dirpath, dirs, files in os.walk(source_dir):
+        target = path.join(target_dir, dirpath[length_root:])
+        make_directories([target])
+        for name in dirs + files:
+            source = path.join(dirpath, name)
+            destination = path.join(target, name)
+            if path.islink(source):
+                if path.lexists(destination):
+                    os.remove(destination)
+                os.symlink(os.readlink(source), destination)
+            elif name in files:
+                method = copy_file(source, destination, use_hardlinks=use_hardlinks, disabled=disabled)
+                if method != "hardlink":
+                    os.chmod(destination, stat.S_IMODE(os.stat(source).st_mode) | stat.S_IWUSR)
+
+
+def make_read_only(root):
+    """Remove write permission from all the files below root."""
+    no_write = ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+    for dirpath, dirs, files in os.walk(root):
+        for file in files:
+            full_path = path.join(dirpath, file)
+            if not path.islink(full_path):
+                os.chmod(full_path, os.stat(full_path).st_mode & no_write)
+
+
+def _check_member_path(target_dir, name):
+    """
+    Raise ValueError if an archive member called `name` would be
+    extracted outside `target_dir`.
+    """
+    root = path.realpath(target_dir)
+    destination = path.realpath(path.join(root, name))
+    if path.isabs(name) or not (destination == root or destination.startswith(root + path.sep)):
+        raise ValueError("Archive member '{}' would be extracted outside {}".format(name, target_dir))
+    return destination
+
+
+def extract_tar(fileobj, target_dir):
+    """
+    Extract a (possibly compressed) tar archive read sequentially from
+    `fileobj`, so that it never needs to be written to disk as a whole.
+    Members with absolute paths, '..' components or links pointing outside
+    `target_dir` are rejected; device files and FIFOs are skipped.
+    """
+    with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+        if hasattr(tarfile, "data_filter"):
+            archive.extraction_filter = tarfile.data_filter
+        for member in archive:
+            _check_member_path(target_dir, member.name)
+            if member.issym():
+                _check_member_path(target_dir, path.join(path.dirname(member.name), member.linkname))
+            elif member.islnk():
+                _check_member_path(target_dir, member.linkname)
+            elif not (member.isfile() or member.isdir()):
+                logger.debug("Skipping special file {} in archive".format(member.name))
+                continue
+            archive.extract(member, target_dir)
+
+
+def extract_zip(fileobj, target_dir):
+    """
+    Extract a zip archive from `fileobj`, which must be seekable.
+    Members that would be extracted outside `target_dir` are rejected.
+    Executable permissions are preserved.
+    """
+    with zipfile.ZipFile(fileobj) as archive:
+        members = archive.infolist()
+        for member in members:
+            _check_member_path(target_dir, member.filename)
+        for member in members:
+            extracted = archive.extract(member, target_dir)
+            mode = (member.external_attr >> 16) & 0o777
+            if mode & 0o111 and not member.filename.endswith("/"):
+                os.chmod(extracted, os.stat(extracted).st_mode | (mode & 0o111))
+
+
+def extract_archive(fileobj, name, target_dir):
+    """
+    Extract the archive read from `fileobj` into `target_dir`, using the
+    file `name` to decide whether it is a tar or a zip archive.
+    """
+    if name.endswith(".zip"):
+        # the zip central directory is at the end of the file, so a zip
+        # archive cannot be extracted as it streams in. Spool it, in memory
+        # if it is small enough.
+        spool = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_SIZE)
+        try:
+            shutil.copyfileobj(fileobj, spool, COPY_CHUNK_SIZE)
+            spool.seek(0)
+            extract_zip(spool, target_dir)
+        finally:
+            spool.close()
+    else:
+        extract_tar(fileobj, target_dir)
+
+
+def open_url(url, validator=None):
+    """
+    Start downloading the file at `url`, which may be an http(s) or file URL.
+
+    Returns a tuple (file object, validator), where the validator identifies
+    this version of the file (the ETag or, failing that, the Last-Modified
+    date for HTTP; modification time and size for local files) or is None
+    if the server does not provide one. If the `validator` argument is given
+    and still matches, the file is not downloaded and the file object is None.
+    """
+    url_parts = urlparse(url)
+    if url_parts.scheme in ("", "file"):
+        local_path = url_parts.path
+        file_stat = os.stat(local_path)
+        current = "{}-{}".format(file_stat.st_mtime, file_stat.st_size)
+        if current == validator:
+            return None, validator
+        return open(local_path, "rb"), current
+    headers = {}
+    if validator and validator.startswith(LAST_MODIFIED_PREFIX):
+        headers["If-Modified-Since"] = validator[len(LAST_MODIFIED_PREFIX):]
+    elif validator:
+        headers["If-None-Match"] = validator
+    response = requests.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    if validator and response.status_code == 304:
+        response.close()
+        return None, validator
+    response.raise_for_status()
+    response.raw.decode_content = True
+    if "ETag" in response.headers:
+        current = response.headers["ETag"]
+    elif "Last-Modified" in response.headers:
+        current = LAST_MODIFIED_PREFIX + response.headers["Last-Modified"]
+    else:
+        current = None
+    return response.raw, current
+
+
+def download_file(url, target):
+    """
+    Download the file at `url` to the path `target`, streaming it to disk.
+    The file only appears at `target` once it is complete.
+    """
+    fileobj, _ = open_url(url)
+    partial = target + ".part"
+    try:
+        with open(partial, "wb") as fp:
+            shutil.copyfileobj(fileobj, fp, COPY_CHUNK_SIZE)
+    except Exception:
+        if path.exists(partial):
+            os.remove(partial)
+        raise
+    finally:
+        fileobj.close()
+    os.rename(partial, target)
+
+
+def fetch_archive(url, target_dir):
+    """
+    Download the archive at `url` and extract it into `target_dir` as it
+    arrives, without keeping a copy of the archive.
+    """
+    fileobj, _ = open_url(url)
+    try:
+        extract_archive(fileobj, urlparse(url).path, target_dir)
+    finally:
+        fileobj.close()
+
+
+def to_text(data):
+    """Decode bytes read from a file, replacing invalid UTF-8."""
+    if not isinstance(data, str):  # Py3
+        data = data.decode("utf-8", "replace")
+    return data
+
+
+def read_head_tail(file_path, max_length):
+    """
+    Return the contents of a file if it is no longer than `max_length`
+    bytes. Otherwise return only the first and last `max_length // 2`
+    bytes, separated by a marker, as `nmpi_saga.truncate_string()` does,
+    but without reading the rest of the file.
+    """
+    with open(file_path, "rb") as fp:
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell()
+        fp.seek(0)
+        if size <= max_length:
+            return to_text(fp.read())
+        head = fp.read(max_length // 2)
+        fp.seek(-(max_length // 2), os.SEEK_END)
+        tail = fp.read()
+    return to_text(head) + TRUNCATION_MARKER + to_text(tail)
+
+
+def compress_file(source, target):
+    """Write a gzip-compressed copy of the file `source` to `target`."""
+    with open(source, "rb") as fsrc:
+        fdst = gzip.open(target, "wb")
+        try:
+            shutil.copyfileobj(fsrc, fdst, COPY_CHUNK_SIZE)
+        finally:
+            fdst.close()
@@ -0,0 +1,363 @@
+"""
+Fork servers: Python interpreters which have already imported PyNN and its
+backend, and fork a fresh child for each job, so that short jobs do not
+spend seconds importing the same modules again.
+
+A server is started for each Python executable (i.e. for each PyNN
+version), by running this file with that executable. The runner talks to it
+through a Unix socket, one connection per job, with one JSON message per
+line: the runner sends the job, the server replies with the process ID of
+the child, once the child is in a session of its own, so that the runner
+can kill its process group, and, when the child has exited, with its exit
+code and rusage.
+
+Each child starts in a new session, with the job's working directory and
+environment (the server's environment is not inherited), its standard
+output and error redirected to the job's files, and a freshly seeded random
+number generator.
+
+This file must only import the standard library, since it is run by the
+interpreters of the jobs, in which the nmpi package may not be installed.
+
+"""
+
+import os
+import sys
+import json
+import errno
+import random
+import select
+import signal
+import socket
+import logging
+import tempfile
+import time
+import threading
+import subprocess
+import traceback
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+logger = logging.getLogger("NMPI")
+
+START_TIMEOUT = 120  # seconds allowed for the server to import its modules
+RETRY_INTERVAL = 600  # seconds before trying again to start a server which failed to start
+
+
+def _send(conn, message):
+    conn.sendall((json.dumps(message) + "\n").encode("utf-8"))
+
+
+def _receive(reader):
+    line = reader.readline()
+    if not line:
+        return None
+    if isinstance(line, bytes):
+        line = line.decode("utf-8")
+    return json.loads(line)
+
+
+# --- server side, run by the job's interpreter ---
+
+def _run_child(conn, request, started_fd):
+    """
+    Set up the environment of a job, and run its script. Never returns.
+    `started_fd` is closed once the child is in a new session.
+    """
+    code = 1
+    try:
+        os.setsid()
+        os.close(started_fd)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        if request.get("cpus") and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, request["cpus"])
+        if request.get("memory_limit") and resource is not None:
+            resource.setrlimit(resource.RLIMIT_AS, (request["memory_limit"], request["memory_limit"]))
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, file_name, flags in ((0, os.devnull, os.O_RDONLY),
+                                     (1, request["stdout"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC),
+                                     (2, request["stderr"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC)):
+            new_fd = os.open(file_name, flags, 0o644)
+            os.dup2(new_fd, fd)
+            os.close(new_fd)
+        conn.close()
+        argv = [str(arg) for arg in request["argv"]]
+        sys.argv = argv
+        sys.path[0] = os.path.dirname(os.path.abspath(argv[0]))
+        # children of the same server must not share random number sequences
+        random.seed()
+        if "numpy" in sys.modules:
+            sys.modules["numpy"].random.seed()
+        import runpy
+        try:
+            runpy.run_path(argv[0], run_name="__main__")
+            code = 0
+        except SystemExit as exc:
+            if exc.code is None:
+                code = 0
+            elif isinstance(exc.code, int):
+                code = exc.code
+            else:
+                sys.stderr.write("{}\n".format(exc.code))
+                code = 1
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def serve(socket_path, preload=()):
+    """
+    Import the modules in `preload`, then fork a child for each job received
+    on the Unix socket at `socket_path`. Runs until standard input is closed,
+    i.e. until the runner which started the server goes away.
+    """
+    import importlib
+    for module_name in preload:
+        try:
+            importlib.import_module(module_name)
+        except Exception:
+            sys.stderr.write("Could not import {}:\n".format(module_name))
+            traceback.print_exc()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(16)
+    # on a line of its own, whatever the imported modules have printed
+    sys.stdout.write("\nready\n")
+    sys.stdout.flush()
+    children = {}  # pid -> connection
+    while True:
+        try:
+            readable = select.select([listener, sys.stdin], [], [], 0.1)[0]
+        except select.error as exc:
+            if exc.args[0] == errno.EINTR:
+                continue
+            raise
+        if sys.stdin in readable and not os.read(sys.stdin.fileno(), 1024):
+            break
+        if listener in readable:
+            conn, _ = listener.accept()
+            reader = conn.makefile("rb")
+            request = _receive(reader)
+            reader.close()
+            if request is None:
+                conn.close()
+                continue
+            started_fd, child_started_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(started_fd)
+                listener.close()
+                for other in children.values():
+                    other.close()
+                _run_child(conn, request, child_started_fd)
+            os.close(child_started_fd)
+            # until the child has called setsid() (or died): before then,
+            # killing its process group, e.g. to cancel the job, would fail
+            os.read(started_fd, 1)
+            os.close(started_fd)
+            _send(conn, {"pid": pid})
+            children[pid] = conn
+        while children:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except OSError:
+                break
+            if pid == 0:
+                break
+            conn = children.pop(pid, None)
+            if conn is None:
+                continue
+            if os.WIFEXITED(status):
+                exit_code = os.WEXITSTATUS(status)
+            else:
+                exit_code = -os.WTERMSIG(status)
+            try:
+                _send(conn, {"exit_code": exit_code,
+                             "rusage": {"ru_utime": rusage.ru_utime, "ru_stime": rusage.ru_stime,
+                                        "ru_maxrss": rusage.ru_maxrss}})
+            except socket.error:
+                pass
+            conn.close()
+    listener.close()
+
+
+# --- runner side ---
+
+class ForkedProcess(object):
+    """
+    A job started by a fork server, with the parts of the interface of
+    subprocess.Popen used by nmpi_local.LocalJobService (pid, poll()), and
+    the rusage of the process, as a dict, once it has exited.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._reader = conn.makefile("rb")
+        reply = _receive(self._reader)
+        if reply is None or "pid" not in reply:
+            conn.close()
+            raise Exception("Fork server did not start the job")
+        self.pid = reply["pid"]
+        self.returncode = None
+        self.rusage = None
+        self._thread = threading.Thread(target=self._wait, name="ForkedProcess-{}".format(self.pid))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _wait(self):
+        try:
+            reply = _receive(self._reader)
+        except (socket.error, ValueError):
+            reply = None
+        self._conn.close()
+        if reply is None:
+            logger.warning("Lost contact with the fork server running process {}".format(self.pid))
+            self.returncode = 255
+        else:
+            self.rusage = reply.get("rusage")
+            self.returncode = reply["exit_code"]
+
+    def poll(self):
+        return self.returncode
+
+
+class ForkServer(object):
+    """
+    A fork server running under the Python interpreter `executable`, with
+    the modules in `preload` imported.
+    """
+
+    def __init__(self, executable, preload=(), socket_dir=None):
+        self.executable = executable
+        self.preload = list(preload)
+        self._tmp_dir = tempfile.mkdtemp(prefix="nmpi_forkserver_", dir=socket_dir)
+        self.socket_path = os.path.join(self._tmp_dir, "socket")
+        script = os.path.abspath(__file__)
+        if script.endswith((".pyc", ".pyo")):
+            script = script[:-1]
+        self._process = subprocess.Popen([executable, script, self.socket_path] + self.preload,
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         close_fds=True)
+        if not self._wait_until_ready():
+            self.close()
+            raise Exception("Fork server for {} failed to start".format(executable))
+        logger.info("Started fork server for {} with {} imported".format(executable, ", ".join(self.preload)))
+
+    def _wait_until_ready(self):
+        """
+        Wait until the server says it has imported its modules, skipping
+        anything else it prints first, such as the banners of the modules.
+        Returns False if it stops or takes more than START_TIMEOUT seconds.
+        """
+        deadline = time.time() + START_TIMEOUT
+        fd = self._process.stdout.fileno()
+        pending = b""
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                return False
+            data = os.read(fd, 4096)
+            if not data:
+                return False
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+            if any(line.strip() == b"ready" for line in lines):
+                return True
+
+    def alive(self):
+        return self._process.poll() is None
+
+    def spawn(self, argv, cwd, env, stdout, stderr, cpus=None, memory_limit=None):
+        """Start a job, returning a `ForkedProcess`."""
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(self.socket_path)
+            _send(conn, {"argv": list(argv), "cwd": cwd, "env": dict(env),
+                         "stdout": stdout, "stderr": stderr,
+                         "cpus": cpus, "memory_limit": memory_limit})
+        except Exception:
+            conn.close()
+            raise
+        return ForkedProcess(conn)
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.stdin.close()
+            try:
+                self._process.wait()
+            except OSError:
+                pass
+        self._process.stdout.close()
+        for file_name in (self.socket_path, self._tmp_dir):
+            try:
+                if os.path.isdir(file_name):
+                    os.rmdir(file_name)
+                else:
+                    os.remove(file_name)
+            except OSError:
+                pass
+
+
+class ForkServerPool(object):
+    """
+    One fork server per Python executable, started when first needed.
+    If a server cannot be started, jobs for that executable are run cold,
+    and it is tried again after RETRY_INTERVAL seconds.
+    """
+
+    def __init__(self, preload=(), socket_dir=None):
+        self.preload = list(preload)
+        self.socket_dir = socket_dir
+        self._servers = {}
+        self._failed = {}  # executable -> time of the last failure to start its server
+        self._lock = threading.Lock()
+
+    def get(self, executable):
+        """Return the fork server for `executable`, or None if it cannot be started."""
+        with self._lock:
+            if executable in self._servers:
+                server = self._servers[executable]
+                if server.alive():
+                    return server
+                logger.warning("Fork server for {} has died, restarting it".format(executable))
+                server.close()
+                del self._servers[executable]
+            failed = self._failed.get(executable)
+            if failed is not None and time.time() - failed < RETRY_INTERVAL:
+                # run the jobs cold until it is time to try again
+                return None
+            try:
+                server = ForkServer(executable, self.preload, self.socket_dir)
+            except Exception as exception:
+                logger.warning("Could not start a fork server for {}, trying again in {} s: {}".format(
+                    executable, RETRY_INTERVAL, exception))
+                self._failed[executable] = time.time()
+                return None
+            self._failed.pop(executable, None)
+            self._servers[executable] = server
+            return server
+
+    def close(self):
+        with self._lock:
+            for server in self._servers.values():
+                server.close()
+            self._servers = {}
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    serve(sys.argv[1], sys.argv[2:])
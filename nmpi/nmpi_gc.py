@@ -0,0 +1,300 @@
+"""
+Garbage collection of the directories of jobs the runner has finished with:
+job_<id> and pack_<id> in WORKING_DIRECTORY (and job_<id> in
+OUTPUT_DIRECTORY), and job_<id> in DATA_DIRECTORY.
+
+The runner marks the working directory of a job with FINISHED_FILE once its
+output data has been copied to DATA_DIRECTORY and registered, and its final
+status reported (see `mark_finished()`). Only marked directories are
+collected, so that the directories of jobs which are still being staged, run
+or handled, by this runner or by another sharing WORKING_DIRECTORY, are never
+touched. A pack directory is collected once all the jobs of the pack are.
+
+Finished working directories are removed, oldest first, when they are older
+than `max_age` seconds, and while they take up more than `max_size` bytes in
+total. Since the output data in DATA_DIRECTORY is what is published, it is
+only removed if `data_max_age` is given, once it is older than that. This
+holds when WORKING_DIRECTORY or OUTPUT_DIRECTORY is the same as
+DATA_DIRECTORY: directories inside DATA_DIRECTORY are never collected as
+working or output directories.
+
+Collection runs in a background thread, and unlinks files in batches of
+`batch_size`, at most `rate` per second, so that it does not compete with
+running jobs for the metadata operations of a shared filesystem.
+
+"""
+
+import os
+from os import path
+import json
+import logging
+import threading
+import time
+from nmpi.nmpi_cache import directory_size, parse_size
+from nmpi import nmpi_pack
+
+logger = logging.getLogger("NMPI")
+
+FINISHED_FILE = ".nmpi_finished"
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_RATE = 1000  # files per second
+
+
+def mark_finished(working_directory):
+    """Record that the runner has finished with a job, so that its working directory can be collected."""
+    if not path.isdir(working_directory):
+        return
+    try:
+        with open(path.join(working_directory, FINISHED_FILE), "w") as fp:
+            json.dump({"finished": time.time()}, fp)
+    except IOError as exception:
+        logger.warning("Could not mark {} as finished: {}".format(working_directory, repr(exception)))
+
+
+def clear_finished(working_directory):
+    """Remove the mark left by a previous run of a job, whose working directory is being used again."""
+    try:
+        os.remove(path.join(working_directory, FINISHED_FILE))
+    except OSError:
+        pass
+
+
+class Throttle(object):
+    """Sleeps after each batch of `batch_size` operations, so as to keep to at most `rate` per second."""
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, rate=DEFAULT_RATE, stop_event=None):
+        self.batch_size = max(int(batch_size), 1)
+        self.rate = rate
+        self.stop_event = stop_event
+        self.count = 0
+        self._batch_start = time.time()
+
+    def tick(self):
+        self.count += 1
+        if self.count % self.batch_size:
+            return
+        if self.rate:
+            delay = self.batch_size / float(self.rate) - (time.time() - self._batch_start)
+            if delay > 0:
+                if self.stop_event is not None:
+                    self.stop_event.wait(delay)
+                else:
+                    time.sleep(delay)
+        self._batch_start = time.time()
+
+    def stopped(self):
+        return self.stop_event is not None and self.stop_event.is_set()
+
+
+def remove_tree(root, throttle):
+    """
+    Remove a directory tree bottom-up, one file at a time, pausing as told
+    by `throttle`. Returns False if it was stopped before the end.
+    """
+    for dirpath, dirs, files in os.walk(root, topdown=False):
+        for name in files + [d for d in dirs if path.islink(path.join(dirpath, d))]:
+            try:
+                os.remove(path.join(dirpath, name))
+            except OSError:
+                pass
+            throttle.tick()
+            if throttle.stopped():
+                return False
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            pass
+        throttle.tick()
+    return True
+
+
+class DirectoryCollector(object):
+    """
+    Removes the directories of finished jobs (see the module docstring),
+    every `interval` seconds once started.
+    """
+
+    def __init__(self, working_directory, data_directory=None, output_directory=None,
+                 max_age=None, max_size=None, data_max_age=None,
+                 batch_size=DEFAULT_BATCH_SIZE, rate=DEFAULT_RATE, interval=600):
+        self.working_directory = working_directory
+        self.data_directory = data_directory
+        self.output_directory = output_directory
+        self.max_age = max_age
+        self.max_size = parse_size(max_size)
+        self.data_max_age = data_max_age
+        self.batch_size = batch_size
+        self.rate = rate
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="DirectoryCollector")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop collecting, at the end of the current batch."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.collect()
+            except Exception as exception:
+                logger.error("Failed to collect job directories: {}".format(repr(exception)))
+            self._stop.wait(self.interval)
+
+    def _job_directories(self, root, prefix):
+        try:
+            names = os.listdir(root)
+        except OSError:
+            return []
+        return [path.join(root, name) for name in sorted(names)
+                if name.startswith(prefix) and path.isdir(path.join(root, name))]
+
+    def finished_jobs(self):
+        """
+        Return a list of (finished, size, working directory) tuples for the
+        finished jobs, oldest first. The size, which includes the job's
+        output directory, is computed once and kept in FINISHED_FILE.
+        """
+        finished = []
+        for working_directory in self._job_directories(self.working_directory, "job_"):
+            if self._in_data_directory(working_directory):
+                continue
+            marker = path.join(working_directory, FINISHED_FILE)
+            try:
+                with open(marker) as fp:
+                    info = json.load(fp)
+            except (IOError, ValueError):
+                continue
+            if "size" not in info:
+                info["size"] = sum(directory_size(directory) for directory in self._directories(working_directory))
+                try:
+                    with open(marker, "w") as fp:
+                        json.dump(info, fp)
+                except IOError:
+                    pass
+            finished.append((info["finished"], info["size"], working_directory))
+        return sorted(finished)
+
+    def _in_data_directory(self, directory):
+        """Whether `directory` is, or is inside, DATA_DIRECTORY, i.e. holds published data."""
+        if not self.data_directory:
+            return False
+        data_directory = path.realpath(self.data_directory)
+        directory = path.realpath(directory)
+        return directory == data_directory or directory.startswith(data_directory + path.sep)
+
+    def _directories(self, working_directory):
+        """
+        The directories which belong to a job, and are removed together,
+        other than those holding published data.
+        """
+        directories = [working_directory]
+        if self.output_directory:
+            directories.append(path.join(self.output_directory, path.basename(working_directory)))
+        return [directory for directory in directories if not self._in_data_directory(directory)]
+
+    def _remove(self, directory, throttle):
+        if path.isdir(directory):
+            logger.debug("Removing {}".format(directory))
+            remove_tree(directory, throttle)
+
+    def collect(self, now=None):
+        """Remove the directories which are due for it. Returns the list of removed directories."""
+        now = time.time() if now is None else now
+        throttle = Throttle(self.batch_size, self.rate, self._stop)
+        removed = []
+        finished = self.finished_jobs()
+        total = sum(size for _, size, _ in finished)
+        for finished_time, size, working_directory in finished:
+            too_old = self.max_age is not None and now - finished_time > self.max_age
+            too_big = self.max_size is not None and total > self.max_size
+            if not (too_old or too_big):
+                break  # the others are more recent, and fit in the budget
+            for directory in self._directories(working_directory):
+                # the working directory goes last, so that an interrupted removal is taken up again
+                if directory != working_directory:
+                    self._remove(directory, throttle)
+            self._remove(working_directory, throttle)
+            if throttle.stopped():
+                return removed
+            total -= size
+            removed.append(working_directory)
+        removed.extend(self._collect_packs(throttle))
+        if self.data_directory and self.data_max_age is not None:
+            for data_directory in self._job_directories(self.data_directory, "job_"):
+                if throttle.stopped():
+                    break
+                try:
+                    modified = os.stat(data_directory).st_mtime
+                except OSError:
+                    continue
+                if now - modified > self.data_max_age:
+                    self._remove(data_directory, throttle)
+                    removed.append(data_directory)
+        if removed:
+            logger.info("Removed {} job directories".format(len(removed)))
+        return removed
+
+    def _collect_packs(self, throttle):
+        """Remove the directories of packs all of whose jobs have been removed or are finished."""
+        removed = []
+        for pack_directory in self._job_directories(self.working_directory, "pack_"):
+            try:
+                with open(path.join(pack_directory, nmpi_pack.LAUNCHER_FILE)) as fp:
+                    tasks = [line.strip() for line in fp if line.strip().endswith(nmpi_pack.TASK_FILE)]
+            except IOError:
+                continue  # still being written
+            members = [path.dirname(task) for task in tasks]
+            if all(not path.isdir(member) or path.exists(path.join(member, FINISHED_FILE))
+                   for member in members):
+                self._remove(pack_directory, throttle)
+                removed.append(pack_directory)
+            if throttle.stopped():
+                break
+        return removed
+
+
+def collector_from_config(config):
+    """
+    Create a `DirectoryCollector` from the runner configuration, or return
+    None if GC_INTERVAL is not set.
+
+    Working directories are not collected if WORKING_DIRECTORY is also
+    DATA_DIRECTORY, nor output directories if OUTPUT_DIRECTORY is, since
+    they then hold the published data.
+    """
+    if not config.get('GC_INTERVAL'):
+        return None
+
+    def optional_float(key):
+        return float(config[key]) if config.get(key) is not None else None
+
+    def is_data_directory(key):
+        return (config.get(key) and config.get('DATA_DIRECTORY')
+                and path.realpath(config[key]) == path.realpath(config['DATA_DIRECTORY']))
+
+    max_age = optional_float('WORKING_DIRECTORY_MAX_AGE')
+    max_size = config.get('WORKING_DIRECTORY_SIZE')
+    if is_data_directory('WORKING_DIRECTORY') and (max_age is not None or max_size is not None):
+        logger.warning("WORKING_DIRECTORY is DATA_DIRECTORY, so working directories are only removed "
+                       "after DATA_DIRECTORY_MAX_AGE")
+        max_age = max_size = None
+    output_directory = config.get('OUTPUT_DIRECTORY')
+    if is_data_directory('OUTPUT_DIRECTORY'):
+        output_directory = None
+    return DirectoryCollector(config['WORKING_DIRECTORY'],
+                              data_directory=config.get('DATA_DIRECTORY'),
+                              output_directory=output_directory,
+                              max_age=max_age,
+                              max_size=max_size,
+                              data_max_age=optional_float('DATA_DIRECTORY_MAX_AGE'),
+                              batch_size=int(config.get('GC_BATCH_SIZE', DEFAULT_BATCH_SIZE)),
+                              rate=float(config.get('GC_RATE', DEFAULT_RATE)),
+                              interval=float(config['GC_INTERVAL']))
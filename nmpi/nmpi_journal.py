@@ -0,0 +1,133 @@
+"""
+Persistent record of the jobs a runner (see nmpi_saga) is handling, so that
+a runner which is restarted after a crash can pick up where it left off.
+
+The journal is an SQLite database in write-ahead-log mode. It should be kept
+on a local disk, since SQLite locking is not reliable on network filesystems.
+
+"""
+
+import json
+import time
+import sqlite3
+import logging
+import threading
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+logger = logging.getLogger("NMPI")
+
+# stages a job goes through in the runner
+STAGING = "staging"      # code and input data being fetched, not yet submitted to the cluster
+SUBMITTING = "submitting"  # being submitted to the cluster, its cluster job ID not yet known
+RUNNING = "running"      # submitted to the cluster
+OUTPUT = "output"        # finished on the cluster, output data being handled
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY,
+    stage TEXT NOT NULL,
+    saga_job_id TEXT,
+    working_directory TEXT,
+    start_time REAL,
+    updated REAL NOT NULL,
+    nmpi_job TEXT NOT NULL,
+    job_name TEXT
+)
+"""
+
+
+class JournalLocked(Exception):
+    pass
+
+
+class RunnerJournal(object):
+    """
+    Journal of the jobs being handled by a runner.
+
+    Only one runner at a time may use a given journal; opening a journal
+    which is in use by a live runner raises `JournalLocked`.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock_file = open(db_path + ".lock", "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                self._lock_file.close()
+                raise JournalLocked("Journal {} is in use by another runner".format(db_path))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute(SCHEMA)
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(jobs)")]
+            if "job_name" not in columns:  # journal written by an older version
+                self._db.execute("ALTER TABLE jobs ADD COLUMN job_name TEXT")
+
+    def record(self, nmpi_job, stage, **fields):
+        """
+        Record that a job has reached `stage`. `fields` may contain
+        `saga_job_id`, `working_directory`, `start_time` and `job_name` (the
+        name of the cluster job, by which it can be found before its ID is
+        known); fields not given keep their previous values.
+        """
+        with self._lock:
+            with self._db:
+                row = self._db.execute("SELECT saga_job_id, working_directory, start_time, job_name "
+                                       "FROM jobs WHERE job_id = ?", (nmpi_job["id"],)).fetchone()
+                saga_job_id, working_directory, start_time, job_name = row or (None, None, None, None)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO jobs (job_id, stage, saga_job_id, working_directory, "
+                    "start_time, updated, nmpi_job, job_name) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (nmpi_job["id"], stage,
+                     fields.get("saga_job_id", saga_job_id),
+                     fields.get("working_directory", working_directory),
+                     fields.get("start_time", start_time),
+                     time.time(),
+                     json.dumps(nmpi_job),
+                     fields.get("job_name", job_name)))
+
+    def remove(self, job_id):
+        """Forget a job, once the runner has finished with it."""
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+    def jobs(self, stage=None):
+        """
+        Return a list of the recorded jobs (optionally only those at the
+        given stage), oldest first, as dicts.
+        """
+        query = ("SELECT job_id, stage, saga_job_id, working_directory, start_time, "
+                 "updated, nmpi_job, job_name FROM jobs")
+        args = ()
+        if stage is not None:
+            query += " WHERE stage = ?"
+            args = (stage,)
+        with self._lock:
+            rows = self._db.execute(query + " ORDER BY job_id", args).fetchall()
+        return [{"job_id": row[0],
+                 "stage": row[1],
+                 "saga_job_id": row[2],
+                 "working_directory": row[3],
+                 "start_time": row[4],
+                 "updated": row[5],
+                 "nmpi_job": json.loads(row[6]),
+                 "job_name": row[7]} for row in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+        if fcntl is not None:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+        self._lock_file.close()
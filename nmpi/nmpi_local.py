@@ -0,0 +1,413 @@
+"""
+Execution of jobs as processes on the runner host, for jobs too small to be
+worth sending to the batch system.
+
+`LocalJobService` provides the part of the interface of `saga.job.Service`
+which nmpi_saga.JobRunner uses (create_job, get_job, list, close), and its
+jobs that of `saga.job.Job` (run, wait, cancel, get_state, ...), so that it
+can be used in place of a SAGA job service (see JOB_SERVICES in nmpi_saga).
+
+Jobs are started as soon as a slot is free, each pinned to its own CPUs if
+a list of CPUs is given, killed if they exceed their wall-time limit, and
+with their address space limited if a memory limit is given. Python scripts
+can be started from warm interpreters (see nmpi_forkserver). The resources
+used by each job are taken from the rusage of its process when it exits
+(see nmpi_accounting).
+
+"""
+
+import os
+from os import path
+import itertools
+import logging
+import multiprocessing
+import signal
+import subprocess
+import threading
+import time
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+try:
+    from saga.job import NEW, PENDING, RUNNING, DONE, FAILED, CANCELED
+except ImportError:
+    NEW, PENDING, RUNNING, DONE, FAILED, CANCELED = "New", "Pending", "Running", "Done", "Failed", "Canceled"
+from nmpi.nmpi_accounting import rusage_usage
+
+logger = logging.getLogger("NMPI")
+
+POLL_INTERVAL = 0.05  # seconds
+KILL_GRACE_PERIOD = 5.0  # seconds between SIGTERM and SIGKILL
+FINAL_STATES = (DONE, FAILED, CANCELED)
+
+
+class NoSuchJob(Exception):
+    pass
+
+
+def parse_cpu_list(text):
+    """Convert a CPU list such as "0-3,8,10-11" to a list of integers."""
+    cpus = []
+    for item in str(text).split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "-" in item:
+            first, last = item.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(item))
+    return cpus
+
+
+def _pin(pid, cpus):
+    """Restrict a running process to the given CPUs."""
+    try:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(pid, cpus)
+        else:
+            subprocess.call(["taskset", "--pid", "--cpu-list", ",".join(str(cpu) for cpu in cpus), str(pid)],
+                            stdout=open(os.devnull, "w"))
+    except (OSError, IOError) as exc:
+        logger.debug("Could not pin process {}: {}".format(pid, exc))
+
+
+class LocalJob(object):
+    """A job run as a local process by a `LocalJobService`."""
+
+    def __init__(self, service, job_id, description):
+        self.id = job_id
+        self.service = service
+        self.description = description
+        self.exit_code = None
+        self.cpus = None
+        self.process = None
+        self.started = None
+        self.usage = None  # see nmpi_accounting, set when the job ends
+        self.cancelled = False
+        self.timed_out = False
+        self.kill_timer = None
+        self._state = NEW
+        self._finished = threading.Event()
+
+    def get_description(self):
+        return self.description
+
+    def get_state(self):
+        state = self._state
+        if state in FINAL_STATES:
+            self.service._forget(self)
+        return state
+
+    state = property(get_state)
+
+    def run(self):
+        self.service._submit(self)
+
+    def wait(self, timeout=None):
+        """Wait until the job has finished, or for at most `timeout` seconds."""
+        self._finished.wait(timeout)
+        return self.get_state()
+
+    def cancel(self):
+        self.service._cancel(self)
+
+    def _set_state(self, state):
+        self._state = state
+        if state in (DONE, FAILED, CANCELED):
+            self._finished.set()
+
+
+class LocalJobService(object):
+    """
+    Runs jobs as local processes, at most `max_jobs` at a time.
+
+    Jobs are dropped from the service (`get_job()`, `list()`) once they have
+    finished and their final state has been read, so that a long-running
+    service does not accumulate them.
+
+    If `cpus` (a list of CPU numbers) is given, each job is pinned to
+    `cpus_per_job` of them, and no more jobs run at a time than there are
+    CPUs for. `wall_time` is the default wall-time limit in seconds (jobs
+    whose description has a `wall_time_limit`, in minutes as in SAGA, use
+    that instead), and `memory_limit` the maximum size in bytes of the
+    address space of each job.
+
+    If a `ForkServerPool` is given as `fork_servers`, jobs which run a Python
+    script are forked from a server for their interpreter, in which PyNN has
+    already been imported, rather than started from scratch.
+    """
+
+    def __init__(self, url="process://localhost", max_jobs=None, cpus=None, cpus_per_job=1,
+                 wall_time=None, memory_limit=None, fork_servers=None):
+        self.url = url
+        self.fork_servers = fork_servers
+        self.cpus_per_job = cpus_per_job
+        self.wall_time = wall_time
+        self.memory_limit = memory_limit
+        self._free_cpus = list(cpus) if cpus else None
+        if max_jobs is None:
+            max_jobs = len(cpus) // cpus_per_job if cpus else multiprocessing.cpu_count()
+        elif cpus:
+            max_jobs = min(max_jobs, len(cpus) // cpus_per_job)
+        self.max_jobs = max(max_jobs, 1)
+        self._jobs = {}
+        self._queued = []
+        self._starting = []
+        self._running = []
+        self._counter = itertools.count(1)
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="LocalJobService")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def create_job(self, description):
+        job_id = "[{}]-[{}.{}]".format(self.url, os.getpid(), next(self._counter))
+        job = LocalJob(self, job_id, description)
+        with self._condition:
+            self._jobs[job_id] = job
+        return job
+
+    def get_job(self, job_id):
+        with self._condition:
+            if job_id not in self._jobs:
+                raise NoSuchJob("No such job: {}".format(job_id))
+            return self._jobs[job_id]
+
+    def list(self):
+        with self._condition:
+            return list(self._jobs)
+
+    def close(self):
+        """Cancel all jobs which have not finished, and stop the service."""
+        with self._condition:
+            self._closed = True
+            jobs = self._queued + self._starting + self._running
+            self._condition.notify_all()
+        for job in jobs:
+            self._cancel(job)
+        self._thread.join()
+        if self.fork_servers is not None:
+            self.fork_servers.close()
+
+    def _submit(self, job):
+        with self._condition:
+            if self._closed:
+                raise Exception("Job service has been closed")
+            job._set_state(PENDING)
+            self._queued.append(job)
+            self._condition.notify_all()
+
+    def _cancel(self, job):
+        with self._condition:
+            if job in self._queued:
+                self._queued.remove(job)
+                job._set_state(CANCELED)
+                return
+            if job in self._starting:
+                # killed as soon as it has started, see `_run()`
+                job.cancelled = True
+                return
+            if job not in self._running:
+                return
+            job.cancelled = True
+        self._kill(job)
+
+    def _forget(self, job):
+        with self._condition:
+            self._jobs.pop(job.id, None)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._closed and not self._running:
+                    return
+                job = None
+                if (self._queued and len(self._running) + len(self._starting) < self.max_jobs
+                        and not self._closed):
+                    job = self._queued.pop(0)
+                    self._reserve(job)
+                elif not self._running:
+                    self._condition.wait(1.0)
+                    continue
+            if job is not None:
+                # spawning a process can take a while, so it is done without the lock
+                self._start(job)
+                continue
+            self._poll()
+            time.sleep(POLL_INTERVAL)
+
+    def _reserve(self, job):
+        """Give a job its CPUs, before it is started. Must be called with the lock held."""
+        if self._free_cpus is not None:
+            job.cpus = self._free_cpus[:self.cpus_per_job]
+            del self._free_cpus[:self.cpus_per_job]
+        self._starting.append(job)
+
+    def _start(self, job):
+        """Start the process for a job reserved by `_reserve()`. Must be called without the lock."""
+        description = job.description
+        working_directory = description.working_directory or os.getcwd()
+        env = dict(os.environ)
+        env.update(getattr(description, "environment", None) or {})
+        stdout_path = path.join(working_directory, description.output or "stdout")
+        stderr_path = path.join(working_directory, description.error or "stderr")
+        try:
+            job.process = self._fork(job, working_directory, env, stdout_path, stderr_path)
+            if job.process is None:
+                job.process = self._popen(job, working_directory, env, stdout_path, stderr_path)
+        except Exception as exception:
+            logger.error("Failed to start job {}: {}".format(job.id, repr(exception)))
+            with self._condition:
+                self._starting.remove(job)
+                self._release(job)
+                self._condition.notify_all()
+            job._set_state(FAILED)
+            return
+        job.started = time.time()
+        with self._condition:
+            self._starting.remove(job)
+            self._running.append(job)
+            self._condition.notify_all()
+        job._set_state(RUNNING)
+        logger.debug("Started job {} as process {}".format(job.id, job.process.pid))
+        if job.cancelled:
+            self._kill(job)
+
+    def _fork(self, job, working_directory, env, stdout_path, stderr_path):
+        """Start a Python script from a warm interpreter, if possible. Returns None if not."""
+        description = job.description
+        arguments = list(description.arguments or [])
+        if self.fork_servers is None or not arguments or not arguments[0].endswith(".py"):
+            return None
+        server = self.fork_servers.get(description.executable)
+        if server is None:
+            return None
+        try:
+            process = server.spawn(arguments, working_directory, env, stdout_path, stderr_path,
+                                   cpus=job.cpus, memory_limit=self.memory_limit)
+        except Exception as exception:
+            logger.warning("Fork server failed to start job {}, starting it cold: {}".format(
+                job.id, repr(exception)))
+            return None
+        if job.cpus:
+            _pin(process.pid, job.cpus)
+        return process
+
+    def _popen(self, job, working_directory, env, stdout_path, stderr_path):
+        description = job.description
+        args = [description.executable] + list(description.arguments or [])
+        if job.cpus and not hasattr(os, "sched_setaffinity"):
+            args = ["taskset", "--cpu-list", ",".join(str(cpu) for cpu in job.cpus)] + args
+        stdout = open(stdout_path, "wb")
+        stderr = open(stderr_path, "wb")
+        try:
+            return subprocess.Popen(args, cwd=working_directory, env=env,
+                                    stdout=stdout, stderr=stderr, close_fds=True,
+                                    preexec_fn=self._child_setup(job.cpus))
+        finally:
+            stdout.close()
+            stderr.close()
+
+    def _child_setup(self, cpus):
+        memory_limit = self.memory_limit
+
+        def setup():
+            # own process group, so that the whole job can be killed
+            os.setsid()
+            if cpus and hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, cpus)
+            if memory_limit and resource is not None:
+                resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+        return setup
+
+    def _wall_time(self, job):
+        limit = getattr(job.description, "wall_time_limit", None)
+        if limit:
+            return float(limit) * 60
+        return self.wall_time
+
+    def _reap(self, job):
+        """
+        Return the exit code of the process of a job and its rusage, or
+        (None, None) if it is still running.
+        """
+        process = job.process
+        if not isinstance(process, subprocess.Popen) or not hasattr(os, "wait4"):
+            # a process forked by a fork server, which reports its rusage
+            return process.poll(), getattr(process, "rusage", None)
+        if process.returncode is not None:
+            return process.returncode, None
+        try:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+        except OSError:
+            return process.poll(), None
+        if pid == 0:
+            return None, None
+        # as Popen.poll() would, which can no longer wait for the process
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        return process.returncode, rusage
+
+    def _poll(self):
+        now = time.time()
+        for job in list(self._running):
+            exit_code, rusage = self._reap(job)
+            if exit_code is None:
+                wall_time = self._wall_time(job)
+                if wall_time and now - job.started > wall_time and not job.timed_out:
+                    job.timed_out = True
+                    logger.info("Job {} exceeded its wall-time limit of {} s".format(job.id, wall_time))
+                    self._write_error(job, "Job killed: wall-time limit of {} s exceeded\n".format(wall_time))
+                    self._kill(job)
+                continue
+            job.exit_code = exit_code
+            cores = len(job.cpus) if job.cpus else 1
+            if rusage is not None:
+                job.usage = rusage_usage(rusage, time.time() - job.started, cores)
+            else:
+                job.usage = {"wall_time": time.time() - job.started, "cpu_time": None,
+                             "max_rss": None, "cores": cores}
+            if job.kill_timer is not None:
+                job.kill_timer.cancel()
+            with self._condition:
+                self._running.remove(job)
+                self._release(job)
+                self._condition.notify_all()
+            if job.cancelled:
+                job._set_state(CANCELED)
+            elif exit_code == 0 and not job.timed_out:
+                job._set_state(DONE)
+            else:
+                job._set_state(FAILED)
+
+    def _kill(self, job):
+        """Terminate the process group of a job, then kill it if it does not stop."""
+        def kill(sig):
+            try:
+                os.killpg(job.process.pid, sig)
+            except OSError:
+                pass
+        kill(signal.SIGTERM)
+        if job.kill_timer is None:
+            job.kill_timer = threading.Timer(KILL_GRACE_PERIOD, kill, (signal.SIGKILL,))
+            job.kill_timer.daemon = True
+            job.kill_timer.start()
+
+    def _release(self, job):
+        if job.cpus and self._free_cpus is not None:
+            self._free_cpus.extend(job.cpus)
+            job.cpus = None
+
+    def _write_error(self, job, message):
+        description = job.description
+        try:
+            with open(path.join(description.working_directory or os.getcwd(),
+                                description.error or "stderr"), "a") as fp:
+                fp.write(message)
+        except IOError:
+            pass
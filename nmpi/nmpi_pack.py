@@ -0,0 +1,263 @@
+"""
+Packing of many small jobs into one cluster job, so that the overhead of the
+batch system is paid once per pack rather than once per job.
+
+A pack is a single cluster job running a launcher script, which runs the
+jobs of the pack, at most `parallel` at a time, each in its own working
+directory with its own stdout and stderr files, exactly as if it had been
+submitted on its own. Each job writes its exit code to EXIT_CODE_FILE in its
+working directory when it ends.
+
+The runner sees each job of a pack as a `PackedJob`, which has the part of
+the interface of `saga.job.Job` used by nmpi_saga.JobRunner, and whose state
+is derived from its exit code file and the state of the pack.
+
+"""
+
+import os
+from os import path
+import math
+import time
+import logging
+try:
+    from shlex import quote
+except ImportError:  # Python 2
+    from pipes import quote
+try:
+    from saga.job import NEW, PENDING, RUNNING, DONE, FAILED, CANCELED
+except ImportError:
+    NEW, PENDING, RUNNING, DONE, FAILED, CANCELED = "New", "Pending", "Running", "Done", "Failed", "Canceled"
+
+logger = logging.getLogger("NMPI")
+
+TASK_FILE = ".nmpi_task.sh"
+EXIT_CODE_FILE = ".nmpi_exit_code"
+CANCEL_FILE = ".nmpi_cancel"
+PACK_FILES = (TASK_FILE, EXIT_CODE_FILE, CANCEL_FILE)  # not output data
+LAUNCHER_FILE = "launcher.sh"
+MEMBER_SEPARATOR = "#"
+POLL_INTERVAL = 1.0  # seconds between checks of the pack state
+CANCEL_CHECK_INTERVAL = 1  # seconds between checks of the cancel file by a running job
+CANCELLED_EXIT_CODE = 143
+TIMEOUT_EXIT_CODE = 124  # exit code of timeout(1) when the time limit is reached
+KILL_GRACE_PERIOD = 30  # seconds between SIGTERM and SIGKILL for jobs over their wall-time limit
+
+FINAL_STATES = (DONE, FAILED, CANCELED)
+
+
+def member_job_id(pack_job_id, nmpi_job_id):
+    """Return the job ID of a job in a pack, e.g. "[slurm://localhost]-[1234]#42"."""
+    return "{}{}{}".format(pack_job_id, MEMBER_SEPARATOR, nmpi_job_id)
+
+
+def pack_job_id(job_id):
+    """Return the ID of the pack from the ID of a job in it, or None if the job was not packed."""
+    if job_id and MEMBER_SEPARATOR in str(job_id):
+        return str(job_id).rsplit(MEMBER_SEPARATOR, 1)[0]
+    return None
+
+
+def _task_script(job_desc):
+    """Shell script running one job of a pack, and recording its exit code."""
+    environment = "".join("export {}={}\n".format(name, quote(str(value)))
+                          for name, value in sorted((job_desc.environment or {}).items()))
+    command = " ".join(quote(str(arg)) for arg in [job_desc.executable] + list(job_desc.arguments or []))
+    timeout = timed_out = ""
+    wall_time_limit = getattr(job_desc, "wall_time_limit", None)
+    if wall_time_limit:
+        # the cluster job only has a limit for the whole pack, so each job's own limit is enforced here
+        timeout = "timeout -k {} {} ".format(KILL_GRACE_PERIOD, int(wall_time_limit) * 60)
+        timed_out = ("if [ $code -eq {} ]; then "
+                     "echo 'Job killed: wall-time limit of {} minutes exceeded' >> {}; fi\n").format(
+                         TIMEOUT_EXIT_CODE, wall_time_limit, quote(job_desc.error))
+    # The job runs in a process group of its own, which is killed if the
+    # job is cancelled (see PackedJob.cancel) while it is running. This is
+    # done by the script, on the node running the pack, as the runner may
+    # be on another host.
+    return ("#!/bin/sh\n"
+            "cd {working_directory} || exit 1\n"
+            "if [ -e {cancel} ]; then echo {cancelled} > {exit_code}; exit 0; fi\n"
+            "{environment}"
+            "if command -v setsid > /dev/null; then group=setsid; else group=; fi\n"
+            "$group {timeout}{command} < /dev/null > {output} 2> {error} &\n"
+            "pid=$!\n"
+            "while kill -0 $pid 2> /dev/null; do\n"
+            "  if [ -e {cancel} ]; then\n"
+            "    kill -TERM -$pid 2> /dev/null || kill -TERM $pid\n"
+            "    (sleep {grace}; kill -KILL -$pid 2> /dev/null || kill -KILL $pid) 2> /dev/null &\n"
+            "    break\n"
+            "  fi\n"
+            "  sleep {poll}\n"
+            "done\n"
+            "wait $pid\n"
+            "code=$?\n"
+            "{timed_out}"
+            "echo $code > {exit_code}.tmp && mv {exit_code}.tmp {exit_code}\n").format(
+                working_directory=quote(job_desc.working_directory),
+                cancel=CANCEL_FILE, cancelled=CANCELLED_EXIT_CODE, exit_code=EXIT_CODE_FILE,
+                grace=KILL_GRACE_PERIOD, poll=CANCEL_CHECK_INTERVAL,
+                environment=environment, timeout=timeout, command=command, timed_out=timed_out,
+                output=quote(job_desc.output), error=quote(job_desc.error))
+
+
+def write_pack(pack_directory, job_descs, parallel=1):
+    """
+    Write the task script of each job, and the launcher running them, and
+    return the path of the launcher.
+    """
+    if not path.exists(pack_directory):
+        os.makedirs(pack_directory)
+    tasks = []
+    for job_desc in job_descs:
+        task = path.join(job_desc.working_directory, TASK_FILE)
+        for file_name in (EXIT_CODE_FILE, CANCEL_FILE):
+            if path.exists(path.join(job_desc.working_directory, file_name)):
+                os.remove(path.join(job_desc.working_directory, file_name))
+        with open(task, "w") as fp:
+            fp.write(_task_script(job_desc))
+        tasks.append(task)
+    launcher = path.join(pack_directory, LAUNCHER_FILE)
+    with open(launcher, "w") as fp:
+        fp.write("#!/bin/sh\n"
+                 "# {} NMPI jobs, at most {} at a time\n"
+                 "xargs -P {} -I TASK /bin/sh TASK <<'END_OF_TASKS'\n"
+                 "{}\n"
+                 "END_OF_TASKS\n".format(len(tasks), parallel, max(int(parallel), 1), "\n".join(tasks)))
+    return launcher
+
+
+def describe_pack(pack_desc, pack_directory, name, job_descs, parallel=1, queue=None):
+    """
+    Fill in `pack_desc`, a new saga.job.Description, for a cluster job
+    running the jobs described by `job_descs`. Returns `pack_desc`.
+    """
+    pack_desc.name = name
+    pack_desc.working_directory = pack_directory
+    pack_desc.executable = "/bin/sh"
+    pack_desc.arguments = [write_pack(pack_directory, job_descs, parallel)]
+    pack_desc.output = "pack.out"
+    pack_desc.error = "pack.err"
+    if queue is not None:
+        pack_desc.queue = queue
+    if parallel > 1:
+        pack_desc.total_cpu_count = parallel
+    limits = [getattr(job_desc, "wall_time_limit", None) for job_desc in job_descs]
+    if limits and all(limits):
+        # the launcher starts each job as soon as a slot is free, so the
+        # pack ends at most the longest job after the average load per slot
+        pack_desc.wall_time_limit = int(math.ceil(sum(limits) / float(parallel))) + max(limits)
+    return pack_desc
+
+
+class JobPack(object):
+    """A cluster job running a pack of jobs."""
+
+    def __init__(self, saga_job):
+        self.saga_job = saga_job
+        self.members = []
+        self._state = None
+        self._checked = None
+
+    @property
+    def id(self):
+        return self.saga_job.id
+
+    def get_state(self):
+        """The state of the cluster job, asked for at most once every POLL_INTERVAL seconds."""
+        now = time.time()
+        if self._state not in FINAL_STATES and (self._checked is None or now - self._checked >= POLL_INTERVAL):
+            self._state = self.saga_job.get_state()
+            self._checked = now
+        return self._state
+
+    def wait(self, timeout):
+        if self._state not in FINAL_STATES:
+            self.saga_job.wait(timeout)
+            self._checked = None
+
+    def cancel_if_done(self):
+        """Cancel the cluster job once none of its jobs is still wanted."""
+        if all(member.cancelled or member.get_state() in FINAL_STATES for member in self.members):
+            if self.get_state() not in FINAL_STATES:
+                self.saga_job.cancel()
+
+
+class PackedJob(object):
+    """One job of a `JobPack`, looking to the runner like a SAGA job of its own."""
+
+    def __init__(self, pack, nmpi_job_id, description):
+        self.pack = pack
+        self.id = member_job_id(pack.id, nmpi_job_id)
+        self.nmpi_description = description
+        self.exit_code = None
+        self.cancelled = False
+        self._state = NEW
+        pack.members.append(self)
+
+    def get_description(self):
+        return self.nmpi_description
+
+    def get_state(self):
+        if self._state in FINAL_STATES:
+            return self._state
+        exit_code = self._read_exit_code()
+        if exit_code is None:
+            pack_state = self.pack.get_state()
+            if pack_state in FINAL_STATES:
+                # the job may have ended just before the pack
+                exit_code = self._read_exit_code()
+                if exit_code is None:
+                    self._state = CANCELED if self.cancelled or pack_state == CANCELED else FAILED
+                    self._write_error("Job pack {} ended before the job did\n".format(self.pack.id))
+                    return self._state
+            else:
+                self._state = pack_state
+                return self._state
+        self.exit_code = exit_code
+        if self.cancelled or exit_code == CANCELLED_EXIT_CODE:
+            self._state = CANCELED
+        else:
+            self._state = DONE if exit_code == 0 else FAILED
+        return self._state
+
+    state = property(get_state)
+
+    def wait(self, timeout=None):
+        """Wait until the job has finished, or for at most `timeout` seconds."""
+        deadline = None if timeout is None or timeout < 0 else time.time() + timeout
+        while True:
+            state = self.get_state()
+            if state in FINAL_STATES:
+                return state
+            remaining = POLL_INTERVAL if deadline is None else min(deadline - time.time(), POLL_INTERVAL)
+            if remaining <= 0:
+                return state
+            self.pack.wait(remaining)
+
+    def cancel(self):
+        """
+        Stop the job from starting, if it has not yet, or kill it if it is
+        running: the task script of the job kills its processes when it sees
+        the cancel file. The job stays RUNNING until it has exited. The
+        whole pack is cancelled once none of its jobs is still wanted.
+        """
+        self.cancelled = True
+        try:
+            open(path.join(self.nmpi_description.working_directory, CANCEL_FILE), "w").close()
+        except IOError as exception:
+            logger.warning("Could not cancel job {}: {}".format(self.id, repr(exception)))
+        self.pack.cancel_if_done()
+
+    def _read_exit_code(self):
+        try:
+            with open(path.join(self.nmpi_description.working_directory, EXIT_CODE_FILE)) as fp:
+                return int(fp.read().strip())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_error(self, message):
+        try:
+            with open(path.join(self.nmpi_description.working_directory, self.nmpi_description.error), "a") as fp:
+                fp.write(message)
+        except IOError:
+            pass
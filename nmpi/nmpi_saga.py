@@ -22,14 +22,36 @@ All the personalization should happen in the config file.
 import os
 from os import path
 import logging
-from urlparse import urlparse
-from urllib import urlretrieve
+from urlparse import urlparse, urljoin
+from urllib import urlretrieve, urlencode
 import shutil
+import tarfile
+import zipfile
 from datetime import datetime
 import time
+import copy
+import re
+import socket
+import getpass
+import json
+import threading
+from collections import OrderedDict, namedtuple
+from multiprocessing.pool import ThreadPool
 import saga
 import subprocess
 import nmpi
+from nmpi.nmpi_files import (copy_files, checksum_files, fetch_archive, download_file, read_head_tail,
+                             compress_file, to_text, DEFAULT_COPY_THREADS, ARCHIVE_EXTENSIONS,
+                             TRUNCATION_MARKER)
+from nmpi.nmpi_cache import GitMirrorCache, ArchiveCache, InputDataCache, ResultCache, parse_size
+from nmpi import nmpi_journal
+from nmpi.nmpi_journal import RunnerJournal
+from nmpi.nmpi_scheduler import scheduler_from_config, parse_rules, FairShare
+from nmpi.nmpi_local import LocalJobService, parse_cpu_list
+from nmpi.nmpi_forkserver import ForkServerPool
+from nmpi import nmpi_pack
+from nmpi.nmpi_gc import collector_from_config, mark_finished
+from nmpi.nmpi_accounting import sacct_usage, usage_in_units, platform_units
 import codecs
 import requests
 from requests.auth import AuthBase
@@ -38,6 +60,23 @@ from requests.auth import AuthBase
 DEFAULT_SCRIPT_NAME = "run.py {system}"
 DEFAULT_PYNN_VERSION = "0.7"
 MAX_LOG_SIZE = 10000
+OUTPUT_DIRECTORY_VARIABLE = "NMPI_OUTPUT_DIRECTORY"
+DEFAULT_REGISTRATION_THREADS = 8
+DEFAULT_DOWNLOAD_THREADS = 4
+DEFAULT_RETRIES = 3
+RETRY_DELAY = 1.0  # seconds, doubled after each attempt
+LOG_CHUNK_SIZE = 4000
+UPDATE_QUEUE_DELAY = 1.0  # seconds
+MAX_UPDATE_RETRY_DELAY = 300.0  # seconds
+JOB_NAME_PREFIX = "nmpi_"
+PACK_NAME_PREFIX = JOB_NAME_PREFIX + "pack_"  # not matched by `_nmpi_job_id()`
+DEFAULT_WARM_MODULES = "pyNN,pyNN.{system}"
+DEFAULT_RECONCILE_THREADS = 8
+DEFAULT_QUOTAS_SERVICE = "https://quotas.hbpneuromorphic.eu"
+DEFAULT_FAIR_SHARE_WINDOW = 500
+QUOTA_CACHE_TIME = 600  # seconds for which the remaining quota of a collab is not asked again
+DEFAULT_WALL_TIME_GRACE = 60  # seconds past its wall-time limit before the runner cancels a job
+CANCEL_WAIT = 10  # seconds to wait for a cancelled job to stop
 
 logger = logging.getLogger("NMPI")
 
@@ -63,36 +102,68 @@ def truncate_string(stream, max_length):
     """
     """
     if len(stream) > max_length:
-        return stream[:max_length//2] + "\n\n... truncated...\n\n" + stream[-max_length//2:]
+        return stream[:max_length//2] + TRUNCATION_MARKER + stream[-max_length//2:]
     else:
         return stream
 
 
+def record_usage(nmpi_job, saga_job):
+    """
+    Report the resources used by a job, as measured by `JobRunner._account()`,
+    in the units of the platform's quotas, with the details in its provenance.
+    """
+    usage = getattr(saga_job, "resource_usage", None)
+    provenance = dict(nmpi_job.get('provenance') or {})
+    if usage is None:
+        nmpi_job['resource_usage'] = 1.0
+    else:
+        nmpi_job['resource_usage'] = usage["value"]
+        provenance["resource_usage"] = usage
+    nmpi_job['provenance'] = provenance
+    return nmpi_job
+
+
 def job_done(nmpi_job, saga_job):
     nmpi_job['status'] = "finished"
     timestamp = datetime.now().isoformat()
     nmpi_job['timestamp_completion'] = timestamp
-    nmpi_job['resource_usage'] = 1.0  # todo: report the actual usage
-    nmpi_job['provenance'] = {}  # todo: report provenance information
+    record_usage(nmpi_job, saga_job)
     log = nmpi_job.pop("log", str())
     log += "{}    finished\n".format(datetime.now().isoformat())
-    stdout, stderr = read_output(saga_job)
+    stdout, stderr = read_output(saga_job, MAX_LOG_SIZE)
     log += "\n\n"
-    log += truncate_string(stdout, MAX_LOG_SIZE)
+    log += stdout
     log += "\n\n"
-    log += truncate_string(stderr, MAX_LOG_SIZE)
+    log += stderr
     nmpi_job["log"] = log
     return nmpi_job
 
 
 def job_failed(nmpi_job, saga_job):
     nmpi_job['status'] = "error"
+    record_usage(nmpi_job, saga_job)
     log = nmpi_job.pop("log", str())
     log += "{}    failed\n\n".format(datetime.now().isoformat())
-    stdout, stderr = read_output(saga_job)
-    log += truncate_string(stdout, MAX_LOG_SIZE)
+    stdout, stderr = read_output(saga_job, MAX_LOG_SIZE)
+    log += stdout
     log += "\n\nstdout\n------\n\n"
-    log += truncate_string(stderr, MAX_LOG_SIZE)
+    log += stderr
+    nmpi_job["log"] = log
+    return nmpi_job
+
+
+def job_cancelled(nmpi_job, saga_job):
+    nmpi_job['status'] = "error"
+    record_usage(nmpi_job, saga_job)
+    log = nmpi_job.pop("log", str())
+    log += "{}    cancelled\n\n".format(datetime.now().isoformat())
+    reason = getattr(saga_job, "cancel_reason", None)
+    if reason:
+        log += reason + "\n\n"
+    stdout, stderr = read_output(saga_job, MAX_LOG_SIZE)
+    log += stdout
+    log += "\n\nstdout\n------\n\n"
+    log += stderr
     nmpi_job["log"] = log
     return nmpi_job
 
@@ -103,9 +174,252 @@ default_job_states = {
     saga.job.RUNNING: job_running,
     saga.job.DONE: job_done,
     saga.job.FAILED: job_failed,
+    saga.job.CANCELED: job_cancelled,
+}
+
+
+# states reported by squeue, see `cluster_jobs()`
+SLURM_STATES = {
+    "PENDING": saga.job.PENDING,
+    "CONFIGURING": saga.job.PENDING,
+    "RUNNING": saga.job.RUNNING,
+    "COMPLETING": saga.job.RUNNING,
+    "SUSPENDED": saga.job.SUSPENDED,
+    "COMPLETED": saga.job.DONE,
+    "CANCELLED": saga.job.CANCELED,
+    "FAILED": saga.job.FAILED,
+    "TIMEOUT": saga.job.FAILED,
+    "NODE_FAIL": saga.job.FAILED,
+    "OUT_OF_MEMORY": saga.job.FAILED,
+    "BOOT_FAIL": saga.job.FAILED,
+    "DEADLINE": saga.job.FAILED,
+    "PREEMPTED": saga.job.FAILED,
+}
+
+ClusterJob = namedtuple("ClusterJob", ["saga_job_id", "nmpi_job_id", "state", "queue"])
+
+
+def native_job_id(saga_job_id):
+    """Return the ID given to a job by the cluster, from a SAGA job ID such as "[slurm://localhost]-[1234]"."""
+    match = re.match(r"^\[.*\]-\[(.*)\]$", str(saga_job_id))
+    return match.group(1) if match else str(saga_job_id)
+
+
+def _nmpi_job_id(job_name):
+    """Return the ID of the NMPI job from the name of a cluster job, or None for other jobs."""
+    if job_name and job_name.startswith(JOB_NAME_PREFIX):
+        try:
+            return int(job_name[len(JOB_NAME_PREFIX):])
+        except ValueError:
+            pass
+    return None
+
+
+def _is_local_slurm(adaptor):
+    url = urlparse(adaptor)
+    return url.scheme == "slurm" and url.hostname in (None, "localhost", "127.0.0.1")
+
+
+def cluster_jobs(service, adaptor):
+    """
+    Return the jobs the runner's user has on the cluster, as a dict mapping
+    their native IDs (see `native_job_id()`) to `ClusterJob` tuples.
+
+    For SLURM on the local host this is a single call to squeue, so it stays
+    cheap with thousands of jobs. For other adaptors each job is looked up
+    through the SAGA job service.
+    """
+    jobs = {}
+    if _is_local_slurm(adaptor):
+        output = subprocess.check_output(["squeue", "--noheader", "--user", getpass.getuser(),
+                                          "--format", "%i|%j|%T|%P"])
+        for line in to_text(output).splitlines():
+            if line.count("|") != 3:
+                continue
+            job_id, name, state, queue = [field.strip() for field in line.split("|")]
+            jobs[job_id] = ClusterJob("[{}]-[{}]".format(adaptor, job_id), _nmpi_job_id(name),
+                                      SLURM_STATES.get(state, saga.job.UNKNOWN), queue or None)
+    else:
+        for saga_job_id in service.list():
+            try:
+                saga_job = service.get_job(saga_job_id)
+                state = saga_job.get_state()
+                description = saga_job.get_description()
+            except Exception as exception:
+                logger.debug("Could not get the state of job {}: {}".format(saga_job_id, repr(exception)))
+                continue
+            jobs[native_job_id(saga_job_id)] = ClusterJob(saga_job_id,
+                                                          _nmpi_job_id(getattr(description, "name", None)),
+                                                          state, description.queue or None)
+    return jobs
+
+
+def find_cluster_job(service, adaptor, job_name):
+    """
+    Return the SAGA job ID of the runner's job called `job_name` on the
+    cluster, or None if there is no such job. For SLURM on the local host
+    this is a single call to squeue.
+    """
+    if _is_local_slurm(adaptor):
+        output = subprocess.check_output(["squeue", "--noheader", "--user", getpass.getuser(),
+                                          "--states", "all", "--name", job_name, "--format", "%i"])
+        job_ids = to_text(output).split()
+        return "[{}]-[{}]".format(adaptor, job_ids[-1]) if job_ids else None
+    for saga_job_id in service.list():
+        try:
+            description = service.get_job(saga_job_id).get_description()
+        except Exception as exception:
+            logger.debug("Could not get the description of job {}: {}".format(saga_job_id, repr(exception)))
+            continue
+        if getattr(description, "name", None) == job_name:
+            return saga_job_id
+    return None
+
+
+def cluster_occupancy(service, adaptor):
+    """
+    Count the jobs of the runner's user on the cluster which are waiting or
+    running, by queue. Returns a dict mapping queue names to (waiting, running) tuples.
+    """
+    occupancy = {}
+    for cluster_job in cluster_jobs(service, adaptor).values():
+        waiting, running = occupancy.get(cluster_job.queue, (0, 0))
+        if cluster_job.state in (saga.job.NEW, saga.job.PENDING):
+            occupancy[cluster_job.queue] = (waiting + 1, running)
+        elif cluster_job.state in (saga.job.RUNNING, saga.job.SUSPENDED):
+            occupancy[cluster_job.queue] = (waiting, running + 1)
+    return occupancy
+
+
+def default_queue(adaptor):
+    """
+    Return the name of the queue which jobs submitted without one go to,
+    for SLURM on the local host (its default partition), otherwise None.
+    """
+    if not _is_local_slurm(adaptor):
+        return None
+    output = subprocess.check_output(["scontrol", "--oneliner", "show", "partition"])
+    for line in to_text(output).splitlines():
+        fields = dict(field.split("=", 1) for field in line.split() if "=" in field)
+        if fields.get("Default") == "YES":
+            return fields.get("PartitionName")
+    return None
+
+
+def cancel_cluster_jobs(service, adaptor, saga_job_ids):
+    """
+    Cancel jobs on the cluster. For SLURM on the local host this is a single
+    call to scancel. Returns an error message, or None.
+    """
+    if not saga_job_ids:
+        return None
+    if _is_local_slurm(adaptor):
+        err = subprocess.call(["scancel"] + [native_job_id(job_id) for job_id in saga_job_ids])
+        return "scancel failed with exit code {}".format(err) if err else None
+    errors = []
+    for saga_job_id in saga_job_ids:
+        try:
+            service.get_job(saga_job_id).cancel()
+        except Exception as exception:
+            errors.append("{}: {}".format(saga_job_id, repr(exception)))
+    return "\n".join(errors) or None
+
+
+def classify_jobs(server_jobs, handled_jobs, cluster, is_ours):
+    """
+    Compare the queue server's view of the jobs with the cluster's.
+
+    `server_jobs` are the jobs the queue server has as running or submitted,
+    `handled_jobs` the IDs of the jobs the runner is currently looking after,
+    `cluster` a dict of `ClusterJob` tuples such as returned by `cluster_jobs()`,
+    and `is_ours(nmpi_job)` tells whether a running job was claimed by this
+    runner. Returns a dict with three lists:
+
+    "orphaned": (nmpi_job, cluster_job) tuples for jobs of ours which are
+        running on the cluster but which the runner has lost track of;
+    "ghost": cluster jobs for NMPI jobs which the queue server no longer
+        has as running or submitted (e.g. reset or killed);
+    "unreported": running jobs of ours which are no longer on the cluster and
+        which the runner has lost track of, so that their end was never reported.
+
+    This takes time linear in the number of jobs.
+    """
+    final_states = (saga.job.DONE, saga.job.FAILED, saga.job.CANCELED)
+    live = dict((cluster_job.nmpi_job_id, cluster_job) for cluster_job in cluster.values()
+                if cluster_job.nmpi_job_id is not None and cluster_job.state not in final_states)
+    active = set(job["id"] for job in server_jobs)
+    result = {"orphaned": [], "ghost": [], "unreported": []}
+    for nmpi_job in server_jobs:
+        if (nmpi_job["status"] != "running" or nmpi_job["id"] in handled_jobs
+                or not is_ours(nmpi_job)):
+            continue
+        if nmpi_job["id"] in live:
+            result["orphaned"].append((nmpi_job, live[nmpi_job["id"]]))
+        else:
+            result["unreported"].append(nmpi_job)
+    for nmpi_job_id, cluster_job in live.items():
+        if nmpi_job_id not in active and nmpi_job_id not in handled_jobs:
+            result["ghost"].append(cluster_job)
+    return result
+
+
+def local_job_service(adaptor, config):
+    """
+    Create a service running jobs as local processes (see nmpi_local),
+    configured by the LOCAL_* settings.
+    """
+    cpus = parse_cpu_list(config['LOCAL_CPUS']) if config.get('LOCAL_CPUS') else None
+    max_jobs = config.get('LOCAL_MAX_JOBS')
+    wall_time = config.get('LOCAL_WALL_TIME')
+    fork_servers = None
+    if config.get('LOCAL_WARM_START'):
+        modules = config.get('LOCAL_WARM_MODULES', DEFAULT_WARM_MODULES).format(
+            system=config.get('DEFAULT_PYNN_BACKEND'))
+        fork_servers = ForkServerPool([name.strip() for name in modules.split(",") if name.strip()])
+    return LocalJobService(adaptor,
+                           max_jobs=int(max_jobs) if max_jobs else None,
+                           cpus=cpus,
+                           cpus_per_job=int(config.get('LOCAL_CPUS_PER_JOB', 1)),
+                           wall_time=float(wall_time) if wall_time else None,
+                           memory_limit=parse_size(config.get('LOCAL_MEMORY_LIMIT')),
+                           fork_servers=fork_servers)
+
+
+# Execution backends other than SAGA, by the scheme of the adaptor URL.
+# Each is a function taking the URL and the runner configuration, and returning
+# an object with the interface of saga.job.Service used by JobRunner.
+JOB_SERVICES = {
+    "process": local_job_service,
 }
 
 
+def make_job_service(adaptor, config):
+    """Create the job service for an adaptor URL (see JOB_SERVICES)."""
+    factory = JOB_SERVICES.get(urlparse(adaptor).scheme)
+    if factory is None:
+        return saga.job.Service(adaptor)
+    return factory(adaptor, config)
+
+
+def default_runner_id():
+    """Identifier of this runner, used when none is configured (RUNNER_ID)."""
+    return "{}@{}".format(getpass.getuser(), socket.gethostname())
+
+
+def lease_expired(nmpi_job, now=None):
+    """
+    Return True if the job carries a lease (see `HardwareClient.lease_duration`)
+    which has not been renewed in time, i.e. the runner holding it has
+    probably died. Jobs without a lease are never considered expired.
+    """
+    lease = (nmpi_job.get("provenance") or {}).get("lease")
+    if not lease:
+        return False
+    if now is None:
+        now = time.time()
+    return now > lease["expires"]
+
+
 def load_config(fullpath):
     """
     NOTE: This should be replaced with a standard config format, such as yaml.
@@ -116,7 +430,7 @@ def load_config(fullpath):
         for line in f:
             # leave out comment as python/bash
             if not line.startswith('#') and len(line) >= 5:
-                (key, val) = line.split('=')
+                (key, val) = line.split('=', 1)
                 conf[key.strip()] = val.strip()
     for key, val in conf.items():
         if val in ("True", "False", "None"):
@@ -125,6 +439,38 @@ def load_config(fullpath):
     return conf
 
 
+def _retry(func, retries=DEFAULT_RETRIES, delay=None):
+    """
+    Call `func` until it succeeds, at most `retries + 1` times,
+    waiting twice as long after each failure. The final exception is re-raised.
+    """
+    if delay is None:
+        delay = RETRY_DELAY
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except Exception as exception:
+            if attempt == retries:
+                raise
+            logger.debug("Attempt {} failed, retrying: {}".format(attempt + 1, repr(exception)))
+            time.sleep(delay * 2**attempt)
+
+
+def _concurrent_map(func, items, threads):
+    """Apply `func` to each of `items`, using up to `threads` threads, and return the results in order."""
+    if not items:
+        return []
+    threads = max(1, min(threads, len(items)))
+    if threads == 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
 class NMPAuth(AuthBase):
     """Attaches ApiKey Authentication to the given Request object."""
 
@@ -156,8 +502,9 @@ class HardwareClient(nmpi.Client):
 
     def __init__(self, username, platform, token,
                  job_service="https://nmpi.hbpneuromorphic.eu/api/v2/",
-                 verify=True):
+                 verify=True, quotas_service=DEFAULT_QUOTAS_SERVICE):
         self.username = username
+        self.quotas_server = quotas_service
         self.cert = None
         self.verify = verify
         self.token = token
@@ -183,23 +530,225 @@ class HardwareClient(nmpi.Client):
             job_nmpi = None
         return job_nmpi
 
+    update_queue = None
+    # If `lease_duration` is set, every update of a running job records in its
+    # provenance a lease held by `runner_id` and expiring `lease_duration`
+    # seconds later, which the runner renews periodically (`renew_lease()`).
+    runner_id = None
+    lease_duration = None
+    # If `claim_jobs` is set, jobs are taken from the queue with `claim_job()`,
+    # and stay "running" on the server until they end, even while they wait
+    # in the cluster queue, so that no other runner takes them.
+    claim_jobs = False
+
+    def claim_job(self, job):
+        """
+        Take a submitted job for this runner, as a conditional update: the job
+        is set to "running", with a claim by `runner_id` in its provenance,
+        only if it has not changed since it was read (HTTP If-Match with the
+        ETag the server gave for the job). Returns the claimed job, or None if
+        another runner took it first.
+
+        If the server gives no ETag for the job, it cannot be claimed safely,
+        so it is not claimed at all and None is returned.
+        """
+        current, etag = self._get_versioned(job["resource_uri"])
+        if current.get("status") != "submitted":
+            return None
+        if not etag:
+            logger.error("The server gave no ETag for {}, so it cannot be claimed without the risk of "
+                         "another runner running it too: not claiming it".format(job["resource_uri"]))
+            return None
+        provenance = dict(current.get("provenance") or {},
+                          claim={"runner": self.runner_id, "time": time.time()})
+        claimed = dict(current, status="running", provenance=provenance)
+        if not self._put_if_match(job["resource_uri"], self._stamp_lease(claimed), etag):
+            return None
+        return claimed
+
+    def _get_versioned(self, resource_uri):
+        """Return a resource and its ETag (None if the server gives none)."""
+        req = requests.get(self.job_server + resource_uri, auth=self.auth,
+                           cert=self.cert, verify=self.verify)
+        if not req.ok:
+            self._handle_error(req)
+        return req.json(), req.headers.get("ETag")
+
+    def _put_if_match(self, resource_uri, data, etag):
+        """
+        Update a resource if its ETag is still `etag`. Returns False if it has
+        changed in the meantime.
+        """
+        headers = {"content-type": "application/json", "If-Match": etag}
+        req = requests.put(self.job_server + resource_uri, data=json.dumps(data), auth=self.auth,
+                           cert=self.cert, verify=self.verify, headers=headers)
+        if req.status_code in (409, 412):
+            return False
+        if not req.ok:
+            self._handle_error(req)
+        return True
+
     def update_job(self, job):
-        log = job.pop("log", None)
-        response = self._put(self.job_server + job["resource_uri"], job)
+        log = self._take_pending_log(job["id"], job.pop("log", None))
+        response = self._send_job_update(job, log)
+        if self.update_queue is not None:
+            self.update_queue._notify_sent(job["id"])
+        return response
+
+    def update_job_later(self, job):
+        """
+        Update the job in the background, if a `StatusUpdateQueue` has been
+        attached to this client as `update_queue`, otherwise immediately.
+        """
+        if self.update_queue is None:
+            return self.update_job(job)
+        self.update_queue.put(job)
+        return job
+
+    def _take_pending_log(self, job_id, log):
+        """
+        Remove any queued update for the job, which is about to be
+        superseded, and return its log followed by `log`.
+        """
+        if self.update_queue is None:
+            return log
+        pending_log = self.update_queue.take(job_id)
+        if pending_log:
+            return pending_log + (log or "")
+        return log
+
+    def _stamp_lease(self, job):
+        """
+        Return the job to send to the server: for a running job, if leases are
+        enabled, a copy with a fresh lease; for a job in any other state, a
+        copy without a lease. Claimed jobs pending on the cluster are sent as
+        running (see `claim_jobs`).
+        """
+        if self.claim_jobs and job["status"] == "submitted":
+            # the job is pending on the cluster, but must not go back in the queue
+            job = dict(job, status="running")
+        provenance = job.get("provenance") or {}
+        if job["status"] == "running" and self.lease_duration is not None:
+            provenance = dict(provenance, lease={"runner": self.runner_id,
+                                                 "expires": time.time() + self.lease_duration})
+        elif "lease" in provenance:
+            provenance = dict(provenance)
+            del provenance["lease"]
+        else:
+            return job
+        return dict(job, provenance=provenance)
+
+    def renew_lease(self, job):
+        """Extend the lease on a running job, by updating it."""
+        return self.update_job_later(job)
+
+    def requeue_expired_jobs(self, exclude=()):
+        """
+        Put running jobs whose lease has expired back in the queue, so that
+        jobs held by a runner which has died are run again. Jobs without a
+        lease, and jobs whose ID is in `exclude`, are left alone.
+        Returns the list of jobs which were requeued.
+        """
+        requeued = []
+        now = time.time()
+        for job in self.running_jobs(verbose=True):
+            if job["id"] in exclude or not lease_expired(job, now):
+                continue
+            logger.warning("Lease of job {} held by {} has expired, putting it back in the queue".format(
+                job["id"], job["provenance"]["lease"]["runner"]))
+            self.reset_job(job)
+            requeued.append(job)
+        return requeued
+
+    def _send_job_update(self, job, log):
+        response = self._put(self.job_server + job["resource_uri"], self._stamp_lease(job))
         if log:
             log_response = self._put(self.job_server + "/api/v2/log/{}".format(job["id"]),
                                      {"content": log})
         return response
 
+    def append_log(self, job_id, content):
+        """
+        Append `content` to the log of the job with ID `job_id`,
+        without updating the job itself.
+        """
+        return self._put(self.job_server + "/api/v2/log/{}".format(job_id),
+                         {"content": content})
+
+    def create_data_items(self, urls, threads=DEFAULT_REGISTRATION_THREADS, retries=DEFAULT_RETRIES,
+                          checksums=None):
+        """
+        Register several data items with the platform, with their checksums
+        if given as a dict mapping urls to checksums.
+
+        The job queue API has no batch endpoint for data items, so the items
+        are POSTed concurrently, with up to `threads` requests in flight,
+        and each request is retried up to `retries` times. As a POST which
+        failed may still have created the item (if the response was lost),
+        the item is looked for (see `find_data_item()`) before it is POSTed
+        again.
+
+        Returns a list with one (url, resource_uri, error) tuple for each url,
+        in the same order as `urls`. For each item either `resource_uri` or
+        `error` is None.
+        """
+        checksums = checksums or {}
+
+        def _create(url):
+            posted = []
+
+            def attempt():
+                if posted:
+                    resource_uri = self.find_data_item(url)
+                    if resource_uri is not None:
+                        return resource_uri
+                posted.append(url)
+                return self.create_data_item(url, checksum=checksums.get(url))
+
+            try:
+                return url, _retry(attempt, retries), None
+            except Exception as exception:
+                return url, None, repr(exception)
+
+        return _concurrent_map(_create, urls, threads)
+
+    def find_data_item(self, url):
+        """
+        Return the resource URI of the data item registered for `url`,
+        or None if there is none.
+        """
+        items = self._query_all(self.job_server + self.resource_map["dataitem"] + "?" + urlencode({"url": url}),
+                                verbose=True)
+        for item in items:
+            if item["url"] == url:
+                return item["resource_uri"]
+        return None
+
+    def reset_jobs(self, jobs, threads=DEFAULT_RECONCILE_THREADS, retries=DEFAULT_RETRIES):
+        """
+        Reset several jobs (see `reset_job()`), with up to `threads` requests
+        in flight. Returns a list with one (job, error) tuple for each job,
+        where error is None if the job was reset.
+        """
+        def _reset(job):
+            try:
+                _retry(lambda: self.reset_job(job), retries)
+                return job, None
+            except Exception as exception:
+                return job, repr(exception)
+
+        return _concurrent_map(_reset, jobs, threads)
+
     def reset_job(self, job):
         """
         If a job is stuck in the "running" state due to a problem on the backend,
         reset its status to "submitted".
         """
         job["status"] = "submitted"
+        log = self._take_pending_log(job["id"], "reset status to 'submitted'\n")
         log_response = self._put(self.job_server + "/api/v2/log/{}".format(job["id"]),
-                                 {"content": "reset status to 'submitted'\n"})
-        return self._put(self.job_server + job["resource_uri"], job)
+                                 {"content": log})
+        return self._put(self.job_server + job["resource_uri"], self._stamp_lease(job))
 
     def kill_job(self, job, error_message=""):
         """
@@ -211,8 +760,8 @@ class HardwareClient(nmpi.Client):
         if job["status"] not in ("running", "submitted"):
             raise Exception("You cannot kill a job with status {}".format(job["status"]))
         job["status"] = "error"
-        log = job.pop("log", "")
-        response = self._put(self.job_server + job["resource_uri"], job)
+        log = self._take_pending_log(job["id"], job.pop("log", "")) or ""
+        response = self._put(self.job_server + job["resource_uri"], self._stamp_lease(job))
         log += "Internal error. Please resubmit the job\n"
         log += error_message
         log_response = self._put(self.job_server + "/api/v2/log/{}".format(job["id"]),
@@ -229,8 +778,21 @@ class HardwareClient(nmpi.Client):
         verbose : if False, return just the job URIs,
                   if True, return full details.
         """
-        return self._query(self.job_server + self.resource_map["queue"] + "/submitted/?hardware_platform=" + str(self.platform),
-                           verbose=verbose)
+        return self._query_all(self.job_server + self.resource_map["queue"] + "/submitted/?hardware_platform=" + str(self.platform),
+                               verbose=verbose)
+
+    def remaining_quota(self, collab_id):
+        """
+        Return the compute time a collab has left on this platform, summed
+        over the quotas of its accepted resource requests.
+        """
+        remaining = 0.0
+        for request in self._query(self.quotas_server + "/projects/?" +
+                                   urlencode({"collab": collab_id, "status": "accepted"}), verbose=True):
+            for quota in self._query(self.quotas_server + request["resource_uri"] + "/quotas/", verbose=True):
+                if quota.get("platform") == self.platform:
+                    remaining += max(float(quota["limit"]) - float(quota["usage"]), 0.0)
+        return remaining
 
     def running_jobs(self, verbose=False):
         """
@@ -242,14 +804,376 @@ class HardwareClient(nmpi.Client):
         verbose : if False, return just the job URIs,
                   if True, return full details.
         """
-        return self._query(self.job_server + self.resource_map["queue"] + "/running/?hardware_platform=" + str(self.platform),
-                           verbose=verbose)
+        return self._query_all(self.job_server + self.resource_map["queue"] + "/running/?hardware_platform=" + str(self.platform),
+                               verbose=verbose)
+
+    def _query_all(self, resource_uri, verbose=False):
+        """
+        Retrieve a list of resources, following the pages of the list
+        (`meta.next`) so that all of them are returned, not just the first page.
+        """
+        objects = []
+        while resource_uri:
+            page = self._get(resource_uri)
+            objects.extend(page["objects"])
+            next_page = (page.get("meta") or {}).get("next")
+            resource_uri = urljoin(resource_uri, next_page) if next_page else None
+        if verbose:
+            return objects
+        return [obj["resource_uri"] for obj in objects]
+
+    def _get(self, resource_uri):
+        req = requests.get(resource_uri, auth=self.auth, cert=self.cert, verify=self.verify)
+        if not req.ok:
+            self._handle_error(req)
+        return req.json()
+
+
+class StatusUpdateQueue(object):
+    """
+    Write-behind queue for job updates, so that updating the job queue
+    server does not hold up the runner.
+
+    Updates are sent by a background thread, in the order in which the jobs
+    were first queued, and retried if they fail. An update is only sent once
+    it has waited `delay` seconds, and further updates of the same job
+    received in the meantime are merged into it: the latest version of the
+    job is sent, with the logs of all the updates appended together.
+
+    An update which still fails after `retries` retries is not dropped, as
+    the job would then be left claimed, or running, on the server: it is
+    queued again, with its log, and tried again after a delay which doubles
+    each time, up to MAX_UPDATE_RETRY_DELAY. Only updates still failing
+    when the queue is closed are given up.
+
+    Attach the queue to a `HardwareClient` and use `update_job_later()`.
+    A synchronous `update_job()` takes over any queued update of the same
+    job, so the two can be mixed freely. Use `when_sent()` to act once the
+    updates of a job have reached the server.
+    """
+
+    def __init__(self, client, delay=UPDATE_QUEUE_DELAY, retries=DEFAULT_RETRIES, retry_delay=RETRY_DELAY):
+        self.client = client
+        self.delay = delay
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._pending = OrderedDict()  # job id -> (time due, job, log, failures)
+        self._in_flight = None
+        self._on_sent = {}  # job id -> callbacks waiting for its updates to be sent
+        self._flushing = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="StatusUpdateQueue")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, job):
+        """
+        Queue an update of `job`. As with `HardwareClient.update_job()`,
+        the log is removed from the job.
+        """
+        log = job.pop("log", None) or ""
+        job = copy.deepcopy(job)
+        with self._condition:
+            if self._closed:
+                raise Exception("Status update queue has been closed")
+            if job["id"] in self._pending:
+                due, _, pending_log, failures = self._pending[job["id"]]
+                # assigning to an existing key keeps its place in the queue
+                self._pending[job["id"]] = (due, job, pending_log + log, failures)
+            else:
+                self._pending[job["id"]] = (time.time() + self.delay, job, log, 0)
+            self._condition.notify_all()
+
+    def take(self, job_id):
+        """
+        Remove the queued update of a job, if any, returning its log.
+        If the job is being sent at the moment, wait until that is done.
+        """
+        with self._condition:
+            while self._in_flight == job_id:
+                self._condition.wait()
+            entry = self._pending.pop(job_id, None)
+            self._condition.notify_all()
+        return entry[2] if entry else None
+
+    def when_sent(self, job_id, callback):
+        """
+        Call `callback()` once no update of the job is waiting to be sent:
+        at once if there is none, otherwise from the background thread when
+        the last one has been sent. If sending fails the callback waits for
+        the update to be sent when it is retried.
+        """
+        with self._condition:
+            if job_id in self._pending or self._in_flight == job_id:
+                self._on_sent.setdefault(job_id, []).append(callback)
+                return
+        callback()
+
+    def _notify_sent(self, job_id):
+        """Call the callbacks waiting for the updates of the job, unless another one is queued."""
+        with self._condition:
+            if job_id in self._pending or self._in_flight == job_id:
+                return
+            callbacks = self._on_sent.pop(job_id, [])
+        self._call_back(job_id, callbacks)
+
+    def _call_back(self, job_id, callbacks):
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as exception:
+                logger.error("Error after updating job {}: {}".format(job_id, repr(exception)))
+
+    def flush(self):
+        """
+        Send all queued updates now, and wait until they have been sent or
+        have failed again. Updates which have failed before are tried once.
+        """
+        with self._condition:
+            start = time.time()
+            for job_id, (due, job, log, failures) in list(self._pending.items()):
+                self._pending[job_id] = (min(due, start), job, log, failures)
+            self._flushing = True
+            self._condition.notify_all()
+            while self._in_flight is not None or any(due <= start or not failures
+                                                     for due, _, _, failures in self._pending.values()):
+                self._condition.wait()
+            self._flushing = False
+
+    def close(self):
+        """Send all queued updates and stop the background thread."""
+        self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        for job_id in self._pending:
+            logger.error("Giving up updating job {}".format(job_id))
+
+    def __len__(self):
+        with self._condition:
+            return len(self._pending)
+
+    def _due(self, entry):
+        """When the update `entry` is to be sent: at once when flushing, unless it has failed."""
+        due, _, _, failures = entry
+        if (self._flushing or self._closed) and not failures:
+            return 0
+        return due
+
+    def _next_update(self):
+        """
+        Wait for the next update that is due. Returns None when closed and
+        only updates which have failed are left.
+        """
+        with self._condition:
+            while True:
+                if self._pending:
+                    job_id, entry = min(self._pending.items(), key=lambda item: self._due(item[1]))
+                    wait = self._due(entry) - time.time()
+                    if wait <= 0:
+                        del self._pending[job_id]
+                        self._in_flight = job_id
+                        _, job, log, failures = entry
+                        return job, log, failures
+                    if self._closed:
+                        return None
+                    self._condition.wait(wait)
+                elif self._closed:
+                    return None
+                else:
+                    self._condition.wait()
+
+    def _requeue(self, job, log, failures):
+        """Queue a failed update again, before any later update of the same job."""
+        retry_delay = min(self.retry_delay * 2**failures, MAX_UPDATE_RETRY_DELAY)
+        with self._condition:
+            if job["id"] in self._pending:
+                _, job, pending_log, _ = self._pending.pop(job["id"])
+                log += pending_log
+            self._pending[job["id"]] = (time.time() + retry_delay, job, log, failures + 1)
+
+    def _run(self):
+        while True:
+            update = self._next_update()
+            if update is None:
+                return
+            job, log, failures = update
+            try:
+                _retry(lambda: self.client._send_job_update(job, log), self.retries)
+                sent = True
+            except Exception as exception:
+                logger.error("Failed to update job {}, will try again: {}".format(job["id"], repr(exception)))
+                sent = False
+            try:
+                if sent:
+                    with self._condition:
+                        callbacks = []
+                        if job["id"] not in self._pending:
+                            callbacks = self._on_sent.pop(job["id"], [])
+                    # before the update stops being in flight, so that flush() waits for the callbacks
+                    self._call_back(job["id"], callbacks)
+                else:
+                    self._requeue(job, log, failures)
+            finally:
+                with self._condition:
+                    self._in_flight = None
+                    self._condition.notify_all()
+
+
+class LogFollower(object):
+    """
+    Sends the output of running jobs to the job log while they run, so that
+    users can follow their progress.
+
+    A background thread checks the SAGA stdout and stderr files of the
+    followed jobs every `interval` seconds, and appends what has been written
+    since the last check to the job log. At most `chunk_size` bytes per file
+    are sent each time (the most recent ones), and at most `max_length` bytes
+    per file in total; the complete, truncated output is still added to the
+    log when the job finishes.
+    """
+
+    def __init__(self, client, interval, chunk_size=LOG_CHUNK_SIZE, max_length=MAX_LOG_SIZE):
+        self.client = client
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.max_length = max_length
+        self._jobs = {}
+        self._sending = None  # ID of the job whose output is being sent
+        self._lock = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="LogFollower")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def follow(self, nmpi_job, saga_job):
+        job_desc = job_description(saga_job)
+        files = [path.join(job_desc.working_directory, job_desc.output),
+                 path.join(job_desc.working_directory, job_desc.error)]
+        with self._lock:
+            # for each file: [offset, bytes sent so far]
+            self._jobs[nmpi_job['id']] = dict((file_path, [0, 0]) for file_path in files)
+
+    def unfollow(self, nmpi_job):
+        """
+        Stop following a job. Once this returns, nothing more will be
+        appended to the job log by the follower.
+        """
+        with self._lock:
+            self._jobs.pop(nmpi_job['id'], None)
+            while self._sending == nmpi_job['id']:
+                self._lock.wait()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def poll(self):
+        """
+        Send any new output for all the followed jobs. The output is read
+        with the lock held, but sent without it, so that following and
+        unfollowing jobs do not wait for the queue server.
+        """
+        chunks = []
+        with self._lock:
+            for job_id, files in self._jobs.items():
+                content = ""
+                for file_path, position in files.items():
+                    content += self._read_new_output(file_path, position)
+                if content:
+                    chunks.append((job_id, content))
+        for job_id, content in chunks:
+            with self._lock:
+                if job_id not in self._jobs:  # unfollowed in the meantime
+                    continue
+                self._sending = job_id
+            try:
+                self.client.append_log(job_id, content)
+            except Exception as exception:
+                logger.warning("Failed to update the log of job {}: {}".format(job_id, repr(exception)))
+            finally:
+                with self._lock:
+                    self._sending = None
+                    self._lock.notify_all()
+
+    def _read_new_output(self, file_path, position):
+        offset, sent = position
+        if sent >= self.max_length:
+            return ""
+        try:
+            size = path.getsize(file_path)
+        except OSError:
+            return ""
+        if size <= offset:
+            return ""
+        count = min(size - offset, self.chunk_size, self.max_length - sent)
+        with open(file_path, "rb") as fp:
+            fp.seek(size - count)
+            content = to_text(fp.read(count))
+        if size - offset > count:
+            content = "\n... {} bytes skipped ...\n".format(size - offset - count) + content
+        position[:] = [size, sent + count]
+        if position[1] >= self.max_length:
+            content += "\n... further output will be shown when the job has finished ...\n"
+        return content
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as exception:
+                logger.error("Error while following job logs: {}".format(repr(exception)))
+
+
+def pynn_version(nmpi_job):
+    """Return the PyNN version a job asks for."""
+    return (nmpi_job.get('hardware_config') or {}).get("pyNN_version", DEFAULT_PYNN_VERSION)
+
+
+def job_description(saga_job):
+    """
+    Return the description of a SAGA job.
+
+    Jobs reattached after a restart of the runner do not carry their full
+    description, so JobRunner attaches the one it built as `nmpi_description`.
+    """
+    return getattr(saga_job, "nmpi_description", None) or saga_job.get_description()
+
+
+class CachedResultJob(object):
+    """
+    Stands in for the SAGA job of a job whose results were taken from the
+    result cache (see `JobRunner._reuse_result()`). It is running until it
+    is waited on, and then done.
+    """
+
+    def __init__(self, result_key, description):
+        self.id = "cached-" + result_key[:16]
+        self.result_key = result_key
+        self.nmpi_description = description
+        self._state = saga.job.RUNNING
+
+    def get_description(self):
+        return self.nmpi_description
+
+    def get_state(self):
+        return self._state
+
+    def wait(self, timeout=None):
+        self._state = saga.job.DONE
+        return self._state
+
+    def cancel(self):
+        self._state = saga.job.CANCELED
 
 
 # adapted from Sumatra
 def _find_new_data_files(root, timestamp,
                          ignoredirs=[".smt", ".hg", ".svn", ".git", ".bzr"],
-                         ignore_extensions=[".pyc"]):
+                         ignore_extensions=[".pyc"],
+                         ignore_files=()):
     """Finds newly created/changed files in root.
 
     NOTE: This is a potentially pretty expensive operation.
@@ -264,83 +1188,139 @@ def _find_new_data_files(root, timestamp,
             if path.splitext(file)[1] not in ignore_extensions:
                 full_path = path.join(root, file)
                 relative_path = path.join(root[length_root:], file)
+                if relative_path in ignore_files:
+                    continue
                 last_modified = os.stat(full_path).st_mtime
                 if last_modified >= timestamp:
                     new_files.append(relative_path)
     return new_files
 
-def read_output(saga_job):
+
+def _list_output_files(root):
+    """
+    Return the paths, relative to root, of all files below root.
+
+    Used when the job has a dedicated output directory, in which case
+    everything in it is output and no timestamps need to be compared.
+    """
+    length_root = len(root) + len(path.sep)
+    output_files = []
+    for dirpath, dirs, files in os.walk(root):
+        for file in files:
+            output_files.append(path.join(dirpath[length_root:], file))
+    return output_files
+
+def read_output(saga_job, max_length=MAX_LOG_SIZE):
     """
     Read and return the contents of the stdout and stderr files
     created by the SAGA job.
+
+    Files longer than `max_length` are truncated as by `truncate_string()`,
+    reading only the beginning and end of the file.
     """
-    job_desc = saga_job.get_description()
+    job_desc = job_description(saga_job)
     outfile= path.join(job_desc.working_directory, job_desc.output)
     errfile = path.join(job_desc.working_directory, job_desc.error)
     try:
-        with open(outfile) as fp:
-            stdout = fp.read()
-        with open(errfile) as fp:
-            stderr = fp.read()
+        stdout = read_head_tail(outfile, max_length)
+        stderr = read_head_tail(errfile, max_length)
         return stdout, stderr
     except IOError:
         # weird things can happen...
         return "", ""
 
+
+def archive_logs(hardware_client, data_server, data_directory, working_directory,
+                 log_files, max_length=MAX_LOG_SIZE):
+    """
+    The job log only contains the beginning and end of long stdout and
+    stderr files. So that nothing is lost, store compressed copies of such
+    files in the data directory and register them as data items.
+
+    Returns a tuple containing a list of the resource URIs of the new data
+    items and an error message or None.
+    """
+    job_dir = path.basename(working_directory)
+    output_dir = path.join(data_directory, job_dir)
+    compressed_files = []
+    try:
+        for log_file in log_files:
+            if path.exists(log_file) and path.getsize(log_file) > max_length:
+                create_working_directory(output_dir)
+                compressed_file = path.basename(log_file) + ".gz"
+                compress_file(log_file, path.join(output_dir, compressed_file))
+                compressed_files.append(compressed_file)
+    except Exception as exception:
+        return [], "Failed to compress log files: {}".format(repr(exception))
+    urls = ["{}/{}/{}".format(data_server, job_dir, name) for name in compressed_files]
+    resource_uris = []
+    errors = []
+    for url, resource_uri, err in hardware_client.create_data_items(urls):
+        if err:
+            errors.append("Failed to create data item remotely at {}: {}".format(url, err))
+        else:
+            resource_uris.append(resource_uri)
+    return resource_uris, "\n".join(errors) or None
+
+
 def create_working_directory(workdir):
     if not path.exists(workdir):
         os.makedirs(workdir)
     else:
         logger.debug("Directory %s already exists" % workdir)
 
-def get_code(working_directory, nmpi_job, script_name = "run.py"):
+def get_code(working_directory, nmpi_job, script_name = "run.py", git_cache=None,
+             archive_cache=None):
     """
     Obtain the code and place it in the working directory.
-    If the experiment description is the URL of a Git repository, try to clone it.
+    If the experiment description is the http(s) or ssh URL of a Git
+    repository, clone it into the working directory, which must be empty.
     If it is the URL of a zip or .tar.gz archive, download and unpack it.
     Otherwise, the content of "code" is the code: write it to a file.
+
+    If a `GitMirrorCache` is given, repositories are cloned from a local
+    mirror, which is only updated incrementally. Archives are extracted as
+    they are downloaded; if an `ArchiveCache` is given, they are only
+    downloaded again when they have changed.
     """
     # NOTE: The code is potentially in unicode, but 
     # urlparse can only handle ascii, so we violently convert the string
     # to ascii here.
     url_candidate = urlparse(str(nmpi_job['code']))
-    if url_candidate.scheme and url_candidate.path.endswith((".tar.gz", ".zip", ".tgz")):
+    if url_candidate.scheme and url_candidate.path.endswith(ARCHIVE_EXTENSIONS):
         # NOTE: This assumes that the input is more or less valid, just as the rest
         # of the code.
         url = nmpi_job['code']
         logger.info("Retrieving code from url: {}".format(url))
         create_working_directory(working_directory)
-        target = os.path.join(working_directory, os.path.basename(url_candidate.path))
-        err = subprocess.call(["curl", url, "-o", target])
-        if err:
-            msg = "Unable to retrieve code from url: {}".format(url)
+        try:
+            if archive_cache is not None:
+                archive_cache.fetch(url, working_directory)
+            else:
+                fetch_archive(url, working_directory)
+        except (tarfile.TarError, zipfile.BadZipfile, ValueError) as exception:
+            msg = "Unable to extract archive from {}, malformed archive? {}".format(url, exception)
             logger.info(msg)
             return msg
-        logger.info("Retrieved file from {} to local target {}".format(url, target))
-        logger.info("Extracting file {}".format(target))
-        if url_candidate.path.endswith((".tar.gz", ".tgz")):
-            err = subprocess.call(["tar", "xfz", target, "--directory", working_directory])
-            if err:
-                msg = "Unable extract tar file, malformed archive?"
-                logger.info(msg)
-                return msg
-            return None
-        if url_candidate.path.endswith(".zip"):
-            err = subprocess.call(["unzip", "-o", target, "-d", working_directory])
-            if err:
-                msg = "Unable expand zip file, malformed archive?"
-                logger.info(msg)
-                return msg
-            return None
-        
-        assert False, "unreachable"
+        except Exception as exception:
+            msg = "Unable to retrieve code from url {}: {}".format(url, repr(exception))
+            logger.info(msg)
+            return msg
+        logger.info("Extracted archive from {} into {}".format(url, working_directory))
+        return None
     if url_candidate.scheme in ["http", "https", "ssh"]:
         # This could be a git repository (we don't know yet and don't handle the case of local repositories)
         url = nmpi_job['code']
-        err = subprocess.call(["git","clone","--recursive",url, working_directory])
-        if not err:
-            logger.info("Cloned repository {}".format(url))
-            return None
+        if git_cache is not None:
+            err = git_cache.clone(url, working_directory)
+        else:
+            err = subprocess.call(["git","clone","--recursive",url, working_directory])
+        if err:
+            msg = "Unable to clone repository {}: exit status {}".format(url, err)
+            logger.info(msg)
+            return msg
+        logger.info("Cloned repository {}".format(url))
+        return None
     logger.info("The code field appears to contain a script.")
     try:
         create_working_directory(working_directory)
@@ -350,74 +1330,156 @@ def get_code(working_directory, nmpi_job, script_name = "run.py"):
         return "Exception occured while writing script: {}".format(repr(exception))
     return None
 
-def get_input_data(hardware_client, nmpi_job, working_directory):
+def get_input_data(hardware_client, nmpi_job, working_directory, input_cache=None,
+                   threads=DEFAULT_DOWNLOAD_THREADS):
     """
     Retrieve eventual additional input DataItem
     We assume that the script knows the input files are in the same folder
+
+    The files are downloaded concurrently, with up to `threads` downloads
+    in flight. If an `InputDataCache` is given, each file is only downloaded
+    once and shared between jobs.
     """
     if 'input_data' in nmpi_job and len(nmpi_job['input_data']):
         try:
-            hardware_client.download_data_url(nmpi_job, working_directory, True)
+            urls = [_data_item_url(hardware_client, item) for item in nmpi_job['input_data']]
         except Exception as exception:
-            return "Exception occurred while downloading input data: {}".format(repr(exception))
+            return "Exception occurred while looking up input data: {}".format(repr(exception))
+        create_working_directory(working_directory)
+
+        def _download(url):
+            target = path.join(working_directory, path.basename(urlparse(url).path))
+            try:
+                if input_cache is not None:
+                    input_cache.fetch(url, target)
+                else:
+                    download_file(url, target)
+            except Exception as exception:
+                return "{}: {}".format(url, repr(exception))
+            return None
+
+        threads = max(1, min(threads, len(urls)))
+        pool = ThreadPool(threads)
+        try:
+            errors = [err for err in pool.map(_download, urls) if err]
+        finally:
+            pool.close()
+            pool.join()
+        if errors:
+            return "Exception occurred while downloading input data: {}".format("\n".join(errors))
     return None
 
-def handle_output_data(hardware_client, 
-                       data_server, 
-                       data_directory, 
-                       working_directory, 
-                       start_time, 
-                       nmpi_job):
+
+def _data_item_url(hardware_client, item):
+    """
+    Return the URL of a data item, which may be given in full or as
+    a resource URI.
+    """
+    if isinstance(item, dict):
+        return item["url"]
+    return hardware_client._query(hardware_client.job_server + item)["url"]
+
+
+def handle_output_data(hardware_client,
+                       data_server,
+                       data_directory,
+                       working_directory,
+                       start_time,
+                       nmpi_job,
+                       output_directory=None,
+                       copy_threads=DEFAULT_COPY_THREADS,
+                       use_hardlinks=True,
+                       registration_threads=DEFAULT_REGISTRATION_THREADS,
+                       ignore_files=(),
+                       checksums=True):
     """
     Adds the contents of the nmpi_job folder to the list of nmpi_job
     output data
 
-    NOTE: This is potentially a pretty fragile implementation. It would
-    be easier to separate the output directory from the directory in which
-    the code was cloned or alternatively to keep a list of files and directories
-    around that have been present before the code executed.
-    """
+    If `output_directory` is given, the job wrote its results into a
+    dedicated directory and only the contents of that directory are
+    harvested. Otherwise we fall back to scanning the whole working directory
+    for files modified since `start_time`, other than those in `ignore_files`.
 
-    new_files = _find_new_data_files(working_directory, start_time)
+    NOTE: The fallback is potentially a pretty fragile implementation, since
+    code, input data and results share the same directory.
+
+    Files are copied to the data directory by `copy_files()`, using up to
+    `copy_threads` threads and hard links where possible. Files which could
+    not be copied are not registered, and are listed in the returned error
+    message once all the other files have been handled.
+
+    If `checksums` is true, the checksum of each file is computed as it
+    is copied (or, if it is already in the data directory, read by the
+    same pool of threads), and is registered with its data item and
+    recorded in the provenance of the job, by URL.
+
+    The data items are registered with up to `registration_threads`
+    concurrent requests, and the job is then updated once with the
+    complete list.
+    """
+    if output_directory:
+        source_dir = output_directory
+        new_files = _list_output_files(output_directory)
+    else:
+        source_dir = working_directory
+        new_files = _find_new_data_files(working_directory, start_time,
+                                         ignore_files=ignore_files)
     output_dir = path.join(data_directory, path.basename(working_directory))
-    
-    logger.info("Copying files to {}: {}".format(output_dir, ", ".join(new_files)))
 
-    if data_directory != working_directory:
-        for new_file in new_files:
-            try:
-                new_file_path = path.join(output_dir, new_file)
-                if not os.path.exists(os.path.dirname(new_file_path)):
-                    os.makedirs(os.path.dirname(new_file_path))
-                shutil.copyfile(path.join(job_desc.working_directory, new_file),
-                                new_file_path)
-            except Exception as exception:
-                msg = "Failed to copy files : {}".format(repr(exception))
-                logger.info(msg)
-                return msg
+    failures = []
+    file_checksums = {}
+    if path.abspath(source_dir) != path.abspath(output_dir):
+        logger.info("Copying files to {}: {}".format(output_dir, ", ".join(new_files)))
+        failures = copy_files(source_dir, output_dir, new_files,
+                              threads=copy_threads, use_hardlinks=use_hardlinks,
+                              checksums=file_checksums if checksums else None)
+        failed_files = set(new_file for new_file, _ in failures)
+        new_files = [new_file for new_file in new_files if new_file not in failed_files]
+    elif checksums:
+        # files which cannot be read are still registered, without a checksum
+        file_checksums, _ = checksum_files(output_dir, new_files, threads=copy_threads)
 
     # append the new output to the list of item data and retrieve it
     # by POSTing to the DataItem list resource
     logger.info("Posting data items")
-    for new_file in new_files:
-        url = "{}/{}/{}".format(data_server, os.path.basename(working_directory), new_file)
-        try:
-            resource_uri = hardware_client.create_data_item(url)
+    urls = ["{}/{}/{}".format(data_server, os.path.basename(working_directory), new_file)
+            for new_file in new_files]
+    url_checksums = dict((url, file_checksums[new_file]) for url, new_file in zip(urls, new_files)
+                         if new_file in file_checksums)
+    if url_checksums:
+        provenance = dict(nmpi_job.get('provenance') or {})
+        provenance["output_checksums"] = dict(provenance.get("output_checksums") or {})
+        provenance["output_checksums"].update(url_checksums)
+        nmpi_job['provenance'] = provenance
+    registration_failures = []
+    for url, resource_uri, err in hardware_client.create_data_items(urls, threads=registration_threads,
+                                                                    checksums=url_checksums):
+        if err:
+            registration_failures.append((url, err))
+        else:
             nmpi_job['output_data'].append(resource_uri)
-        except Exception as exception:
-            msg = "Failed to create data item remotely at {}: {}".format(url, repr(exception))
-            logger.info(msg)
-            return msg
 
     # ... and PUTting to the job resource
-    try: 
+    try:
         hardware_client.update_job(nmpi_job)
     except Exception as exception:
         msg = "Failed to update the job reflecting the produced output data: {}".format(repr(exception))
         logger.info(msg)
         return msg
-    return None
 
+    errors = []
+    if failures:
+        errors.append("Failed to copy {} output file(s):".format(len(failures)))
+        errors.extend("{}: {}".format(new_file, err) for new_file, err in failures)
+    if registration_failures:
+        errors.append("Failed to create {} data item(s) remotely:".format(len(registration_failures)))
+        errors.extend("{}: {}".format(url, err) for url, err in registration_failures)
+    if errors:
+        msg = "\n".join(errors)
+        logger.info(msg)
+        return msg
+    return None
 
 
 class JobRunner(object):
@@ -429,145 +1491,1078 @@ class JobRunner(object):
 
     def __init__(self, config):
         self.config = config
-        self.service = saga.job.Service(config['JOB_SERVICE_ADAPTOR'])
+        # before anything which would need closing, as JournalLocked means another runner is active
+        if config.get('JOURNAL_FILE'):
+            self.journal = RunnerJournal(config['JOURNAL_FILE'])
+        else:
+            self.journal = None
+        self.service = make_job_service(config['JOB_SERVICE_ADAPTOR'], config)
+        self.services = {config['JOB_SERVICE_ADAPTOR']: self.service}
+        self.scheduler = scheduler_from_config(config)
+        self.claimed_jobs = set()
         self.client = HardwareClient(username=config['AUTH_USER'],
                                      token=config['AUTH_TOKEN'],
                                      job_service=config['NMPI_HOST'] + config['NMPI_API'],
                                      platform=config['PLATFORM_NAME'],
-                                     verify=config['VERIFY_SSL'])
+                                     verify=config['VERIFY_SSL'],
+                                     quotas_service=config.get('QUOTAS_SERVICE', DEFAULT_QUOTAS_SERVICE))
+        if config.get('GIT_CACHE_DIRECTORY'):
+            self.git_cache = GitMirrorCache(config['GIT_CACHE_DIRECTORY'],
+                                            max_size=config.get('GIT_CACHE_SIZE'))
+        else:
+            self.git_cache = None
+        if config.get('ARCHIVE_CACHE_DIRECTORY'):
+            self.archive_cache = ArchiveCache(config['ARCHIVE_CACHE_DIRECTORY'],
+                                              max_size=config.get('ARCHIVE_CACHE_SIZE'))
+        else:
+            self.archive_cache = None
+        if config.get('INPUT_CACHE_DIRECTORY'):
+            self.input_cache = InputDataCache(config['INPUT_CACHE_DIRECTORY'],
+                                              max_size=config.get('INPUT_CACHE_SIZE'))
+        else:
+            self.input_cache = None
+        if config.get('RESULT_CACHE_DIRECTORY'):
+            self.result_cache = ResultCache(config['RESULT_CACHE_DIRECTORY'],
+                                            max_size=config.get('RESULT_CACHE_SIZE'))
+        else:
+            self.result_cache = None
+        self.result_cache_rules = parse_rules(config.get('RESULT_CACHE_RULES'))
+        if config.get('LEASE_DURATION'):
+            self.client.runner_id = config.get('RUNNER_ID') or default_runner_id()
+            self.client.lease_duration = float(config['LEASE_DURATION'])
+        if config.get('CLAIM_JOBS'):
+            self.client.runner_id = config.get('RUNNER_ID') or default_runner_id()
+            self.client.claim_jobs = True
+        self.fair_share = self._make_fair_share(config)
+        self.resource_units = platform_units(config.get('PLATFORM_NAME'), config.get('RESOURCE_UNITS'))
+        self.usage_cache = {}  # usage of ended SLURM jobs, by native job ID, see `_account()`
+        self.lease_renewed = {}
+        self.last_lease_check = None
+        self.last_reconciliation = None
+        self.last_cancellation_check = None
+        self.copy_back_pool = None
+        self.copying = []  # (nmpi_job, saga_job, result) for jobs whose output is being copied back
+        self.collector = collector_from_config(config)
+        if self.collector is not None:
+            self.collector.start()
+        if config.get('ASYNC_STATUS_UPDATES'):
+            self.client.update_queue = StatusUpdateQueue(self.client)
+        if config.get('LOG_UPDATE_INTERVAL'):
+            self.log_follower = LogFollower(self.client, float(config['LOG_UPDATE_INTERVAL']))
+        else:
+            self.log_follower = None
 
     def retrieve_pending_jobs(self):
         """
-        Retrieve all pending nmpi jobs and return them in a list.
+        Retrieve pending nmpi jobs and return them in a list.
+
+        No more jobs are claimed than the cluster queues can take (see
+        `admission_limit()`), so that jobs the runner cannot start soon stay
+        on the queue server, where other runners can take them and users can
+        cancel them.
         """
+        limit = self.admission_limit()
+        if self.fair_share is not None:
+            return self._retrieve_fair_share(limit)
         pending_jobs = []
-        while True:
+        lost = set()
+        while limit is None or len(pending_jobs) < limit:
             nmpi_job = self.client.get_next_job()
-            if nmpi_job is None or nmpi_job in pending_jobs:
+            if nmpi_job is None or nmpi_job['id'] in self.claimed_jobs or nmpi_job['id'] in lost:
                 break
+            if self.client.claim_jobs:
+                claimed = self._claim(nmpi_job)
+                if claimed is None:
+                    # taken by another runner, the server now has a different next job
+                    lost.add(nmpi_job['id'])
+                    continue
+                nmpi_job = claimed
+            self.claimed_jobs.add(nmpi_job['id'])
+            pending_jobs.append(nmpi_job)
+        if limit is not None:
+            logger.debug("Claimed {} jobs, admission limit {}".format(len(pending_jobs), limit))
         return pending_jobs
 
+    def _retrieve_fair_share(self, limit):
+        """
+        Claim up to `limit` jobs from the oldest FAIR_SHARE_WINDOW jobs of
+        each flow waiting on the queue server, in the order given by
+        `self.fair_share`.
+
+        Without an admission limit, no more jobs are claimed than there are
+        free slots, so that jobs submitted later compete for the slots as
+        they free up, rather than waiting behind all the jobs claimed before.
+        """
+        if limit is None:
+            limit = self.scheduler.free_slots()
+        if limit == 0:
+            return []
+        try:
+            queued = self.client.queued_jobs(verbose=True)
+        except Exception as exception:
+            logger.warning("Failed to get the queued jobs: {}".format(repr(exception)))
+            return []
+        window = int(self.config.get('FAIR_SHARE_WINDOW', DEFAULT_FAIR_SHARE_WINDOW))
+        candidates = [job for job in queued if job['id'] not in self.claimed_jobs]
+        pending_jobs = self.fair_share.select(candidates, limit, window=window)
+        if self.client.claim_jobs:
+            pending_jobs = [job for job in map(self._claim, pending_jobs) if job is not None]
+        for nmpi_job in pending_jobs:
+            self.claimed_jobs.add(nmpi_job['id'])
+        logger.debug("Claimed jobs {} by fair share".format([job['id'] for job in pending_jobs]))
+        return pending_jobs
+
+    def _claim(self, nmpi_job):
+        """
+        Claim a job for this runner (see `HardwareClient.claim_job()`).
+        Returns the claimed job, or None if it was taken by another runner
+        or could not be claimed.
+        """
+        try:
+            claimed = self.client.claim_job(nmpi_job)
+        except Exception as exception:
+            logger.warning("Failed to claim job {}: {}".format(nmpi_job['id'], repr(exception)))
+            return None
+        if claimed is None:
+            logger.info("Job {} was claimed by another runner".format(nmpi_job['id']))
+        elif self.client.lease_duration is not None:
+            self.lease_renewed[claimed['id']] = time.time()  # the claim comes with a lease
+        return claimed
+
+    def _make_fair_share(self, config):
+        """
+        Create the fair-share scheduler, if FAIR_SHARE is set to the job
+        fields whose values define a flow (e.g. "collab_id,user_id").
+        With FAIR_SHARE_QUOTA_WEIGHTS, flows are weighted by the compute
+        time left to their collab, asked for at most every QUOTA_CACHE_TIME
+        seconds.
+
+        Fair share needs a bound on the number of jobs claimed at a time:
+        MAX_RUNNING_JOBS (and PARTITION_<name>_MAX_JOBS for each partition),
+        or MAX_QUEUED_JOBS or LOCAL_BACKLOG. Without one, all queued jobs are
+        claimed at once, and their order only matters within that batch.
+        """
+        if not config.get('FAIR_SHARE'):
+            return None
+        if (config.get('LOCAL_BACKLOG') is None and self.scheduler.free_slots() is None
+                and any(partition.max_queued is None for partition in self.scheduler.all_partitions())):
+            logger.warning("FAIR_SHARE is set, but nothing limits the number of jobs claimed at a time: "
+                           "set MAX_RUNNING_JOBS, MAX_QUEUED_JOBS or LOCAL_BACKLOG")
+        keys = [key.strip() for key in str(config['FAIR_SHARE']).split(",") if key.strip()]
+        weight = None
+        if config.get('FAIR_SHARE_QUOTA_WEIGHTS'):
+            if "collab_id" not in keys:
+                raise ValueError("FAIR_SHARE_QUOTA_WEIGHTS needs collab_id in FAIR_SHARE")
+            position = keys.index("collab_id")
+            quotas = {}  # collab id -> (time, remaining quota)
+
+            def weight(flow):
+                collab_id = flow[position]
+                now = time.time()
+                if collab_id not in quotas or now - quotas[collab_id][0] > QUOTA_CACHE_TIME:
+                    try:
+                        quotas[collab_id] = (now, self.client.remaining_quota(collab_id))
+                    except Exception as exception:
+                        logger.warning("Failed to get the quota of collab {}: {}".format(collab_id, repr(exception)))
+                        return 1.0
+                return quotas[collab_id][1]
+        return FairShare(keys, weight)
+
+    def admission_limit(self):
+        """
+        Return how many more jobs may be claimed now, or None if there is no limit.
+
+        This is limited by the number of jobs waiting in the cluster queue of
+        each partition (MAX_QUEUED_JOBS, PARTITION_<name>_MAX_QUEUED; a
+        partition without a queue uses the default queue of the cluster), and by
+        the number of jobs held by the runner itself until a partition has a
+        free slot (LOCAL_BACKLOG).
+        """
+        limit = None
+        if self.config.get('LOCAL_BACKLOG') is not None:
+            limit = max(int(self.config['LOCAL_BACKLOG']) - self.scheduler.queued(), 0)
+        partitions = self.scheduler.all_partitions()
+        if limit != 0 and all(partition.max_queued is not None for partition in partitions):
+            cluster_queued = {}  # (adaptor, queue) -> number of jobs waiting
+            default_queues = {}  # adaptor -> queue of the jobs submitted without one
+            for adaptor in set(partition.adaptor or self.config['JOB_SERVICE_ADAPTOR'] for partition in partitions):
+                try:
+                    occupancy = cluster_occupancy(self._service(adaptor), adaptor)
+                    if any(partition.queue is None for partition in partitions):
+                        default_queues[adaptor] = default_queue(adaptor)
+                except Exception as exception:
+                    logger.warning("Could not get the cluster occupancy from {}, not claiming jobs: {}".format(
+                        adaptor, repr(exception)))
+                    return 0
+                for queue, (waiting, running) in occupancy.items():
+                    cluster_queued[(adaptor, queue)] = waiting
+
+            def queue_key(partition):
+                # the queue as the cluster reports it
+                adaptor = partition.adaptor or self.config['JOB_SERVICE_ADAPTOR']
+                queue = partition.queue if partition.queue is not None else default_queues.get(adaptor)
+                return adaptor, queue
+
+            room = self.scheduler.admission_limit(cluster_queued, queue_key)
+            limit = room if limit is None else min(limit, room)
+        return limit
+
     def submit_jobs(self, pending_jobs = []):
         """
         Submit a list of pending nmpi jobs to the saga job system.
+        Jobs are handed to the scheduler, and only those whose partition has
+        a free slot are submitted now; the others are submitted by
+        `wait_on_completion()` as running jobs finish.
         If a nmpi job fails to be submitted it is killed on the server.
         Returns a list of tuples containing the nmpi_job and corresponding saga_job.
         """
-        saga_jobs = []
         for nmpi_job in pending_jobs:
-            saga_job, err = self.run(nmpi_job)
-            if err:
-                self.client.kill_job(job=nmpi_job, error_message=str(err))
-                continue
-            self._update_status(nmpi_job, saga_job, default_job_states)
-            saga_jobs.append((nmpi_job, saga_job))
+            self.scheduler.add(nmpi_job)
+        return self._submit_scheduled_jobs()
+
+    def _submit_scheduled_jobs(self):
+        """
+        Submit queued jobs for as long as their partitions have free slots.
+        In partitions with a PACK_SIZE, jobs using the same PyNN version are
+        submitted together as one cluster job (see `run_pack()`).
+        """
+        saga_jobs = []
+        while True:
+            scheduled = self.scheduler.pop_pack(key=pynn_version)
+            if scheduled is None:
+                break
+            nmpi_jobs, partition = scheduled
+            if len(nmpi_jobs) == 1:
+                saga_job, err = self.run(nmpi_jobs[0], partition)
+                results = [(nmpi_jobs[0], saga_job, err)]
+            else:
+                results = self.run_pack(nmpi_jobs, partition)
+            for nmpi_job, saga_job, err in results:
+                if err:
+                    self.scheduler.release(partition)
+                    self.client.kill_job(job=nmpi_job, error_message=str(err))
+                    self._forget(nmpi_job)
+                    continue
+                self._update_status(nmpi_job, saga_job, default_job_states)
+                if self.log_follower:
+                    self.log_follower.follow(nmpi_job, saga_job)
+                saga_jobs.append((nmpi_job, saga_job))
         return saga_jobs
 
     def wait_on_completion(self, pending_jobs = []):
         """
         Wait on the completion of a list of saga jobs.
+        Each time a job finishes, jobs held back by the scheduler, or newly
+        claimed if the cluster has room, are submitted to take its place, and
+        are waited on in turn.
+
+        Jobs which ran in a scratch directory free their slot as soon as they
+        are done, and their output is copied back in the background while
+        the next jobs run (see `_start_copy_back()`).
         """
-        while True:
-            if pending_jobs is []:
-                break
-            for nmpi_job, saga_job in pending_jobs:
-                saga_job.wait(100)
-                state = saga_job.get_state()
+        while pending_jobs or self.copying:
+            for nmpi_job, saga_job in list(pending_jobs):
+                self._renew_leases(pending_jobs)
+                deadline = self._wall_time_deadline(saga_job)
+                saga_job.wait(100 if deadline is None else min(100, max(deadline - time.time(), 1)))
+                state = self._enforce_wall_time(saga_job, saga_job.get_state())
+                if state in (saga.job.DONE, saga.job.FAILED, saga.job.CANCELED):
+                    self._account(nmpi_job, saga_job, pending_jobs)
+                    if self.log_follower:
+                        self.log_follower.unfollow(nmpi_job)
                 if state == saga.job.DONE:
+                    if self.journal:
+                        self.journal.record(nmpi_job, nmpi_journal.OUTPUT)
+                    if self._in_scratch(saga_job):
+                        pending_jobs.remove((nmpi_job, saga_job))
+                        self.scheduler.release(saga_job.partition)
+                        self._start_copy_back(nmpi_job, saga_job)
+                        continue
                     err = self._handle_output_data(nmpi_job, saga_job)
                     if err:
                         self.client.kill_job(job=nmpi_job, error_message=str(err))
                         logger.info("Job {} killed, because of faulty output handling".format(saga_job.id))
                         pending_jobs.remove((nmpi_job, saga_job))
+                        self.scheduler.release(saga_job.partition)
+                        self._forget(nmpi_job)
                         continue
+                    self._store_result(nmpi_job, saga_job)
+                    self._archive_logs(nmpi_job, saga_job)
                     logger.info("Job {} completed".format(saga_job.id))
                 elif state == saga.job.FAILED:
+                    self._archive_logs(nmpi_job, saga_job)
                     logger.info("Job {} failed".format(saga_job.id))
-                elif state == saga_job.job.CANCELED:
+                elif state == saga.job.CANCELED:
+                    self._archive_logs(nmpi_job, saga_job)
                     logger.info("Job {} got canceled".format(saga_job.id))
                 else:
                     continue
 
                 pending_jobs.remove((nmpi_job, saga_job))
+                self.scheduler.release(saga_job.partition)
                 self._update_status(nmpi_job, saga_job, default_job_states)
+                self._remove_scratch(saga_job)
+                self._forget(nmpi_job)
+            self._finish_copy_backs(wait=not pending_jobs)
+            self.requeue_expired_jobs()
+            self.cancel_removed_jobs(pending_jobs)
+            pending_jobs.extend(self.reconcile())
+            pending_jobs.extend(self.submit_jobs(self.retrieve_pending_jobs()))
+
+    def _in_scratch(self, saga_job):
+        """Whether a job was run in the scratch directory of its partition."""
+        partition = getattr(saga_job, "partition", None)
+        if partition is None or not partition.scratch_directory:
+            return False
+        working_directory = job_description(saga_job).working_directory
+        return path.abspath(working_directory).startswith(path.abspath(partition.scratch_directory) + path.sep)
+
+    def _start_copy_back(self, nmpi_job, saga_job):
+        """
+        Handle the output data of a job which ran in scratch in a background
+        thread, which copies it to DATA_DIRECTORY. The job is reported by
+        `_finish_copy_backs()` once this is done.
+
+        The background thread works on a copy of the job, since the main
+        thread goes on renewing its lease meanwhile (see `_renew_leases()`).
+        The log waiting to be sent stays with the job, so that it is only
+        sent once. The copy is merged back into the job by `_finish_copy_backs()`.
+        """
+        if self.copy_back_pool is None:
+            self.copy_back_pool = ThreadPool(1)
+        logger.info("Copying back the output of job {}".format(saga_job.id))
+        copied_job = copy.deepcopy(nmpi_job)
+        copied_job.pop("log", None)
+        result = self.copy_back_pool.apply_async(self._copy_back, (copied_job, saga_job))
+        self.copying.append((nmpi_job, saga_job, result))
+
+    def _copy_back(self, nmpi_job, saga_job):
+        """
+        Run in the background by `_start_copy_back()`. Returns a tuple of the
+        job, updated with its output data, and an error message or None.
+        """
+        err = self._handle_output_data(nmpi_job, saga_job)
+        if not err:
+            self._store_result(nmpi_job, saga_job)
+            self._archive_logs(nmpi_job, saga_job)
+        return nmpi_job, err
+
+    def _finish_copy_backs(self, wait=False):
+        """
+        Update the status of the jobs whose output has been copied back, and
+        remove their scratch directories. If `wait` is true, first wait for
+        up to 100 s for the oldest copy to finish.
+        """
+        if wait and self.copying:
+            self.copying[0][2].wait(100)
+        for nmpi_job, saga_job, result in list(self.copying):
+            if not result.ready():
+                continue
+            self.copying.remove((nmpi_job, saga_job, result))
+            try:
+                copied_job, err = result.get()
+            except Exception as exception:
+                err = repr(exception)
+            else:
+                log = (nmpi_job.pop("log", None) or "") + (copied_job.pop("log", None) or "")
+                nmpi_job.clear()
+                nmpi_job.update(copied_job)
+                if log:
+                    nmpi_job["log"] = log
+            if err:
+                self.client.kill_job(job=nmpi_job, error_message=str(err))
+                logger.info("Job {} killed, because of faulty output handling".format(saga_job.id))
+            else:
+                self._update_status(nmpi_job, saga_job, default_job_states)
+                logger.info("Job {} completed".format(saga_job.id))
+            self._remove_scratch(saga_job)
+            self._forget(nmpi_job)
+
+    def _remove_scratch(self, saga_job):
+        """Remove the working directory of a job which ran in scratch, once the runner is done with it."""
+        if self._in_scratch(saga_job):
+            shutil.rmtree(job_description(saga_job).working_directory, ignore_errors=True)
+
+    def recover_jobs(self):
+        """
+        Pick up the jobs recorded in the journal by a previous runner that
+        stopped before it had finished with them.
+
+        Jobs that had been submitted to the cluster are reattached to their
+        SAGA job, and their output is handled as usual when they finish.
+        Jobs that were being submitted are looked for on the cluster by name,
+        and reattached if they are found. Jobs that had not been submitted
+        yet, or were not found, are submitted again. Jobs whose SAGA job can
+        no longer be found are put back in the queue.
+
+        Returns a tuple containing a list of (nmpi_job, saga_job) tuples for
+        the reattached jobs, and a list of nmpi jobs to be submitted.
+        """
+        if not self.journal:
+            return [], []
+        reattached = []
+        to_submit = []
+        packs = {}
+        for entry in self.journal.jobs():
+            nmpi_job = entry["nmpi_job"]
+            self.claimed_jobs.add(nmpi_job['id'])
+            partition = self.scheduler.route(nmpi_job)
+            saga_job_id = entry["saga_job_id"]
+            if entry["stage"] == nmpi_journal.SUBMITTING:
+                try:
+                    saga_job_id = self._find_submitted_job(nmpi_job, entry["job_name"], partition)
+                except Exception as exception:
+                    # it may be on the cluster, so it must not be submitted again
+                    logger.warning("Could not look for job {} on the cluster, leaving it for the next "
+                                   "run: {}".format(nmpi_job['id'], repr(exception)))
+                    continue
+            if entry["stage"] == nmpi_journal.STAGING or not saga_job_id:
+                logger.info("Job {} was not submitted before the runner stopped, "
+                            "submitting it again".format(nmpi_job['id']))
+                to_submit.append(nmpi_job)
+                continue
+            try:
+                job_desc = self._build_job_description(nmpi_job, partition)
+                pack_id = nmpi_pack.pack_job_id(saga_job_id)
+                if pack_id:
+                    if pack_id not in packs:
+                        packs[pack_id] = nmpi_pack.JobPack(self._service(partition.adaptor).get_job(pack_id))
+                    saga_job = nmpi_pack.PackedJob(packs[pack_id], nmpi_job['id'], job_desc)
+                else:
+                    saga_job = self._service(partition.adaptor).get_job(saga_job_id)
+                    saga_job.nmpi_description = job_desc
+            except Exception as exception:
+                logger.warning("Could not reattach job {} to SAGA job {}, putting it back in the queue: {}".format(
+                    nmpi_job['id'], saga_job_id, repr(exception)))
+                self.client.reset_job(nmpi_job)
+                self._forget(nmpi_job)
+                continue
+            saga_job.start_time = entry["start_time"]
+            saga_job.partition = partition
+            # the job is on the cluster, so it is running as far as the queue server is concerned
+            nmpi_job['status'] = "running"
+            self.scheduler.started(partition)
+            if saga_job_id != entry["saga_job_id"]:
+                self.journal.record(nmpi_job, nmpi_journal.RUNNING, saga_job_id=saga_job_id)
+            logger.info("Reattached job {} to SAGA job {}".format(nmpi_job['id'], saga_job_id))
+            if self.log_follower:
+                self.log_follower.follow(nmpi_job, saga_job)
+            reattached.append((nmpi_job, saga_job))
+        return reattached, to_submit
+
+    def _find_submitted_job(self, nmpi_job, job_name, partition):
+        """
+        Return the SAGA job ID of a job whose submission to the cluster was
+        under way when the runner stopped, or None if it is not on the cluster.
+        For a job in a pack, this is its ID within the pack.
+        """
+        adaptor = partition.adaptor or self.config['JOB_SERVICE_ADAPTOR']
+        cluster_job_id = find_cluster_job(self._service(partition.adaptor), adaptor, job_name)
+        if cluster_job_id is not None and job_name.startswith(PACK_NAME_PREFIX):
+            return nmpi_pack.member_job_id(cluster_job_id, nmpi_job['id'])
+        return cluster_job_id
 
     def next(self):
         """
         Get all pending nmpi jobs from the server, submit them using saga 
         and wait for their completion.
+
+        Jobs left unfinished by a previous runner are picked up first,
+        see `recover_jobs()`.
         """
-        pending_nmpi_jobs = self.retrieve_pending_jobs()
-        pending_saga_jobs = self.submit_jobs(pending_nmpi_jobs)
+        recovered_saga_jobs, unsubmitted_jobs = self.recover_jobs()
+        self.requeue_expired_jobs()
+        pending_nmpi_jobs = unsubmitted_jobs + self.retrieve_pending_jobs()
+        pending_saga_jobs = recovered_saga_jobs + self.submit_jobs(pending_nmpi_jobs)
+        pending_saga_jobs.extend(self.reconcile())
         self.wait_on_completion(pending_saga_jobs)
         return pending_saga_jobs
 
-    def run(self, nmpi_job):
+    def run(self, nmpi_job, partition=None):
         """
-        Run a given nmpi job as a saga job. Returns a tuple
+        Run a given nmpi job as a saga job, in the given partition (by default
+        the one chosen by the scheduler). Returns a tuple
         of the saga_job handle or None and an error message or None.
         """
+        if partition is None:
+            partition = self.scheduler.route(nmpi_job)
+        job_desc, msg = self._stage(nmpi_job, partition)
+        if msg:
+            return None, msg
+        result_key = self._result_key(nmpi_job, job_desc)
+        if result_key is not None:
+            saga_job = self._reuse_result(nmpi_job, job_desc, result_key, partition)
+            if saga_job is not None:
+                return saga_job, ""
+
+        # Submit a job to the cluster with SAGA."""
+        try: 
+            saga_job = self._service(partition.adaptor).create_job(job_desc)
+        except Exception as exception:
+            msg = "Failed to create job on cluster with exception: {}".format(repr(exception))
+            logger.error(msg)
+            return None, msg
+
+        # Run the job
+        saga_job.start_time = time.time()
+        saga_job.nmpi_description = job_desc
+        saga_job.partition = partition
+        saga_job.result_key = result_key
+        logger.info("Running job {}".format(nmpi_job['id']))
+        if self.journal:
+            # if the runner stops before the job's cluster ID is recorded, it can still find the job by name
+            self.journal.record(nmpi_job, nmpi_journal.SUBMITTING,
+                                job_name=job_desc.name, start_time=saga_job.start_time)
+        try:
+            saga_job.run()
+        except Exception as exception:
+            msg = "Failed to run saga job with exception: {}".format(repr(exception))
+            logger.error(msg)
+            return None, msg
+        if self.journal:
+            self.journal.record(nmpi_job, nmpi_journal.RUNNING,
+                                saga_job_id=saga_job.id, start_time=saga_job.start_time)
+
+        return saga_job, ""
+
+    def run_pack(self, nmpi_jobs, partition):
+        """
+        Run several nmpi jobs as a single cluster job in the given partition,
+        which runs at most PACK_PARALLEL of them at a time (see nmpi_pack).
+        Each job keeps its own working directory, output files and status.
+        Returns a list of tuples of the nmpi_job, its saga_job handle or
+        None, and an error message or None.
+        """
+        results = []
+        staged = []
+        for nmpi_job in nmpi_jobs:
+            job_desc, msg = self._stage(nmpi_job, partition)
+            if msg:
+                results.append((nmpi_job, None, msg))
+                continue
+            result_key = self._result_key(nmpi_job, job_desc)
+            saga_job = None
+            if result_key is not None:
+                saga_job = self._reuse_result(nmpi_job, job_desc, result_key, partition)
+            if saga_job is not None:
+                results.append((nmpi_job, saga_job, ""))
+            else:
+                staged.append((nmpi_job, job_desc, result_key))
+        if not staged:
+            return results
+
+        first_id = staged[0][0]['id']
+        pack_name = PACK_NAME_PREFIX + str(first_id)
+        start_time = time.time()
+        try:
+            pack_desc = nmpi_pack.describe_pack(saga.job.Description(),
+                                                path.join(self.config['WORKING_DIRECTORY'], 'pack_%s' % first_id),
+                                                pack_name,
+                                                [job_desc for nmpi_job, job_desc, result_key in staged],
+                                                parallel=partition.pack_parallel,
+                                                queue=partition.queue)
+            pack_job = self._service(partition.adaptor).create_job(pack_desc)
+            if self.journal:
+                for nmpi_job, job_desc, result_key in staged:
+                    self.journal.record(nmpi_job, nmpi_journal.SUBMITTING,
+                                        job_name=pack_name, start_time=start_time)
+            pack_job.run()
+        except Exception as exception:
+            msg = "Failed to run job pack with exception: {}".format(repr(exception))
+            logger.error(msg)
+            return results + [(nmpi_job, None, msg) for nmpi_job, job_desc, result_key in staged]
+
+        pack = nmpi_pack.JobPack(pack_job)
+        logger.info("Running jobs {} as pack {}".format(
+            [nmpi_job['id'] for nmpi_job, job_desc, result_key in staged], pack.id))
+        for nmpi_job, job_desc, result_key in staged:
+            saga_job = nmpi_pack.PackedJob(pack, nmpi_job['id'], job_desc)
+            saga_job.start_time = start_time
+            saga_job.partition = partition
+            saga_job.result_key = result_key
+            if self.journal:
+                self.journal.record(nmpi_job, nmpi_journal.RUNNING,
+                                    saga_job_id=saga_job.id, start_time=start_time)
+            results.append((nmpi_job, saga_job, ""))
+        return results
+
+    def _stage(self, nmpi_job, partition):
+        """
+        Build the job description, and fetch the code and input data of a job.
+        Returns a tuple of the job description and an error message or None.
+        """
         # Build the job description
         try:
-            job_desc = self._build_job_description(nmpi_job)
+            job_desc = self._build_job_description(nmpi_job, partition)
         except Exception as exception:
             msg = "Failed to build job description with error: {}".format(repr(exception))
             logger.error(msg)
             return None, msg
+        if self.journal:
+            self.journal.record(nmpi_job, nmpi_journal.STAGING,
+                                working_directory=job_desc.working_directory)
+        # The job may be run again in the working directory of an earlier
+        # run (after a requeue, or a restart of the runner while it was
+        # being staged), which holds its code, e.g. a partial clone
+        try:
+            if path.exists(job_desc.working_directory):
+                shutil.rmtree(job_desc.working_directory)
+            create_working_directory(job_desc.working_directory)
+        except (IOError, OSError) as exception:
+            msg = "Failed to empty the working directory: {}".format(repr(exception))
+            logger.error(msg)
+            return None, msg
+
+        # Files left in the output directory by an earlier run of the job
+        # (before a requeue or a restart of the runner) are not outputs of this one
+        output_directory = (job_desc.environment or {}).get(OUTPUT_DIRECTORY_VARIABLE)
+        if output_directory:
+            try:
+                if path.exists(output_directory):
+                    shutil.rmtree(output_directory)
+                create_working_directory(output_directory)
+            except (IOError, OSError) as exception:
+                msg = "Failed to empty the output directory: {}".format(repr(exception))
+                logger.error(msg)
+                return None, msg
 
         # Get the source code for the experiment
-        err = get_code(nmpi_job, job_desc.working_directory, script_name=job_desc.arguments[0])
+        err = get_code(job_desc.working_directory, nmpi_job, script_name=job_desc.arguments[0],
+                       git_cache=self.git_cache, archive_cache=self.archive_cache)
         if err:
             msg = "Failed to obtain source code: {}".format(err)
             logger.info(msg)
             return None, msg
 
         # Download any input data
-        err = get_input_data(self.client, nmpi_job, job_desc.working_directory)
+        err = get_input_data(self.client, nmpi_job, job_desc.working_directory,
+                             input_cache=self.input_cache,
+                             threads=int(self.config.get('INPUT_DOWNLOAD_THREADS', DEFAULT_DOWNLOAD_THREADS)))
         if err:
-            msg = "Failed to download input data."
+            msg = "Failed to download input data: {}".format(err)
             logger.error(msg)
             return None, msg
+        return job_desc, None
 
-        # Submit a job to the cluster with SAGA."""
-        try: 
-            saga_job = self.service.create_job(job_desc)
-        except Exception as exception:
-            msg = "Failed to create job on cluster with exception: {}".format(repr(exception))
-            logger.error(msg)
-            return None, msg
+    def _result_key(self, nmpi_job, job_desc):
+        """
+        Return the key under which the results of a staged job are cached
+        (see `ResultCache.job_key()`), or None if the results of the job are
+        not to be cached: there is no RESULT_CACHE_DIRECTORY, or the job
+        does not match the RESULT_CACHE_RULES which say which jobs are
+        deterministic.
+        """
+        if self.result_cache is None:
+            return None
+        if not all(rule.matches(nmpi_job.get('hardware_config')) for rule in self.result_cache_rules):
+            return None
+        working_directory = job_desc.working_directory
+        environment = dict(job_desc.environment or {})
+        environment.pop(OUTPUT_DIRECTORY_VARIABLE, None)
+        parameters = {
+            "platform": self.config.get('PLATFORM_NAME'),
+            "executable": job_desc.executable,
+            # the working directory is different for each job
+            "arguments": [path.relpath(arg, working_directory)
+                          if str(arg).startswith(working_directory + path.sep) else arg
+                          for arg in job_desc.arguments],
+            "environment": environment,
+            "hardware_config": nmpi_job.get('hardware_config'),
+        }
+        try:
+            return self.result_cache.job_key(parameters, working_directory,
+                                             ignore_files=(job_desc.output, job_desc.error) + nmpi_pack.PACK_FILES)
+        except (IOError, OSError) as exception:
+            logger.warning("Could not compute the result key of job {}: {}".format(nmpi_job['id'], repr(exception)))
+            return None
 
-        # Run the job
-        saga_job.start_time = time.time()
-        logger.info("Running job {}".format(nmpi_job['id']))
+    def _reuse_result(self, nmpi_job, job_desc, result_key, partition):
+        """
+        If the results of an identical job are in the result cache, put its
+        output files and logs in place of those of the job, and return a
+        `CachedResultJob` to be handled like a job which has run. Otherwise
+        return None.
+        """
+        start_time = time.time()
+        output_directory = (job_desc.environment or {}).get(OUTPUT_DIRECTORY_VARIABLE)
         try:
-            saga_job.run()
+            meta = self.result_cache.fetch(result_key, output_directory or job_desc.working_directory,
+                                           self._log_files(job_desc))
         except Exception as exception:
-            msg = "Failed to run saga job with exception: {}".format(repr(exception))
-            logger.error(msg)
-            return None, msg
+            logger.warning("Could not use the cached results for job {}: {}".format(nmpi_job['id'], repr(exception)))
+            return None
+        if meta is None:
+            return None
+        saga_job = CachedResultJob(result_key, job_desc)
+        saga_job.start_time = start_time
+        saga_job.partition = partition
+        nmpi_job["log"] = nmpi_job.get("log", "") + "Results reused from identical job {}\n".format(meta.get("job_id"))
+        logger.info("Job {} is identical to job {}, reusing its results".format(nmpi_job['id'], meta.get("job_id")))
+        return saga_job
+
+    def _store_result(self, nmpi_job, saga_job):
+        """Put the results of a job which has completed in the result cache, if they are to be cached."""
+        result_key = getattr(saga_job, "result_key", None)
+        if result_key is None or isinstance(saga_job, CachedResultJob):
+            return
+        job_desc = job_description(saga_job)
+        output_directory = (job_desc.environment or {}).get(OUTPUT_DIRECTORY_VARIABLE)
+        try:
+            if output_directory:
+                source_dir, output_files = output_directory, _list_output_files(output_directory)
+            else:
+                source_dir = job_desc.working_directory
+                output_files = _find_new_data_files(source_dir, saga_job.start_time,
+                                                    ignore_files=(job_desc.output, job_desc.error) + nmpi_pack.PACK_FILES)
+            self.result_cache.store(result_key, source_dir, output_files, self._log_files(job_desc),
+                                    job_id=nmpi_job['id'])
+        except Exception as exception:
+            logger.warning("Could not cache the results of job {}: {}".format(nmpi_job['id'], repr(exception)))
 
-        return saga_job, ""
+    def _log_files(self, job_desc):
+        return {"stdout": path.join(job_desc.working_directory, job_desc.output),
+                "stderr": path.join(job_desc.working_directory, job_desc.error)}
 
     def close(self):
-        self.service.close()
+        if self.collector is not None:
+            self.collector.stop()
+        if self.copy_back_pool is not None:
+            self.copy_back_pool.close()
+            self.copy_back_pool.join()
+        if self.log_follower:
+            self.log_follower.stop()
+        if self.client.update_queue is not None:
+            self.client.update_queue.close()
+        if self.journal:
+            self.journal.close()
+        for service in self.services.values():
+            service.close()
+
+    def _service(self, adaptor=None):
+        """
+        Return the job service for an adaptor URL, connecting if needed.
+        This is a SAGA job service, unless the URL scheme is one of JOB_SERVICES.
+        """
+        adaptor = adaptor or self.config['JOB_SERVICE_ADAPTOR']
+        if adaptor not in self.services:
+            self.services[adaptor] = make_job_service(adaptor, self.config)
+        return self.services[adaptor]
+
+    def requeue_expired_jobs(self):
+        """
+        Put jobs whose lease has expired back in the queue (see
+        `HardwareClient.requeue_expired_jobs()`), at most once every
+        LEASE_CHECK_INTERVAL seconds. Does nothing unless leases are enabled.
+        """
+        if self.client.lease_duration is None:
+            return []
+        interval = float(self.config.get('LEASE_CHECK_INTERVAL', self.client.lease_duration / 2))
+        now = time.time()
+        if self.last_lease_check is not None and now - self.last_lease_check < interval:
+            return []
+        self.last_lease_check = now
+        try:
+            return self.client.requeue_expired_jobs(exclude=self.claimed_jobs)
+        except Exception as exception:
+            logger.warning("Failed to check for jobs with expired leases: {}".format(repr(exception)))
+            return []
+
+    def reconcile(self):
+        """
+        Compare the jobs the queue server has as running with the jobs on the
+        cluster (see `classify_jobs()`), and fix any differences:
+        orphaned jobs are reattached and returned as a list of
+        (nmpi_job, saga_job) tuples to be waited on, unreported jobs are put
+        back in the queue, and ghost jobs are cancelled.
+
+        Runs at most once every RECONCILE_INTERVAL seconds, and not at all if
+        that is not set. When leases are enabled, only running jobs whose
+        lease is held by this runner are considered ours, and likewise when
+        claims are enabled (CLAIM_JOBS), only jobs it has claimed; otherwise
+        all running jobs of the platform are.
+        """
+        if not self.config.get('RECONCILE_INTERVAL'):
+            return []
+        now = time.time()
+        if (self.last_reconciliation is not None
+                and now - self.last_reconciliation < float(self.config['RECONCILE_INTERVAL'])):
+            return []
+        self.last_reconciliation = now
+
+        def is_ours(nmpi_job):
+            provenance = nmpi_job.get("provenance") or {}
+            if self.client.lease_duration is not None:
+                lease = provenance.get("lease")
+                return bool(lease) and lease["runner"] == self.client.runner_id
+            if self.client.claim_jobs:
+                claim = provenance.get("claim")
+                return bool(claim) and claim["runner"] == self.client.runner_id
+            return True
+
+        # make sure the server knows about all the jobs we have finished with
+        if self.client.update_queue is not None:
+            self.client.update_queue.flush()
+        try:
+            server_jobs = self.client.running_jobs(verbose=True) + self.client.queued_jobs(verbose=True)
+            cluster = {}
+            adaptors = {}  # saga job id -> adaptor
+            for adaptor in set(partition.adaptor or self.config['JOB_SERVICE_ADAPTOR']
+                               for partition in self.scheduler.all_partitions()):
+                for cluster_job in cluster_jobs(self._service(adaptor), adaptor).values():
+                    cluster[cluster_job.saga_job_id] = cluster_job
+                    adaptors[cluster_job.saga_job_id] = adaptor
+        except Exception as exception:
+            logger.warning("Failed to get the state of the jobs for reconciliation: {}".format(repr(exception)))
+            return []
+        found = classify_jobs(server_jobs, self.claimed_jobs, cluster, is_ours)
+
+        adopted = []
+        for nmpi_job, cluster_job in found["orphaned"]:
+            partition = self.scheduler.route(nmpi_job)
+            try:
+                saga_job = self._service(partition.adaptor).get_job(cluster_job.saga_job_id)
+                saga_job.nmpi_description = self._build_job_description(nmpi_job, partition)
+            except Exception as exception:
+                logger.warning("Could not reattach orphaned job {}: {}".format(nmpi_job['id'], repr(exception)))
+                continue
+            logger.info("Reattached orphaned job {} to cluster job {}".format(nmpi_job['id'],
+                                                                             cluster_job.saga_job_id))
+            saga_job.start_time = now
+            saga_job.partition = partition
+            self.scheduler.started(partition)
+            self.claimed_jobs.add(nmpi_job['id'])
+            if self.journal:
+                self.journal.record(nmpi_job, nmpi_journal.RUNNING,
+                                    saga_job_id=cluster_job.saga_job_id, start_time=now)
+            if self.log_follower:
+                self.log_follower.follow(nmpi_job, saga_job)
+            adopted.append((nmpi_job, saga_job))
+
+        if found["unreported"]:
+            logger.warning("Putting back in the queue {} jobs which ended without being reported: {}".format(
+                len(found["unreported"]), [job['id'] for job in found["unreported"]]))
+            for job, err in self.client.reset_jobs(found["unreported"]):
+                if err:
+                    logger.error("Failed to reset job {}: {}".format(job['id'], err))
+
+        if found["ghost"]:
+            logger.warning("Cancelling {} cluster jobs for jobs which are no longer active: {}".format(
+                len(found["ghost"]), [cluster_job.saga_job_id for cluster_job in found["ghost"]]))
+            for adaptor in set(adaptors.values()):
+                ghosts = [cluster_job.saga_job_id for cluster_job in found["ghost"]
+                          if adaptors[cluster_job.saga_job_id] == adaptor]
+                err = cancel_cluster_jobs(self._service(adaptor), adaptor, ghosts)
+                if err:
+                    logger.error("Failed to cancel cluster jobs: {}".format(err))
+        return adopted
+
+    def _wall_time_deadline(self, saga_job):
+        """
+        Return the time after which a running job is cancelled by the runner,
+        i.e. WALL_TIME_GRACE seconds after the wall-time limit of its
+        partition, or None if it has no limit or is not known to be running.
+
+        The limit is also passed to the batch system, in the job description,
+        so this only matters for job services which do not enforce it. Jobs
+        in a pack are limited by their task script (see nmpi_pack).
+        """
+        partition = getattr(saga_job, "partition", None)
+        running_since = getattr(saga_job, "running_since", None)
+        if (partition is None or not partition.wall_time_limit or running_since is None
+                or isinstance(saga_job, nmpi_pack.PackedJob)):
+            return None
+        grace = float(self.config.get('WALL_TIME_GRACE', DEFAULT_WALL_TIME_GRACE))
+        return running_since + partition.wall_time_limit * 60 + grace
 
-    def _build_job_description(self, nmpi_job):
+    def _enforce_wall_time(self, saga_job, state):
+        """
+        Cancel a running job which has gone past its deadline (see
+        `_wall_time_deadline()`). Returns the state of the job.
+        """
+        if state != saga.job.RUNNING:
+            return state
+        if getattr(saga_job, "running_since", None) is None:
+            saga_job.running_since = time.time()
+        deadline = self._wall_time_deadline(saga_job)
+        if deadline is None or time.time() < deadline:
+            return state
+        logger.info("Job {} exceeded the wall-time limit of {} minutes, cancelling it".format(
+            saga_job.id, saga_job.partition.wall_time_limit))
+        saga_job.cancel_reason = "Job exceeded the wall-time limit of {} minutes".format(
+            saga_job.partition.wall_time_limit)
+        try:
+            saga_job.cancel()
+            saga_job.wait(CANCEL_WAIT)
+        except Exception as exception:
+            logger.error("Failed to cancel job {}: {}".format(saga_job.id, repr(exception)))
+        return saga_job.get_state()
+
+    def cancel_removed_jobs(self, pending_jobs):
+        """
+        Cancel the cluster jobs of jobs which are no longer queued or running
+        on the queue server, i.e. which their users have removed, and drop
+        such jobs which are still waiting for a free slot. Their slots are
+        freed at once, and the server is not updated, since the jobs are gone.
+
+        Runs at most once every CANCELLATION_CHECK_INTERVAL seconds, and not
+        at all if that is not set.
+        """
+        if not self.config.get('CANCELLATION_CHECK_INTERVAL'):
+            return
+        now = time.time()
+        if (self.last_cancellation_check is not None
+                and now - self.last_cancellation_check < float(self.config['CANCELLATION_CHECK_INTERVAL'])):
+            return
+        self.last_cancellation_check = now
+        # jobs whose update to "running" has not been sent yet are still on the server
+        if self.client.update_queue is not None:
+            self.client.update_queue.flush()
+        try:
+            active = set(int(str(uri).rstrip("/").split("/")[-1])
+                         for uri in self.client.running_jobs() + self.client.queued_jobs())
+        except Exception as exception:
+            logger.warning("Failed to get the active jobs from the queue server: {}".format(repr(exception)))
+            return
+
+        for nmpi_job, saga_job in list(pending_jobs):
+            if nmpi_job['id'] in active:
+                continue
+            logger.info("Job {} was removed from the queue, cancelling cluster job {}".format(
+                nmpi_job['id'], saga_job.id))
+            saga_job.cancel_reason = "Job removed from the queue by its user"
+            try:
+                saga_job.cancel()
+            except Exception as exception:
+                logger.error("Failed to cancel job {}: {}".format(saga_job.id, repr(exception)))
+            if self.log_follower:
+                self.log_follower.unfollow(nmpi_job)
+            pending_jobs.remove((nmpi_job, saga_job))
+            self.scheduler.release(saga_job.partition)
+            self._forget(nmpi_job)
+
+        removed = self.scheduler.discard(self.claimed_jobs - active)
+        if removed:
+            logger.info("Dropping {} jobs removed from the queue before they were submitted: {}".format(
+                len(removed), [nmpi_job['id'] for nmpi_job in removed]))
+        for nmpi_job in removed:
+            self._forget(nmpi_job)
+
+    def _account(self, nmpi_job, saga_job, pending_jobs):
+        """
+        Measure the resources used by a job which has ended, and keep them
+        as `saga_job.resource_usage` for `record_usage()`.
+
+        For cluster jobs run through SLURM on the local host, the usage is
+        taken from SLURM's accounting. A single call to sacct gets it for
+        all the pending jobs which have ended, and is only made again for a
+        job which ended since. Jobs run as local processes report their own
+        usage. For other jobs, and jobs in packs, only the wall time is
+        known, as measured by the runner.
+        """
+        if isinstance(saga_job, CachedResultJob):
+            usage = {"wall_time": 0.0, "cpu_time": 0.0, "max_rss": None, "cores": 0}
+        elif getattr(saga_job, "usage", None) is not None:
+            usage = saga_job.usage  # see nmpi_local
+        else:
+            usage = None
+            if self._is_slurm_job(saga_job):
+                job_id = native_job_id(saga_job.id)
+                if job_id not in self.usage_cache:
+                    job_ids = [native_job_id(other.id) for _, other in pending_jobs if self._is_slurm_job(other)]
+                    try:
+                        self.usage_cache = sacct_usage(sorted(set(job_ids + [job_id])))
+                    except Exception as exception:
+                        logger.warning("Failed to get the resource usage of jobs from sacct: {}".format(
+                            repr(exception)))
+                usage = self.usage_cache.pop(job_id, None)
+            if usage is None:
+                started = getattr(saga_job, "running_since", None) or getattr(saga_job, "start_time", None)
+                usage = {"wall_time": time.time() - started if started else None,
+                         "cpu_time": None,
+                         "max_rss": None,
+                         "cores": getattr(job_description(saga_job), "total_cpu_count", None) or 1}
+        value = usage_in_units(usage, self.resource_units, nmpi_job.get('hardware_config'))
+        saga_job.resource_usage = dict(usage, units=self.resource_units, value=value)
+        return saga_job.resource_usage
+
+    def _is_slurm_job(self, saga_job):
+        """Whether a job is a cluster job of its own run through SLURM on the local host."""
+        partition = getattr(saga_job, "partition", None)
+        adaptor = partition.adaptor if partition is not None else self.config.get('JOB_SERVICE_ADAPTOR')
+        return (adaptor is not None and _is_local_slurm(adaptor)
+                and not isinstance(saga_job, (nmpi_pack.PackedJob, CachedResultJob)))
+
+    def _renew_leases(self, pending_jobs):
+        """
+        Renew the leases on the jobs the runner holds which are due for it
+        (every third of LEASE_DURATION): jobs on the cluster, jobs waiting
+        for a free slot in the scheduler, and jobs whose output is being
+        copied back. Jobs are renewed if they are running on the queue
+        server, which claimed jobs are whatever their local status (see
+        `HardwareClient.claim_jobs`). Does nothing unless leases are enabled.
+        """
+        if self.client.lease_duration is None:
+            return
+        now = time.time()
+        held = ([nmpi_job for nmpi_job, saga_job in pending_jobs] + self.scheduler.held_jobs()
+                + [nmpi_job for nmpi_job, saga_job, result in self.copying])
+        for nmpi_job in held:
+            if not (self.client.claim_jobs or nmpi_job.get('status') == "running"):
+                continue
+            if now - self.lease_renewed.get(nmpi_job['id'], 0) >= self.client.lease_duration / 3:
+                try:
+                    self.client.renew_lease(nmpi_job)
+                except Exception as exception:
+                    logger.warning("Failed to renew the lease on job {}: {}".format(nmpi_job['id'], repr(exception)))
+                    continue
+                self.lease_renewed[nmpi_job['id']] = now
+
+    def _forget(self, nmpi_job):
+        """
+        Remove a job the runner has finished with from the journal, and mark
+        its working directory for collection (see nmpi_gc).
+
+        With ASYNC_STATUS_UPDATES the journal entry is only removed once the
+        final update of the job has been sent, so that a runner which dies
+        before then handles the job again when it is restarted.
+        """
+        if self.config.get('WORKING_DIRECTORY'):
+            mark_finished(path.join(self.config['WORKING_DIRECTORY'], 'job_%s' % nmpi_job['id']))
+        self.claimed_jobs.discard(nmpi_job['id'])
+        self.lease_renewed.pop(nmpi_job['id'], None)
+        if self.journal:
+            job_id = nmpi_job['id']
+            if self.client.update_queue is not None:
+                self.client.update_queue.when_sent(job_id, lambda: self.journal.remove(job_id))
+            else:
+                self.journal.remove(job_id)
+
+    def _build_job_description(self, nmpi_job, partition=None):
         """
         Construct a Saga job description based on an NMPI job description and
-        the local configuration.
+        the local configuration. The job is sent to the queue of `partition`
+        if given, otherwise to JOB_QUEUE.
         """
         #    Set all relevant parameters as in http://saga-project.github.io/saga-python/doc/library/job/index.html
         #    http://saga-project.github.io/saga-python/doc/tutorial/part5.html
 
         job_desc = saga.job.Description()
         job_id = nmpi_job['id']
-        job_desc.working_directory = path.join(self.config['WORKING_DIRECTORY'], 'job_%s' % job_id)
+        # jobs are staged and run on fast local storage if their partition has some
+        if partition is not None and partition.scratch_directory:
+            job_desc.working_directory = path.join(partition.scratch_directory, 'job_%s' % job_id)
+        else:
+            job_desc.working_directory = path.join(self.config['WORKING_DIRECTORY'], 'job_%s' % job_id)
+        job_desc.name = JOB_NAME_PREFIX + str(job_id)  # lets `reconcile()` match cluster jobs to NMPI jobs
         # job_desc.spmd_variation    = "MPI" # to be commented out if not using MPI
 
-        if nmpi_job['hardware_config'] is None:
-            pyNN_version = DEFAULT_PYNN_VERSION
-        else:
-            pyNN_version = nmpi_job['hardware_config'].get("pyNN_version", DEFAULT_PYNN_VERSION)
+        # If configured, give the job a directory of its own for its results,
+        # separate from the code and input data, and tell the script where it is.
+        if self.config.get('OUTPUT_DIRECTORY'):
+            output_directory = path.join(self.config['OUTPUT_DIRECTORY'], 'job_%s' % job_id)
+            job_desc.environment = {OUTPUT_DIRECTORY_VARIABLE: output_directory}
+
+        pyNN_version = pynn_version(nmpi_job)
 
         if pyNN_version == "0.7":
             job_desc.executable = self.config['JOB_EXECUTABLE_PYNN_7']
@@ -576,8 +2571,11 @@ class JobRunner(object):
         else:
             raise ValueError("Supported PyNN versions: 0.7, 0.8. {} not supported".format(pyNN_version))
 
-        if self.config['JOB_QUEUE'] is not None:
-            job_desc.queue = self.config['JOB_QUEUE']  # aka SLURM "partition"
+        queue = partition.queue if partition is not None else self.config['JOB_QUEUE']
+        if queue is not None:
+            job_desc.queue = queue  # aka SLURM "partition"
+        if partition is not None and partition.wall_time_limit:
+            job_desc.wall_time_limit = partition.wall_time_limit  # minutes
         script_name = nmpi_job.get("command", "")
         if not script_name:
             script_name = DEFAULT_SCRIPT_NAME
@@ -595,63 +2593,52 @@ class JobRunner(object):
         logger.debug("SAGA state: {}".format(saga_state))
         set_status = job_states[saga_state]
         nmpi_job = set_status(nmpi_job, saga_job)
-        self.client.update_job(nmpi_job)
+        self.client.update_job_later(nmpi_job)
         return nmpi_job
 
     def _handle_output_data(self, nmpi_job, saga_job):
         """
-        Adds the contents of the nmpi_job folder to the list of nmpi_job
-        output data
-
-        NOTE: This is potentially a pretty fragile implementation. It would
-        be easier to separate the output directory from the directory in which
-        the code was cloned or alternatively to keep a list of files and directories
-        around that have been present before the code executed.
-        """
-        job_desc = saga_job.get_description()
-        new_files = _find_new_data_files(job_desc.working_directory, saga_job.start_time)
-        output_dir = path.join(self.config['DATA_DIRECTORY'], path.basename(job_desc.working_directory))
-        logger.debug("Copying files to {}: {}".format(output_dir,
-                                                     ", ".join(new_files)))
-        if self.config["DATA_DIRECTORY"] != self.config["WORKING_DIRECTORY"]:
-            if not path.exists(self.config['DATA_DIRECTORY']):
-                try:
-                    os.makedirs(self.config['DATA_DIRECTORY'])
-                except Exception as exception:
-                    logging.error("Failed to create output directory: {}".format(repr(exception)))
-                    return repr(exception)
-            for new_file in new_files:
-                try:
-                    new_file_path = path.join(output_dir, new_file)
-                    if not os.path.exists(os.path.dirname(new_file_path)):
-                        os.makedirs(os.path.dirname(new_file_path))
-                    shutil.copyfile(path.join(job_desc.working_directory, new_file),
-                                    new_file_path)
-                except Exception as exception:
-                    msg = "Failed to copy files : {}".format(repr(exception))
-                    logging.info(msg)
-                    return msg
-        # append the new output to the list of item data and retrieve it
-        # by POSTing to the DataItem list resource
-        logger.info("Posting data items")
-        for new_file in new_files:
-            url = "{}/{}/{}".format(self.config["DATA_SERVER"], os.path.basename(job_desc.working_directory), new_file)
+        Adds the contents of the nmpi_job output folder to the list of nmpi_job
+        output data. See `handle_output_data()`.
+        """
+        job_desc = job_description(saga_job)
+        output_directory = (job_desc.environment or {}).get(OUTPUT_DIRECTORY_VARIABLE)
+        if not path.exists(self.config['DATA_DIRECTORY']):
             try:
-                resource_uri = self.client.create_data_item(url)
-                nmpi_job['output_data'].append(resource_uri)
+                os.makedirs(self.config['DATA_DIRECTORY'])
             except Exception as exception:
-                msg = "Failed to create data item remotely at {}: {}".format(url, repr(exception))
-                logging.info(msg)
-                return msg
-
-        # ... and PUTting to the job resource
-        try: 
-            self.client.update_job(nmpi_job)
-        except Exception as exception:
-            msg = "Failed to update the job reflecting the produced output data: {}".format(repr(exception))
-            logger.info(msg)
-            return msg
-        return None
+                logger.error("Failed to create output directory: {}".format(repr(exception)))
+                return repr(exception)
+        return handle_output_data(self.client,
+                                  self.config["DATA_SERVER"],
+                                  self.config["DATA_DIRECTORY"],
+                                  job_desc.working_directory,
+                                  saga_job.start_time,
+                                  nmpi_job,
+                                  output_directory=output_directory,
+                                  copy_threads=int(self.config.get('OUTPUT_COPY_THREADS', DEFAULT_COPY_THREADS)),
+                                  use_hardlinks=self.config.get('OUTPUT_USE_HARDLINKS', True),
+                                  registration_threads=int(self.config.get('DATA_ITEM_THREADS',
+                                                                           DEFAULT_REGISTRATION_THREADS)),
+                                  ignore_files=(job_desc.output, job_desc.error) + nmpi_pack.PACK_FILES,
+                                  checksums=self.config.get('OUTPUT_CHECKSUMS', True))
+
+    def _archive_logs(self, nmpi_job, saga_job):
+        """
+        Keep compressed copies of stdout and stderr if they are too long
+        for the job log. See `archive_logs()`.
+        """
+        job_desc = job_description(saga_job)
+        log_files = [path.join(job_desc.working_directory, job_desc.output),
+                     path.join(job_desc.working_directory, job_desc.error)]
+        resource_uris, err = archive_logs(self.client,
+                                          self.config["DATA_SERVER"],
+                                          self.config["DATA_DIRECTORY"],
+                                          job_desc.working_directory,
+                                          log_files)
+        nmpi_job.setdefault('output_data', []).extend(resource_uris)
+        if err:
+            logger.warning("Job {}: {}".format(nmpi_job['id'], err))
 
 
 def main():
@@ -661,6 +2648,10 @@ def main():
     )
     try:
         runner = JobRunner(config)
+    except nmpi_journal.JournalLocked as exception:
+        # a previous run is still waiting on its jobs
+        logger.info(str(exception))
+        return 0
     except Exception as exception:
         # NOTE: JobRunner relies on being able to retrieve a schema from the
         # HBP endpoint, this might fail if the server is down.
@@ -674,6 +2665,8 @@ def main():
         # this is meant to capture the remaining cases.
         logger.error("Unhandled exception while running: {}".format(repr(exception)))
         raise exception
+    finally:
+        runner.close()
     return 0
 
 if __name__ == "__main__":
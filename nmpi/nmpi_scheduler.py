@@ -0,0 +1,363 @@
+"""
+Routing of jobs to partitions of the cluster, and limiting of the number of
+jobs running in each partition (see nmpi_saga.JobRunner).
+
+Partitions are defined in the runner configuration::
+
+    PARTITIONS=short,wafer
+    PARTITION_short_QUEUE=ess
+    PARTITION_short_MAX_JOBS=8
+    PARTITION_short_PRIORITY=10
+    PARTITION_short_RULES=platform_variant=ESS;expected_duration<=600
+    PARTITION_wafer_QUEUE=wafer
+    PARTITION_wafer_ADAPTOR=slurm://wafer-head
+    PARTITION_wafer_MAX_JOBS=1
+    PARTITION_wafer_MAX_QUEUED=2
+
+A job goes to the first partition (in the order of PARTITIONS) all of whose
+rules match its `hardware_config`. Jobs matching no partition go to the
+default partition, given by JOB_QUEUE and JOB_SERVICE_ADAPTOR, with at most
+MAX_RUNNING_JOBS jobs running (no limit if not set).
+
+MAX_QUEUED (MAX_QUEUED_JOBS for the default partition) limits the number of
+jobs waiting in the cluster queue of a partition; the runner does not claim
+new jobs from the queue server while all partitions are full (see
+JobRunner.retrieve_pending_jobs).
+
+PACK_SIZE allows up to that many jobs of a partition which use the same
+PyNN version to be sent to the cluster as a single job, running at most
+PACK_PARALLEL of them at a time (see nmpi_pack). The default partition uses
+PACK_SIZE and PACK_PARALLEL without prefix. Each job of a pack still takes a
+slot.
+
+WALL_TIME_LIMIT is the maximum time in minutes for which a job of the
+partition may run. Without prefix, it applies to the default partition, and
+to the partitions which do not set their own.
+
+SCRATCH_DIRECTORY is a directory on fast storage local to the nodes on which
+the jobs of the partition run (e.g. an SSD or tmpfs), in which they are
+staged and run instead of in WORKING_DIRECTORY. Without prefix, it applies to
+the default partition only.
+
+"""
+
+import heapq
+import logging
+from collections import deque, OrderedDict
+
+logger = logging.getLogger("NMPI")
+
+# longest operators first, so that "<=" is not read as "<"
+OPERATORS = (
+    ("!=", lambda a, b: a != b),
+    ("<=", lambda a, b: a <= b),
+    (">=", lambda a, b: a >= b),
+    ("<", lambda a, b: a < b),
+    (">", lambda a, b: a > b),
+    ("=", lambda a, b: a == b),
+)
+
+
+def _to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Rule(object):
+    """
+    A condition on one entry of the `hardware_config` of a job, such as
+    "expected_duration<=600". Values are compared as numbers if both are
+    numbers, otherwise as strings. A missing entry never matches.
+    """
+
+    def __init__(self, text):
+        for symbol, operator in OPERATORS:
+            if symbol in text:
+                key, value = text.split(symbol, 1)
+                self.key = key.strip()
+                self.value = value.strip()
+                self.symbol = symbol
+                self.operator = operator
+                break
+        else:
+            raise ValueError("Invalid partition rule: '{}'".format(text))
+
+    def matches(self, hardware_config):
+        if not hardware_config or self.key not in hardware_config:
+            return False
+        actual = hardware_config[self.key]
+        actual_number, expected_number = _to_number(actual), _to_number(self.value)
+        if actual_number is not None and expected_number is not None:
+            return self.operator(actual_number, expected_number)
+        return self.operator(str(actual), self.value)
+
+    def __repr__(self):
+        return "{}{}{}".format(self.key, self.symbol, self.value)
+
+
+def parse_rules(text):
+    """Parse a list of rules separated by semicolons."""
+    if not text:
+        return []
+    return [Rule(item) for item in text.split(";") if item.strip()]
+
+
+class Partition(object):
+    """
+    A cluster partition (SLURM queue) jobs can be sent to, possibly through
+    its own SAGA adaptor.
+    """
+
+    def __init__(self, name, queue=None, adaptor=None, max_jobs=None, priority=0, rules=(),
+                 max_queued=None, pack_size=1, pack_parallel=1, wall_time_limit=None,
+                 scratch_directory=None):
+        self.name = name
+        self.queue = queue
+        self.adaptor = adaptor
+        self.max_jobs = max_jobs
+        self.max_queued = max_queued
+        self.priority = priority
+        self.rules = list(rules)
+        self.pack_size = pack_size
+        self.pack_parallel = pack_parallel
+        self.wall_time_limit = wall_time_limit  # minutes
+        self.scratch_directory = scratch_directory
+        self.queued = deque()
+        self.running = 0
+
+    def matches(self, nmpi_job):
+        return all(rule.matches(nmpi_job.get('hardware_config')) for rule in self.rules)
+
+    def has_free_slot(self):
+        return self.max_jobs is None or self.running < self.max_jobs
+
+    def __repr__(self):
+        return "Partition({}, queue={}, running={}/{}, queued={})".format(
+            self.name, self.queue, self.running, self.max_jobs, len(self.queued))
+
+
+class Scheduler(object):
+    """
+    Holds the jobs retrieved from the queue server until their partition has
+    a free slot. When several partitions have jobs waiting and free slots,
+    those with the highest priority are served first; within a partition,
+    jobs are started in the order they were added.
+    """
+
+    def __init__(self, partitions, default):
+        self.partitions = list(partitions)
+        self.default = default
+        # sort is stable, so partitions with equal priority keep their order
+        self._by_priority = sorted(self.partitions + [default], key=lambda p: -p.priority)
+
+    def route(self, nmpi_job):
+        """Return the partition in which a job should run."""
+        for partition in self.partitions:
+            if partition.matches(nmpi_job):
+                return partition
+        return self.default
+
+    def add(self, nmpi_job):
+        """Add a job to the queue of its partition."""
+        partition = self.route(nmpi_job)
+        partition.queued.append(nmpi_job)
+        logger.debug("Job {} queued in partition {}".format(nmpi_job['id'], partition.name))
+        return partition
+
+    def pop(self):
+        """
+        Return the next (nmpi_job, partition) to start, taking a slot in the
+        partition, or None if no job can be started now.
+        """
+        for partition in self._by_priority:
+            if partition.queued and partition.has_free_slot():
+                partition.running += 1
+                return partition.queued.popleft(), partition
+        return None
+
+    def pop_pack(self, key):
+        """
+        Like `pop()`, but return a list of up to `pack_size` jobs from the
+        same partition, all with the same `key(nmpi_job)`, each taking a slot,
+        together with the partition. Returns None if no job can be started now.
+        """
+        scheduled = self.pop()
+        if scheduled is None:
+            return None
+        nmpi_job, partition = scheduled
+        jobs = [nmpi_job]
+        if partition.pack_size > 1:
+            group = key(nmpi_job)
+            for other in list(partition.queued):
+                if len(jobs) >= partition.pack_size or not partition.has_free_slot():
+                    break
+                if key(other) == group:
+                    partition.queued.remove(other)
+                    partition.running += 1
+                    jobs.append(other)
+        return jobs, partition
+
+    def discard(self, job_ids):
+        """Remove jobs which have not been started yet. Returns the removed jobs."""
+        removed = []
+        for partition in self._by_priority:
+            for nmpi_job in list(partition.queued):
+                if nmpi_job['id'] in job_ids:
+                    partition.queued.remove(nmpi_job)
+                    removed.append(nmpi_job)
+        return removed
+
+    def started(self, partition):
+        """Take a slot for a job which was started outside `pop()` (e.g. reattached)."""
+        partition.running += 1
+
+    def release(self, partition):
+        """Free the slot taken by a job which has finished."""
+        partition.running = max(partition.running - 1, 0)
+
+    def queued(self):
+        return sum(len(partition.queued) for partition in self._by_priority)
+
+    def free_slots(self):
+        """
+        The number of jobs which could be started now, beyond those held by
+        the scheduler, or None if a partition has no limit on running jobs.
+        """
+        if any(partition.max_jobs is None for partition in self._by_priority):
+            return None
+        free = sum(max(partition.max_jobs - partition.running, 0) for partition in self._by_priority)
+        return max(free - self.queued(), 0)
+
+    def held_jobs(self):
+        """The jobs waiting for a free slot, in all partitions."""
+        return [nmpi_job for partition in self._by_priority for nmpi_job in partition.queued]
+
+    def all_partitions(self):
+        return list(self._by_priority)
+
+    def admission_limit(self, cluster_queued, queue_key=None):
+        """
+        Return how many more jobs the cluster can take, given the number of
+        jobs waiting in each cluster queue (a dict), or None if there is no
+        limit. Jobs held by the scheduler count as waiting in the cluster,
+        since they will be submitted.
+
+        `queue_key(partition)` gives the key of the cluster queue of a
+        partition in `cluster_queued`, by default its `queue`. Partitions
+        sending their jobs to the same cluster queue share its waiting jobs,
+        and their MAX_QUEUED limits add up.
+        """
+        if queue_key is None:
+            queue_key = lambda partition: partition.queue
+        queues = OrderedDict()
+        for partition in self._by_priority:
+            if partition.max_queued is None:
+                return None
+            queues.setdefault(queue_key(partition), []).append(partition)
+        room = 0
+        for key, partitions in queues.items():
+            waiting = cluster_queued.get(key, 0) + sum(len(partition.queued) for partition in partitions)
+            room += max(sum(partition.max_queued for partition in partitions) - waiting, 0)
+        return room
+
+
+class FairShare(object):
+    """
+    Chooses which of the jobs waiting on the queue server to claim next, by
+    weighted fair queuing over the users submitting them, so that one user
+    submitting many jobs does not hold up everyone else.
+
+    Jobs are grouped into flows by the values of `keys` (e.g. collab_id and
+    user_id). Each flow has a virtual finish time, which advances by
+    1/weight for each job claimed from it, and jobs are taken from the flow
+    with the earliest finish time, oldest job first. `weight(flow)` gives the
+    weight of a flow (a tuple of the values of `keys`), 1 for all if not
+    given. A flow which has had no jobs claimed for a while starts again at
+    the current virtual time, so it gets no credit for having been idle.
+
+    The finish times persist between calls of `select()`, so fairness holds
+    across successive windows of queued jobs. Choosing each job takes time
+    logarithmic in the number of flows.
+    """
+
+    def __init__(self, keys=("collab_id", "user_id"), weight=None):
+        self.keys = tuple(keys)
+        self.weight = weight
+        self.virtual_time = 0.0
+        self.finish = {}  # flow -> virtual finish time of its last claimed job
+
+    def flow(self, nmpi_job):
+        return tuple(nmpi_job.get(key) for key in self.keys)
+
+    def select(self, nmpi_jobs, limit=None, window=None):
+        """
+        Return up to `limit` of the jobs (all if None), in the order in which
+        they should be claimed, and charge their flows for them. If `window`
+        is given, only the oldest `window` jobs of each flow are considered,
+        so that a flow with many jobs cannot crowd the others out.
+        """
+        flows = OrderedDict()
+        for nmpi_job in sorted(nmpi_jobs, key=lambda job: job['id']):
+            jobs = flows.setdefault(self.flow(nmpi_job), deque())
+            if window is None or len(jobs) < window:
+                jobs.append(nmpi_job)
+        costs = {}
+        for flow in flows:
+            weight = self.weight(flow) if self.weight is not None else 1.0
+            costs[flow] = 1.0 / max(float(weight), 1e-6)
+        heap = []
+        for order, flow in enumerate(flows):
+            start = max(self.virtual_time, self.finish.get(flow, 0.0))
+            heap.append((start + costs[flow], order, flow))
+        heapq.heapify(heap)
+        selected = []
+        while heap and (limit is None or len(selected) < limit):
+            finish, order, flow = heapq.heappop(heap)
+            selected.append(flows[flow].popleft())
+            self.finish[flow] = finish
+            self.virtual_time = max(self.virtual_time, finish - costs[flow])
+            if flows[flow]:
+                heapq.heappush(heap, (finish + costs[flow], order, flow))
+        # flows with no claimed jobs ahead of the virtual time need no memory
+        for flow in [flow for flow, finish in self.finish.items() if finish <= self.virtual_time]:
+            del self.finish[flow]
+        return selected
+
+
+def _optional_int(value):
+    return None if value is None else int(value)
+
+
+def scheduler_from_config(config):
+    """Build a Scheduler from the partitions defined in the runner configuration."""
+    partitions = []
+    for name in (config.get('PARTITIONS') or "").split(","):
+        name = name.strip()
+        if not name:
+            continue
+        prefix = "PARTITION_{}_".format(name)
+        partitions.append(Partition(name,
+                                    queue=config.get(prefix + 'QUEUE', config.get('JOB_QUEUE')),
+                                    adaptor=config.get(prefix + 'ADAPTOR', config.get('JOB_SERVICE_ADAPTOR')),
+                                    max_jobs=_optional_int(config.get(prefix + 'MAX_JOBS')),
+                                    priority=int(config.get(prefix + 'PRIORITY', 0)),
+                                    rules=parse_rules(config.get(prefix + 'RULES')),
+                                    max_queued=_optional_int(config.get(prefix + 'MAX_QUEUED')),
+                                    pack_size=int(config.get(prefix + 'PACK_SIZE', 1)),
+                                    pack_parallel=int(config.get(prefix + 'PACK_PARALLEL', 1)),
+                                    wall_time_limit=_optional_int(config.get(prefix + 'WALL_TIME_LIMIT',
+                                                                             config.get('WALL_TIME_LIMIT'))),
+                                    scratch_directory=config.get(prefix + 'SCRATCH_DIRECTORY')))
+    default = Partition("default",
+                        queue=config.get('JOB_QUEUE'),
+                        adaptor=config.get('JOB_SERVICE_ADAPTOR'),
+                        max_jobs=_optional_int(config.get('MAX_RUNNING_JOBS')),
+                        priority=int(config.get('DEFAULT_PARTITION_PRIORITY', 0)),
+                        max_queued=_optional_int(config.get('MAX_QUEUED_JOBS')),
+                        pack_size=int(config.get('PACK_SIZE', 1)),
+                        pack_parallel=int(config.get('PACK_PARALLEL', 1)),
+                        wall_time_limit=_optional_int(config.get('WALL_TIME_LIMIT')),
+                        scratch_directory=config.get('SCRATCH_DIRECTORY'))
+    return Scheduler(partitions, default)
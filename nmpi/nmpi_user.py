@@ -32,8 +32,10 @@ except ImportError: # Py3
     from urllib.parse import urlparse, urlencode
     from urllib.request import urlretrieve
 import errno
+import shutil
 import requests
 from requests.auth import AuthBase
+from nmpi.nmpi_files import file_checksum
 
 logger = logging.getLogger("NMPI")
 
@@ -65,6 +67,20 @@ def _mkdir_p(path):
             raise
 
 
+def _check_file(local_path, checksum):
+    """
+    Whether the file at `local_path` has the given checksum, as recorded
+    for a data item ("<algorithm>:<hex digest>"). Returns None if this
+    cannot be checked, because the algorithm is not available.
+    """
+    if not os.path.isfile(local_path):
+        return False
+    try:
+        return file_checksum(local_path, checksum.split(":", 1)[0]) == checksum
+    except ValueError:
+        return None
+
+
 class Client(object):
     """
     Client for interacting with the Neuromorphic Computing Platform of
@@ -405,12 +421,17 @@ class Client(object):
         """
         Download output data files produced by a given job to a local directory.
 
+        Data items with a checksum are checked once downloaded, and are not
+        downloaded again if the local file already has that checksum, or if
+        a file with the same contents has just been downloaded.
+
         *Arguments*:
             :job: a full job description (dict), as returned by `get_job()`.
             :local_dir: path to a directory into which files shall be saved.
             :include_input_data: also download input data files.
         """
         filenames = []
+        downloaded = {}  # checksum: local path
         datalist = job["output_data"]
         if include_input_data:
             datalist.extend(job["input_data"])
@@ -431,7 +452,18 @@ class Client(object):
                 local_path = os.path.join(local_dir, "job_{}".format(job["id"]), relative_path)
                 dir = os.path.dirname(local_path)
                 _mkdir_p(dir)
-                urlretrieve(url, local_path)
+                checksum = dataitem.get("checksum")
+                if checksum and _check_file(local_path, checksum):
+                    logger.debug("{} is up to date".format(local_path))
+                elif checksum in downloaded:
+                    shutil.copyfile(downloaded[checksum], local_path)
+                else:
+                    urlretrieve(url, local_path)
+                    if checksum and _check_file(local_path, checksum) is False:
+                        os.remove(local_path)
+                        raise Exception("Checksum mismatch for {}, expected {}".format(url, checksum))
+                if checksum:
+                    downloaded[checksum] = local_path
                 filenames.append(local_path)
 
         return filenames
@@ -455,11 +487,14 @@ class Client(object):
         """
         return self._query(self.job_server + "/copydata/{}/{}".format(destination, job_id))
 
-    def create_data_item(self, url):
+    def create_data_item(self, url, checksum=None):
         """
-        Register a data item with the platform.
+        Register a data item with the platform, with the checksum of its
+        contents if given (see `download_data()`).
         """
         data_item = {"url": url}
+        if checksum:
+            data_item["checksum"] = checksum
         result = self._post(self.job_server + self.resource_map["dataitem"], data_item)
         return result
 
@@ -0,0 +1,90 @@
+"""
+Tests of the accounting of the resources used by jobs (nmpi_accounting)
+"""
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from nmpi import nmpi_accounting
+from nmpi.nmpi_accounting import parse_slurm_duration, sacct_usage, usage_in_units, platform_units
+
+SACCT_OUTPUT = """\
+101|COMPLETED|3600|01:50:00||2
+101.batch|COMPLETED|3600|00:50:00|1000K|2
+101.0|COMPLETED|3500|01:00:00|2G|2
+102|FAILED|90|01:30.500||1
+102.batch|FAILED|90|01:30.500|512M|1
+103|RUNNING|30|00:00:10||4
+104|CANCELLED by 1000|86400|1-02:03:04||8
+"""
+
+
+class AccountingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.environ["PATH"]
+
+    def tearDown(self):
+        os.environ["PATH"] = self.path
+        shutil.rmtree(self.tmp_dir)
+
+    def fake_sacct(self, output):
+        """Put a sacct on the PATH which prints `output`, and records its arguments."""
+        script = os.path.join(self.tmp_dir, "sacct")
+        with open(os.path.join(self.tmp_dir, "output"), "w") as fp:
+            fp.write(output)
+        with open(script, "w") as fp:
+            fp.write("#!/bin/sh\necho \"$@\" >> {0}/calls\ncat {0}/output\n".format(self.tmp_dir))
+        os.chmod(script, os.stat(script).st_mode | stat.S_IEXEC)
+        os.environ["PATH"] = self.tmp_dir + os.pathsep + self.path
+
+    def calls(self):
+        with open(os.path.join(self.tmp_dir, "calls")) as fp:
+            return fp.read().splitlines()
+
+    def test_parse_slurm_duration(self):
+        self.assertEqual(parse_slurm_duration("1-02:03:04"), 93784)
+        self.assertEqual(parse_slurm_duration("02:03:04"), 7384)
+        self.assertEqual(parse_slurm_duration("03:04.500"), 184.5)
+        self.assertIsNone(parse_slurm_duration(""))
+
+    def test_sacct_usage(self):
+        self.fake_sacct(SACCT_OUTPUT)
+        usage = sacct_usage(["101", "102", "103"])
+        self.assertEqual(len(self.calls()), 1)
+        self.assertIn("--jobs 101,102,103", self.calls()[0])
+        self.assertEqual(sorted(usage), ["101", "102", "104"])  # 103 has not ended
+        self.assertEqual(usage["101"], {"wall_time": 3600.0, "cpu_time": 6600.0,
+                                        "max_rss": 2 * 1024 ** 3, "cores": 2})
+        self.assertEqual(usage["102"]["cpu_time"], 90.5)
+        self.assertEqual(usage["102"]["max_rss"], 512 * 1024 ** 2)
+        self.assertEqual(usage["104"]["cpu_time"], 93784)
+        self.assertIsNone(usage["104"]["max_rss"])
+        self.assertEqual(sacct_usage([]), {})
+        self.assertEqual(len(self.calls()), 1)
+
+    def test_usage_in_units(self):
+        usage = {"wall_time": 7200.0, "cpu_time": 7000.0, "max_rss": None, "cores": 4}
+        self.assertEqual(usage_in_units(usage, "hours"), 2.0)
+        self.assertEqual(usage_in_units(usage, "core-hours"), 8.0)
+        self.assertEqual(usage_in_units(usage, "wafer-hours"), 2.0)
+        self.assertEqual(usage_in_units(usage, "wafer-hours", {"wafers": [20, 21, 24]}), 6.0)
+        self.assertEqual(usage_in_units(dict(usage, wall_time=None), "core-hours"), 0.0)
+        self.assertRaises(ValueError, usage_in_units, usage, "furlongs")
+
+    def test_platform_units(self):
+        self.assertEqual(platform_units("BrainScaleS"), "wafer-hours")
+        self.assertEqual(platform_units("SpiNNaker"), "core-hours")
+        self.assertEqual(platform_units("SpiNNaker", "hours"), "hours")
+        self.assertEqual(platform_units("clusteru"), "hours")
+
+    def test_rusage_usage(self):
+        usage = nmpi_accounting.rusage_usage({"ru_utime": 1.5, "ru_stime": 0.5, "ru_maxrss": 2048}, 3.0, 2)
+        self.assertEqual(usage, {"wall_time": 3.0, "cpu_time": 2.0, "max_rss": 2 * 1024 ** 2, "cores": 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,292 @@
+"""
+Tests of the caches kept by the job runner.
+
+No network access or batch system is needed, but Git must be installed.
+
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+import zipfile
+from nmpi import nmpi_cache
+
+
+def git(*args):
+    subprocess.check_call(("git",) + args)
+
+
+class ParseSizeTest(unittest.TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(nmpi_cache.parse_size("1024"), 1024)
+        self.assertEqual(nmpi_cache.parse_size("500M"), 500 * 2**20)
+        self.assertEqual(nmpi_cache.parse_size("2GB"), 2 * 2**30)
+        self.assertEqual(nmpi_cache.parse_size("1.5k"), 1536)
+        self.assertIsNone(nmpi_cache.parse_size(None))
+
+
+class GitMirrorCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.tmpdir, "repo")
+        os.mkdir(self.repo)
+        git("-C", self.repo, "init", "--quiet")
+        self._commit("run.py", "print('hello')\n")
+        self.cache = nmpi_cache.GitMirrorCache(os.path.join(self.tmpdir, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _commit(self, name, content):
+        with open(os.path.join(self.repo, name), "w") as fp:
+            fp.write(content)
+        git("-C", self.repo, "add", name)
+        git("-C", self.repo, "-c", "user.name=test", "-c", "user.email=test@example.com",
+            "commit", "--quiet", "-m", "add " + name)
+
+    def test_clone_via_mirror(self):
+        target = os.path.join(self.tmpdir, "job_1")
+        self.assertEqual(self.cache.clone(self.repo, target), 0)
+        self.assertTrue(os.path.exists(os.path.join(target, "run.py")))
+        origin = subprocess.check_output(["git", "-C", target, "remote", "get-url", "origin"])
+        self.assertEqual(origin.decode().strip(), self.repo)
+
+        # a second clone picks up new commits
+        self._commit("model.py", "x = 1\n")
+        target = os.path.join(self.tmpdir, "job_2")
+        self.assertEqual(self.cache.clone(self.repo, target), 0)
+        self.assertTrue(os.path.exists(os.path.join(target, "model.py")))
+        self.assertEqual(len(self.cache.entries()), 1)
+
+    def test_submodules_cloned_via_mirrors(self):
+        submodule_repo = os.path.join(self.tmpdir, "library")
+        os.mkdir(submodule_repo)
+        git("-C", submodule_repo, "init", "--quiet")
+        with open(os.path.join(submodule_repo, "lib.py"), "w") as fp:
+            fp.write("y = 2\n")
+        git("-C", submodule_repo, "add", "lib.py")
+        git("-C", submodule_repo, "-c", "user.name=test", "-c", "user.email=test@example.com",
+            "commit", "--quiet", "-m", "add lib.py")
+        git("-C", self.repo, "-c", "protocol.file.allow=always",
+            "submodule", "--quiet", "add", submodule_repo, "lib")
+        git("-C", self.repo, "-c", "user.name=test", "-c", "user.email=test@example.com",
+            "commit", "--quiet", "-m", "add submodule")
+
+        target = os.path.join(self.tmpdir, "job_1")
+        self.assertEqual(self.cache.clone(self.repo, target), 0)
+        self.assertTrue(os.path.exists(os.path.join(target, "lib", "lib.py")))
+        self.assertEqual(sorted(name for _, _, name in self.cache.entries()),
+                         sorted([self.cache.entry_name(self.repo), self.cache.entry_name(submodule_repo)]))
+        # the submodule refers to its own repository, not to the mirror
+        origin = subprocess.check_output(["git", "-C", os.path.join(target, "lib"), "remote", "get-url", "origin"])
+        self.assertEqual(origin.decode().strip(), submodule_repo)
+
+    def test_clone_failure(self):
+        target = os.path.join(self.tmpdir, "job_1")
+        self.assertNotEqual(self.cache.clone(os.path.join(self.tmpdir, "nonexistent"), target), 0)
+        self.assertEqual(self.cache.entries(), [])
+
+    def test_evict(self):
+        self.cache.max_size = 1
+        other_repo = os.path.join(self.tmpdir, "other")
+        git("clone", "--quiet", self.repo, other_repo)
+        self.assertEqual(self.cache.clone(self.repo, os.path.join(self.tmpdir, "job_1")), 0)
+        time.sleep(0.01)
+        self.assertEqual(self.cache.clone(other_repo, os.path.join(self.tmpdir, "job_2")), 0)
+        # only the most recently used mirror is kept
+        self.assertEqual([name for _, _, name in self.cache.entries()],
+                         [self.cache.entry_name(other_repo)])
+
+
+class ArchiveCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.tmpdir, "code.zip")
+        self._write_archive("version 1")
+        self.url = "file://" + self.archive
+        self.cache = nmpi_cache.ArchiveCache(os.path.join(self.tmpdir, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write_archive(self, content):
+        with zipfile.ZipFile(self.archive, "w") as zf:
+            zf.writestr("run.py", content)
+            zf.writestr("lib/model.py", "x = 1")
+
+    def _read(self, target):
+        with open(os.path.join(target, "run.py")) as fp:
+            return fp.read()
+
+    def test_fetch(self):
+        target1 = os.path.join(self.tmpdir, "job_1")
+        self.cache.fetch(self.url, target1)
+        self.assertEqual(self._read(target1), "version 1")
+        self.assertTrue(os.path.exists(os.path.join(target1, "lib", "model.py")))
+
+        # unchanged archive: the job gets copies of the cached files,
+        # which it can modify without affecting other jobs
+        target2 = os.path.join(self.tmpdir, "job_2")
+        self.cache.fetch(self.url, target2)
+        self.assertNotEqual(os.stat(os.path.join(target1, "run.py")).st_ino,
+                            os.stat(os.path.join(target2, "run.py")).st_ino)
+        with open(os.path.join(target2, "run.py"), "w") as fp:
+            fp.write("modified by job 2")
+        target2b = os.path.join(self.tmpdir, "job_2b")
+        self.cache.fetch(self.url, target2b)
+        self.assertEqual(self._read(target2b), "version 1")
+
+        # changed archive: fetched again, earlier jobs are unaffected
+        time.sleep(0.01)
+        self._write_archive("version 2 is longer")
+        target3 = os.path.join(self.tmpdir, "job_3")
+        self.cache.fetch(self.url, target3)
+        self.assertEqual(self._read(target3), "version 2 is longer")
+        self.assertEqual(self._read(target1), "version 1")
+        self.assertEqual(len(self.cache.entries()), 1)
+
+
+class InputDataCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, "cache")
+        self.cache = nmpi_cache.InputDataCache(self.cache_dir)
+        self.sources = {}
+        for name, content in (("stimulus1.dat", "1 2 3\n"),
+                              ("stimulus2.dat", "4 5 6\n"),
+                              ("copy_of_stimulus1.dat", "1 2 3\n")):
+            self.sources[name] = os.path.join(self.tmpdir, name)
+            with open(self.sources[name], "w") as fp:
+                fp.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _fetch(self, name, job_id, cache=None):
+        target_dir = os.path.join(self.tmpdir, "job_{}".format(job_id))
+        if not os.path.exists(target_dir):
+            os.mkdir(target_dir)
+        target = os.path.join(target_dir, name)
+        (cache or self.cache).fetch("file://" + self.sources[name], target)
+        return target
+
+    def test_fetch_stores_files_once(self):
+        target1 = self._fetch("stimulus1.dat", 1)
+        target2 = self._fetch("stimulus1.dat", 2)
+        with open(target2) as fp:
+            self.assertEqual(fp.read(), "1 2 3\n")
+        self.assertNotEqual(os.stat(target1).st_ino, os.stat(target2).st_ino)
+        # identical content from another URL is stored once
+        self._fetch("copy_of_stimulus1.dat", 3)
+        self._fetch("stimulus2.dat", 3)
+        self.assertEqual(len(self.cache.entries()), 2)
+
+    def test_cache_survives_restart(self):
+        target1 = self._fetch("stimulus1.dat", 1)
+        new_cache = nmpi_cache.InputDataCache(self.cache_dir)
+        target2 = self._fetch("stimulus1.dat", 2, cache=new_cache)
+        with open(target2) as fp:
+            self.assertEqual(fp.read(), "1 2 3\n")
+        self.assertEqual(len(self.cache.entries()), 1)
+
+    def test_job_modifying_its_file_does_not_affect_others(self):
+        target1 = self._fetch("stimulus1.dat", 1)
+        os.chmod(target1, 0o644)
+        with open(target1, "w") as fp:
+            fp.write("corrupted by job 1")
+        target2 = self._fetch("stimulus1.dat", 2)
+        with open(target2) as fp:
+            self.assertEqual(fp.read(), "1 2 3\n")
+
+    def test_changed_file_is_fetched_again(self):
+        self._fetch("stimulus1.dat", 1)
+        time.sleep(0.01)
+        with open(self.sources["stimulus1.dat"], "w") as fp:
+            fp.write("7 8 9 10\n")
+        target = self._fetch("stimulus1.dat", 2)
+        with open(target) as fp:
+            self.assertEqual(fp.read(), "7 8 9 10\n")
+
+    def test_evict(self):
+        self.cache.max_size = 7
+        self._fetch("stimulus1.dat", 1)
+        time.sleep(0.01)
+        self._fetch("stimulus2.dat", 1)
+        self.assertEqual(len(self.cache.entries()), 1)
+        # an evicted file is downloaded again
+        target = self._fetch("stimulus1.dat", 2)
+        with open(target) as fp:
+            self.assertEqual(fp.read(), "1 2 3\n")
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = nmpi_cache.ResultCache(os.path.join(self.tmpdir, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _job_directory(self, job_id, code="print(42)\n"):
+        working_directory = os.path.join(self.tmpdir, "job_{}".format(job_id))
+        os.makedirs(os.path.join(working_directory, ".git"))
+        with open(os.path.join(working_directory, "run.py"), "w") as fp:
+            fp.write(code)
+        with open(os.path.join(working_directory, ".git", "index"), "w") as fp:
+            fp.write(str(job_id))
+        return working_directory
+
+    def _write(self, file_path, content):
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        with open(file_path, "w") as fp:
+            fp.write(content)
+
+    def _read(self, file_path):
+        with open(file_path) as fp:
+            return fp.read()
+
+    def test_job_key(self):
+        parameters = {"arguments": ["run.py", "nest"], "hardware_config": {"a": 1}}
+        key1 = self.cache.job_key(parameters, self._job_directory(1))
+        time.sleep(0.01)
+        # neither the timestamps nor the Git metadata matter
+        self.assertEqual(self.cache.job_key(parameters, self._job_directory(2)), key1)
+        self.assertNotEqual(self.cache.job_key(parameters, self._job_directory(3, "print(43)\n")), key1)
+        self.assertNotEqual(self.cache.job_key(dict(parameters, hardware_config={"a": 2}),
+                                               self._job_directory(4)), key1)
+
+    def test_store_and_fetch(self):
+        job1 = self._job_directory(1)
+        self._write(os.path.join(job1, "results", "data.txt"), "1 2 3\n")
+        self._write(os.path.join(job1, "saga_1.out"), "42\n")
+        key = self.cache.job_key({}, job1)
+        self.assertTrue(self.cache.store(key, job1, [os.path.join("results", "data.txt")],
+                                         {"stdout": os.path.join(job1, "saga_1.out")}, job_id=1))
+        job2 = self._job_directory(2)
+        self.assertIsNone(self.cache.fetch("other key", job2, {}))
+        meta = self.cache.fetch(key, job2, {"stdout": os.path.join(job2, "saga_2.out")})
+        self.assertEqual(meta["job_id"], 1)
+        self.assertEqual(self._read(os.path.join(job2, "results", "data.txt")), "1 2 3\n")
+        self.assertEqual(self._read(os.path.join(job2, "saga_2.out")), "42\n")
+        # the copy is independent of the cache
+        self.assertNotEqual(os.stat(os.path.join(job2, "results", "data.txt")).st_ino,
+                            os.stat(os.path.join(job1, "results", "data.txt")).st_ino)
+
+    def test_evict(self):
+        self.cache.max_size = 10
+        job1 = self._job_directory(1)
+        self._write(os.path.join(job1, "out.txt"), "12345678")
+        self.cache.store("key1", job1, ["out.txt"], {})
+        time.sleep(0.01)
+        self.cache.store("key2", job1, ["out.txt"], {})
+        self.assertEqual(len(self.cache.entries()), 1)
+        self.assertIsNone(self.cache.fetch("key1", self._job_directory(2), {}))
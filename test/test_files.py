@@ -0,0 +1,201 @@
+"""
+Tests of the filesystem helpers used by the job runner.
+
+No network access or batch system is needed.
+
+"""
+
+import os
+import io
+import hashlib
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from nmpi import nmpi_files
+
+
+class CopyFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmpdir, "source")
+        self.target_dir = os.path.join(self.tmpdir, "target")
+        self.files = ["a.txt", os.path.join("spikes", "pop1.dat"),
+                      os.path.join("spikes", "deep", "pop2.dat")]
+        for relative_path in self.files:
+            full_path = os.path.join(self.source_dir, relative_path)
+            if not os.path.exists(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            with open(full_path, "w") as fp:
+                fp.write(relative_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _check_copied(self, relative_paths):
+        for relative_path in relative_paths:
+            with open(os.path.join(self.target_dir, relative_path)) as fp:
+                self.assertEqual(fp.read(), relative_path)
+
+    def test_copy_files_with_hardlinks(self):
+        failures = nmpi_files.copy_files(self.source_dir, self.target_dir, self.files)
+        self.assertEqual(failures, [])
+        self._check_copied(self.files)
+        self.assertEqual(os.stat(os.path.join(self.target_dir, "a.txt")).st_ino,
+                         os.stat(os.path.join(self.source_dir, "a.txt")).st_ino)
+
+    def test_copy_files_without_hardlinks(self):
+        failures = nmpi_files.copy_files(self.source_dir, self.target_dir, self.files,
+                                         threads=2, use_hardlinks=False)
+        self.assertEqual(failures, [])
+        self._check_copied(self.files)
+        self.assertNotEqual(os.stat(os.path.join(self.target_dir, "a.txt")).st_ino,
+                            os.stat(os.path.join(self.source_dir, "a.txt")).st_ino)
+
+    def test_copy_files_reports_each_failure(self):
+        failures = nmpi_files.copy_files(self.source_dir, self.target_dir,
+                                         ["missing1.txt"] + self.files + ["missing2.txt"])
+        self.assertEqual(sorted(f[0] for f in failures), ["missing1.txt", "missing2.txt"])
+        self._check_copied(self.files)
+
+    def test_copy_files_with_checksums(self):
+        for use_hardlinks in (True, False):
+            checksums = {}
+            failures = nmpi_files.copy_files(self.source_dir, self.target_dir, self.files, threads=2,
+                                             use_hardlinks=use_hardlinks, checksums=checksums)
+            self.assertEqual(failures, [])
+            self._check_copied(self.files)
+            self.assertEqual(checksums, dict((relative_path, nmpi_files.file_checksum(
+                os.path.join(self.source_dir, relative_path))) for relative_path in self.files))
+
+    def test_checksum_files(self):
+        checksums, failures = nmpi_files.checksum_files(self.source_dir, self.files + ["missing.txt"])
+        self.assertEqual(sorted(checksums), sorted(self.files))
+        self.assertEqual([f[0] for f in failures], ["missing.txt"])
+
+    def test_file_checksum(self):
+        file_path = os.path.join(self.source_dir, "a.txt")
+        checksum = nmpi_files.file_checksum(file_path)
+        self.assertTrue(checksum.startswith(nmpi_files.CHECKSUM_ALGORITHM + ":"))
+        self.assertEqual(nmpi_files.file_checksum(file_path, "sha256"),
+                         "sha256:" + hashlib.sha256(b"a.txt").hexdigest())
+        self.assertRaises(ValueError, nmpi_files.file_checksum, file_path, "nosuchhash")
+
+    def test_copy_file_overwrites(self):
+        target = os.path.join(self.tmpdir, "b.txt")
+        with open(target, "w") as fp:
+            fp.write("old")
+        nmpi_files.copy_file(os.path.join(self.source_dir, "a.txt"), target)
+        with open(target) as fp:
+            self.assertEqual(fp.read(), "a.txt")
+
+    def test_make_directories(self):
+        directories = [os.path.join(self.tmpdir, "x", "y", "z"),
+                       os.path.join(self.tmpdir, "x", "y"),
+                       os.path.join(self.tmpdir, "x", "w")]
+        nmpi_files.make_directories(directories)
+        nmpi_files.make_directories(directories)
+        for directory in directories:
+            self.assertTrue(os.path.isdir(directory))
+
+
+class ArchiveExtractionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.target_dir = os.path.join(self.tmpdir, "job_42")
+        os.mkdir(self.target_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _tar(self, members, name="code.tar.gz"):
+        archive = os.path.join(self.tmpdir, name)
+        with tarfile.open(archive, "w:gz") as tf:
+            for member_name, content in members:
+                info = tarfile.TarInfo(member_name)
+                if content.startswith("->"):
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = content[2:]
+                    tf.addfile(info)
+                else:
+                    data = content.encode("utf-8")
+                    info.size = len(data)
+                    tf.addfile(info, io.BytesIO(data))
+        return archive
+
+    def _zip(self, members, name="code.zip"):
+        archive = os.path.join(self.tmpdir, name)
+        with zipfile.ZipFile(archive, "w") as zf:
+            for member_name, content in members:
+                zf.writestr(member_name, content)
+        return archive
+
+    def test_fetch_tar(self):
+        archive = self._tar([("run.py", "import sim"), ("lib/model.py", "x = 1")])
+        nmpi_files.fetch_archive("file://" + archive, self.target_dir)
+        with open(os.path.join(self.target_dir, "lib", "model.py")) as fp:
+            self.assertEqual(fp.read(), "x = 1")
+
+    def test_fetch_zip(self):
+        archive = self._zip([("run.py", "import sim"), ("lib/model.py", "x = 1")])
+        nmpi_files.fetch_archive("file://" + archive, self.target_dir)
+        with open(os.path.join(self.target_dir, "run.py")) as fp:
+            self.assertEqual(fp.read(), "import sim")
+
+    def test_path_traversal_rejected(self):
+        for members in ([("../evil.py", "x")],
+                        [("/tmp/evil.py", "x")],
+                        [("lib/../../evil.py", "x")],
+                        [("link", "->../../etc")]):
+            archive = self._tar(members)
+            self.assertRaises(ValueError, nmpi_files.fetch_archive, "file://" + archive, self.target_dir)
+        archive = self._zip([("../evil.py", "x")])
+        self.assertRaises(ValueError, nmpi_files.fetch_archive, "file://" + archive, self.target_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "evil.py")))
+
+    def test_open_url_validator(self):
+        archive = self._zip([("run.py", "import sim")])
+        fileobj, validator = nmpi_files.open_url("file://" + archive)
+        fileobj.close()
+        self.assertIsNotNone(validator)
+        fileobj, same_validator = nmpi_files.open_url("file://" + archive, validator)
+        self.assertIsNone(fileobj)
+        self.assertEqual(same_validator, validator)
+
+
+class ReadHeadTailTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.file_path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.file_path)
+
+    def _write(self, content):
+        with open(self.file_path, "w") as fp:
+            fp.write(content)
+
+    def test_short_file(self):
+        self._write("all is well\n")
+        self.assertEqual(nmpi_files.read_head_tail(self.file_path, 100), "all is well\n")
+
+    def test_long_file(self):
+        content = "".join("line {}\n".format(i) for i in range(10000))
+        self._write(content)
+        head_tail = nmpi_files.read_head_tail(self.file_path, 100)
+        self.assertEqual(head_tail,
+                         content[:50] + nmpi_files.TRUNCATION_MARKER + content[-50:])
+
+    def test_compress_file(self):
+        import gzip
+        content = "spam\n" * 1000
+        self._write(content)
+        target = self.file_path + ".gz"
+        nmpi_files.compress_file(self.file_path, target)
+        with gzip.open(target) as fp:
+            self.assertEqual(fp.read().decode("utf-8"), content)
+        os.remove(target)
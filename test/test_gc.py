@@ -0,0 +1,157 @@
+"""
+Tests of the collection of the directories of finished jobs (nmpi_gc)
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import time
+import unittest
+from nmpi import nmpi_gc, nmpi_pack
+from nmpi.nmpi_gc import DirectoryCollector, Throttle, mark_finished, clear_finished
+
+
+class DirectoryCollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.work = os.path.join(self.tmp_dir, "work")
+        self.data = os.path.join(self.tmp_dir, "data")
+        self.output = os.path.join(self.tmp_dir, "output")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_job(self, job_id, size=10, finished=None, root=None):
+        directory = os.path.join(root or self.work, "job_{}".format(job_id))
+        os.makedirs(os.path.join(directory, "sub"))
+        with open(os.path.join(directory, "sub", "data.bin"), "wb") as fp:
+            fp.write(b"x" * size)
+        if finished is not None:
+            with open(os.path.join(directory, nmpi_gc.FINISHED_FILE), "w") as fp:
+                json.dump({"finished": finished}, fp)
+        return directory
+
+    def test_mark_finished(self):
+        directory = self.make_job(1)
+        mark_finished(directory)
+        collector = DirectoryCollector(self.work)
+        self.assertEqual([job[2] for job in collector.finished_jobs()], [directory])
+        clear_finished(directory)
+        self.assertEqual(collector.finished_jobs(), [])
+
+    def test_collect_by_age(self):
+        now = time.time()
+        old = self.make_job(1, finished=now - 7200)
+        recent = self.make_job(2, finished=now - 60)
+        unfinished = self.make_job(3)
+        old_output = self.make_job(1, root=self.output)
+        collector = DirectoryCollector(self.work, output_directory=self.output, max_age=3600)
+        self.assertEqual(collector.collect(now), [old])
+        self.assertFalse(os.path.exists(old))
+        self.assertFalse(os.path.exists(old_output))
+        self.assertTrue(os.path.exists(recent))
+        self.assertTrue(os.path.exists(unfinished))
+
+    def test_collect_by_size(self):
+        now = time.time()
+        jobs = [self.make_job(i, size=1000, finished=now - 100 * (5 - i)) for i in range(5)]
+        self.make_job(5, size=10000)  # unfinished jobs do not count
+        collector = DirectoryCollector(self.work, max_size="3500")
+        self.assertEqual(collector.collect(now), jobs[:2])
+        self.assertEqual(sorted(os.listdir(self.work)), ["job_2", "job_3", "job_4", "job_5"])
+        # the sizes are remembered
+        with open(os.path.join(jobs[4], nmpi_gc.FINISHED_FILE)) as fp:
+            self.assertGreaterEqual(json.load(fp)["size"], 1000)
+
+    def test_collect_packs(self):
+        jobs = [self.make_job(i) for i in (1, 2)]
+        descriptions = []
+        for directory in jobs:
+            description = type("Description", (object,), {})()
+            description.working_directory = directory
+            description.executable = "true"
+            description.arguments = []
+            description.environment = None
+            description.output = "out"
+            description.error = "err"
+            descriptions.append(description)
+        pack_directory = os.path.join(self.work, "pack_1")
+        nmpi_pack.write_pack(pack_directory, descriptions)
+        collector = DirectoryCollector(self.work)
+        mark_finished(jobs[0])
+        self.assertEqual(collector.collect(), [])
+        mark_finished(jobs[1])
+        self.assertEqual(collector.collect(), [pack_directory])
+
+    def test_collect_data_directory(self):
+        now = time.time()
+        old = self.make_job(1, root=self.data)
+        os.utime(old, (now - 7200, now - 7200))
+        recent = self.make_job(2, root=self.data)
+        self.assertEqual(DirectoryCollector(self.work, data_directory=self.data).collect(now), [])
+        collector = DirectoryCollector(self.work, data_directory=self.data, data_max_age=3600)
+        self.assertEqual(collector.collect(now), [old])
+        self.assertTrue(os.path.exists(recent))
+
+    def test_shared_data_directory(self):
+        # the sample configuration: results are published straight from the working directories
+        now = time.time()
+        old = self.make_job(1, finished=now - 7200)
+        collector = nmpi_gc.collector_from_config({"WORKING_DIRECTORY": self.work, "DATA_DIRECTORY": self.work,
+                                                   "GC_INTERVAL": "60", "WORKING_DIRECTORY_MAX_AGE": "3600",
+                                                   "WORKING_DIRECTORY_SIZE": "1"})
+        self.assertEqual(collector.collect(now), [])
+        self.assertTrue(os.path.exists(old))
+        self.assertEqual(DirectoryCollector(self.work, data_directory=self.work, max_age=3600).collect(now), [])
+        self.assertTrue(os.path.exists(old))
+        # only removed once DATA_DIRECTORY_MAX_AGE has passed
+        os.utime(old, (now - 7200, now - 7200))
+        collector.data_max_age = 3600
+        self.assertEqual(collector.collect(now), [old])
+
+    def test_output_directory_is_data_directory(self):
+        now = time.time()
+        old = self.make_job(1, finished=now - 7200)
+        output = self.make_job(1, root=self.data)
+        collector = nmpi_gc.collector_from_config({"WORKING_DIRECTORY": self.work, "DATA_DIRECTORY": self.data,
+                                                   "OUTPUT_DIRECTORY": self.data, "GC_INTERVAL": "60",
+                                                   "WORKING_DIRECTORY_MAX_AGE": "3600"})
+        self.assertEqual(collector.collect(now), [old])
+        self.assertTrue(os.path.exists(os.path.join(output, "sub", "data.bin")))
+        # also when the collector is given the directories directly
+        old = self.make_job(2, finished=now - 7200)
+        output = self.make_job(2, root=self.data)
+        collector = DirectoryCollector(self.work, data_directory=self.data, output_directory=self.data, max_age=3600)
+        self.assertEqual(collector.collect(now), [old])
+        self.assertTrue(os.path.exists(output))
+
+    def test_rate_limit(self):
+        directory = os.path.join(self.tmp_dir, "many")
+        os.makedirs(directory)
+        for i in range(30):
+            open(os.path.join(directory, str(i)), "w").close()
+        start = time.time()
+        self.assertTrue(nmpi_gc.remove_tree(directory, Throttle(batch_size=10, rate=100)))
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertFalse(os.path.exists(directory))
+
+    def test_background_collection(self):
+        old = self.make_job(1, finished=time.time() - 7200)
+        collector = nmpi_gc.collector_from_config({"WORKING_DIRECTORY": self.work, "GC_INTERVAL": "60",
+                                                   "WORKING_DIRECTORY_MAX_AGE": "3600"})
+        collector.start()
+        try:
+            for i in range(100):
+                if not os.path.exists(old):
+                    break
+                time.sleep(0.05)
+        finally:
+            collector.stop()
+        self.assertFalse(os.path.exists(old))
+        self.assertIsNone(nmpi_gc.collector_from_config({"WORKING_DIRECTORY": self.work}))
+
+
+if __name__ == "__main__":
+    unittest.main()
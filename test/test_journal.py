@@ -0,0 +1,67 @@
+"""
+Tests of the runner journal (nmpi_journal)
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from nmpi import nmpi_journal
+from nmpi.nmpi_journal import RunnerJournal, JournalLocked
+
+
+class RunnerJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, "journal.sqlite")
+        self.journal = RunnerJournal(self.db_path)
+
+    def tearDown(self):
+        if self.journal is not None:
+            self.journal.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_record_and_update(self):
+        job = {"id": 42, "code": "print(42)"}
+        self.journal.record(job, nmpi_journal.STAGING, working_directory="/tmp/job_42")
+        self.journal.record(job, nmpi_journal.RUNNING, saga_job_id="[slurm://localhost]-[123]",
+                            start_time=1000.0)
+        entries = self.journal.jobs()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]["stage"], nmpi_journal.RUNNING)
+        self.assertEqual(entries[0]["saga_job_id"], "[slurm://localhost]-[123]")
+        self.assertEqual(entries[0]["working_directory"], "/tmp/job_42")
+        self.assertEqual(entries[0]["start_time"], 1000.0)
+        self.assertEqual(entries[0]["nmpi_job"], job)
+
+    def test_job_name(self):
+        job = {"id": 42}
+        self.journal.record(job, nmpi_journal.SUBMITTING, job_name="nmpi_42")
+        self.journal.record(job, nmpi_journal.RUNNING, saga_job_id="[slurm://localhost]-[123]")
+        self.assertEqual(self.journal.jobs()[0]["job_name"], "nmpi_42")
+
+    def test_filter_by_stage_and_remove(self):
+        self.journal.record({"id": 1}, nmpi_journal.STAGING)
+        self.journal.record({"id": 2}, nmpi_journal.RUNNING, saga_job_id="a")
+        self.journal.record({"id": 3}, nmpi_journal.RUNNING, saga_job_id="b")
+        self.assertEqual([entry["job_id"] for entry in self.journal.jobs(nmpi_journal.RUNNING)], [2, 3])
+        self.journal.remove(2)
+        self.journal.remove(99)
+        self.assertEqual(len(self.journal), 2)
+        self.assertEqual([entry["job_id"] for entry in self.journal.jobs()], [1, 3])
+
+    def test_survives_reopening(self):
+        self.journal.record({"id": 7}, nmpi_journal.OUTPUT, saga_job_id="c")
+        self.journal.close()
+        self.journal = RunnerJournal(self.db_path)
+        entries = self.journal.jobs()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]["stage"], nmpi_journal.OUTPUT)
+
+    def test_only_one_runner(self):
+        self.assertRaises(JournalLocked, RunnerJournal, self.db_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,299 @@
+"""
+Tests of running jobs as local processes (nmpi_local)
+"""
+
+import os
+import sys
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+from nmpi import nmpi_local
+from nmpi.nmpi_local import LocalJobService, parse_cpu_list
+from nmpi import nmpi_forkserver
+from nmpi.nmpi_forkserver import ForkServerPool
+
+
+class Description(object):
+
+    def __init__(self, working_directory, code, wall_time_limit=None):
+        self.working_directory = working_directory
+        self.executable = sys.executable
+        self.arguments = ["-c", code]
+        self.environment = {"NMPI_TEST": "42"}
+        self.output = "job.out"
+        self.error = "job.err"
+        self.wall_time_limit = wall_time_limit
+
+
+class LocalJobServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.service = None
+
+    def tearDown(self):
+        if self.service is not None:
+            self.service.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def read(self, file_name):
+        with open(os.path.join(self.tmp_dir, file_name)) as fp:
+            return fp.read()
+
+    def test_parse_cpu_list(self):
+        self.assertEqual(parse_cpu_list("0-3,8, 10-11"), [0, 1, 2, 3, 8, 10, 11])
+
+    def test_run_job(self):
+        self.service = LocalJobService(max_jobs=2)
+        job = self.service.create_job(Description(
+            self.tmp_dir, "import os, sys; print(os.environ['NMPI_TEST']); sys.stderr.write('oops')"))
+        self.assertEqual(job.get_state(), nmpi_local.NEW)
+        self.assertIs(self.service.get_job(job.id), job)
+        self.assertEqual(self.service.list(), [job.id])
+        job.run()
+        self.assertEqual(job.wait(10), nmpi_local.DONE)
+        self.assertEqual(job.exit_code, 0)
+        self.assertEqual(self.read("job.out").strip(), "42")
+        self.assertEqual(self.read("job.err"), "oops")
+        # the service forgets jobs once their final state has been read
+        self.assertEqual(self.service.list(), [])
+        self.assertRaises(nmpi_local.NoSuchJob, self.service.get_job, job.id)
+
+    def test_resource_usage(self):
+        self.service = LocalJobService(cpus=[0], cpus_per_job=1)
+        job = self.service.create_job(Description(
+            self.tmp_dir, "import time\nstart = time.time()\nwhile time.time() - start < 0.3: pass"))
+        job.run()
+        self.assertEqual(job.wait(10), nmpi_local.DONE)
+        self.assertGreaterEqual(job.usage["wall_time"], 0.3)
+        self.assertGreater(job.usage["cpu_time"], 0.2)
+        self.assertGreater(job.usage["max_rss"], 1000000)
+        self.assertEqual(job.usage["cores"], 1)
+
+    def test_failed_job(self):
+        self.service = LocalJobService()
+        job = self.service.create_job(Description(self.tmp_dir, "import sys; sys.exit(3)"))
+        job.run()
+        self.assertEqual(job.wait(10), nmpi_local.FAILED)
+        self.assertEqual(job.exit_code, 3)
+
+    def test_max_jobs(self):
+        self.service = LocalJobService(max_jobs=1)
+        first = self.service.create_job(Description(self.tmp_dir, "import time; time.sleep(0.5)"))
+        second = self.service.create_job(Description(self.tmp_dir, "pass"))
+        first.run()
+        second.run()
+        time.sleep(0.2)
+        self.assertEqual(first.get_state(), nmpi_local.RUNNING)
+        self.assertEqual(second.get_state(), nmpi_local.PENDING)
+        self.assertEqual(second.wait(10), nmpi_local.DONE)
+        self.assertEqual(first.get_state(), nmpi_local.DONE)
+
+    def test_wall_time_limit(self):
+        self.service = LocalJobService(wall_time=0.5)
+        job = self.service.create_job(Description(self.tmp_dir, "import time; time.sleep(30)"))
+        start = time.time()
+        job.run()
+        self.assertEqual(job.wait(10), nmpi_local.FAILED)
+        self.assertLess(time.time() - start, 10)
+        self.assertIn("wall-time limit", self.read("job.err"))
+
+    def test_cancel(self):
+        self.service = LocalJobService()
+        job = self.service.create_job(Description(self.tmp_dir, "import time; time.sleep(30)"))
+        job.run()
+        time.sleep(0.2)
+        job.cancel()
+        self.assertEqual(job.wait(10), nmpi_local.CANCELED)
+
+    def test_start_without_lock(self):
+        starting, release = threading.Event(), threading.Event()
+
+        class SlowService(LocalJobService):
+            def _popen(self, *args):
+                starting.set()
+                release.wait(30)
+                return LocalJobService._popen(self, *args)
+
+        self.service = SlowService()
+        job = self.service.create_job(Description(self.tmp_dir, "import time; time.sleep(30)"))
+        job.run()
+        self.assertTrue(starting.wait(10))
+        # the service can be used while a job is being started, and the job cancelled
+        other = self.service.create_job(Description(self.tmp_dir, "pass"))
+        self.assertEqual(sorted(self.service.list()), sorted([job.id, other.id]))
+        job.cancel()
+        release.set()
+        self.assertEqual(job.wait(10), nmpi_local.CANCELED)
+
+    def test_memory_limit(self):
+        self.service = LocalJobService(memory_limit=2**30)
+        job = self.service.create_job(Description(self.tmp_dir, "x = bytearray(2 * 2**30)"))
+        job.run()
+        self.assertEqual(job.wait(10), nmpi_local.FAILED)
+        self.assertIn("MemoryError", self.read("job.err"))
+
+    @unittest.skipUnless(hasattr(os, "sched_getaffinity"), "CPU affinity not supported")
+    def test_cpu_pinning(self):
+        cpus = sorted(os.sched_getaffinity(0))[:2]
+        self.service = LocalJobService(cpus=cpus, cpus_per_job=1)
+        self.assertEqual(self.service.max_jobs, len(cpus))
+        job = self.service.create_job(Description(
+            self.tmp_dir, "import os; print(sorted(os.sched_getaffinity(0)))"))
+        job.run()
+        self.assertEqual(job.wait(10), nmpi_local.DONE)
+        self.assertEqual(self.read("job.out").strip(), str(cpus[:1]))
+
+
+class ScriptDescription(Description):
+
+    def __init__(self, working_directory, code, wall_time_limit=None):
+        super(ScriptDescription, self).__init__(working_directory, code, wall_time_limit)
+        with open(os.path.join(working_directory, "run.py"), "w") as fp:
+            fp.write(code)
+        self.arguments = ["run.py", "nest"]
+
+
+class ForkServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pool = ForkServerPool(["json"])
+        self.service = LocalJobService(max_jobs=2, fork_servers=self.pool)
+
+    def tearDown(self):
+        self.service.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def read(self, file_name):
+        with open(os.path.join(self.tmp_dir, file_name)) as fp:
+            return fp.read()
+
+    def test_run_script(self):
+        job = self.service.create_job(ScriptDescription(
+            self.tmp_dir,
+            "import os, sys\n"
+            "print('{} {} {}'.format(os.environ['NMPI_TEST'], sys.argv[1], 'json' in sys.modules))\n"
+            "sys.stderr.write('oops')\n"))
+        job.run()
+        self.assertEqual(job.wait(30), nmpi_local.DONE)
+        server = self.pool.get(sys.executable)
+        self.assertIsNotNone(server)
+        self.assertEqual(self.read("job.out").strip(), "42 nest True")
+        self.assertEqual(self.read("job.err"), "oops")
+
+    def test_resource_usage(self):
+        job = self.service.create_job(ScriptDescription(
+            self.tmp_dir, "import time\nstart = time.time()\nwhile time.time() - start < 0.3: pass\n"))
+        job.run()
+        self.assertEqual(job.wait(30), nmpi_local.DONE)
+        self.assertGreater(job.usage["cpu_time"], 0.2)
+        self.assertGreater(job.usage["max_rss"], 1000000)
+
+    def test_exit_code(self):
+        job = self.service.create_job(ScriptDescription(self.tmp_dir, "import sys\nsys.exit(3)\n"))
+        job.run()
+        self.assertEqual(job.wait(30), nmpi_local.FAILED)
+        self.assertEqual(job.exit_code, 3)
+
+    def test_exception(self):
+        job = self.service.create_job(ScriptDescription(self.tmp_dir, "raise ValueError('bad')\n"))
+        job.run()
+        self.assertEqual(job.wait(30), nmpi_local.FAILED)
+        self.assertIn("ValueError: bad", self.read("job.err"))
+
+    def test_fresh_random_state(self):
+        values = set()
+        for i in range(2):
+            job = self.service.create_job(ScriptDescription(
+                self.tmp_dir, "import random\nprint(random.random())\n"))
+            job.run()
+            self.assertEqual(job.wait(30), nmpi_local.DONE)
+            values.add(self.read("job.out"))
+        self.assertEqual(len(values), 2)
+
+    def test_wall_time_limit(self):
+        job = self.service.create_job(ScriptDescription(
+            self.tmp_dir, "import time\ntime.sleep(60)\n", wall_time_limit=0.01))
+        job.run()
+        self.assertEqual(job.wait(30), nmpi_local.FAILED)
+        self.assertTrue(job.timed_out)
+
+    def test_process_group_exists_once_started(self):
+        # so that a job can be cancelled as soon as it has started,
+        # even if the child is slow to start a session of its own
+        with open(os.path.join(self.tmp_dir, "slow_setsid.py"), "w") as fp:
+            fp.write("import os, time\n"
+                     "setsid = os.setsid\n"
+                     "def slow_setsid():\n"
+                     "    time.sleep(0.2)\n"
+                     "    setsid()\n"
+                     "os.setsid = slow_setsid\n")
+        with open(os.path.join(self.tmp_dir, "job.py"), "w") as fp:
+            fp.write("import time\ntime.sleep(60)\n")
+        python_path = os.environ.get("PYTHONPATH")
+        os.environ["PYTHONPATH"] = self.tmp_dir
+        try:
+            pool = ForkServerPool(["slow_setsid"])
+            server = pool.get(sys.executable)
+        finally:
+            if python_path is None:
+                del os.environ["PYTHONPATH"]
+            else:
+                os.environ["PYTHONPATH"] = python_path
+        try:
+            process = server.spawn([os.path.join(self.tmp_dir, "job.py")], self.tmp_dir, {},
+                                   os.devnull, os.devnull)
+            os.killpg(process.pid, signal.SIGKILL)
+            process._thread.join(30)
+            self.assertEqual(process.returncode, -signal.SIGKILL)
+        finally:
+            pool.close()
+
+    def test_not_a_script(self):
+        job = self.service.create_job(Description(self.tmp_dir, "print('cold')"))
+        job.run()
+        self.assertEqual(job.wait(30), nmpi_local.DONE)
+        self.assertEqual(self.read("job.out").strip(), "cold")
+        self.assertEqual(self.pool._servers, {})
+
+    def test_server_fails_to_start(self):
+        description = ScriptDescription(self.tmp_dir, "print('cold')\n")
+        description.executable = os.path.join(self.tmp_dir, "no_such_python")
+        self.assertIsNone(self.pool.get(description.executable))
+
+    def test_retry_after_failure(self):
+        executable = os.path.join(self.tmp_dir, "python")
+        self.assertIsNone(self.pool.get(executable))
+        with open(executable, "w") as fp:
+            fp.write('#!/bin/sh\nexec {} "$@"\n'.format(sys.executable))
+        os.chmod(executable, 0o755)
+        self.assertIsNone(self.pool.get(executable))  # not until RETRY_INTERVAL has passed
+        self.pool._failed[executable] -= nmpi_forkserver.RETRY_INTERVAL
+        self.assertIsNotNone(self.pool.get(executable))
+
+    def test_banner(self):
+        # a module which prints while it is imported does not stop the server from starting
+        with open(os.path.join(self.tmp_dir, "noisy.py"), "w") as fp:
+            fp.write("import sys\nsys.stdout.write('Welcome to noisy\\nnot ready')\n")
+        python_path = os.environ.get("PYTHONPATH")
+        os.environ["PYTHONPATH"] = self.tmp_dir
+        try:
+            pool = ForkServerPool(["noisy"])
+            server = pool.get(sys.executable)
+        finally:
+            if python_path is None:
+                del os.environ["PYTHONPATH"]
+            else:
+                os.environ["PYTHONPATH"] = python_path
+        try:
+            self.assertIsNotNone(server)
+        finally:
+            pool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
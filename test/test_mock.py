@@ -5,8 +5,11 @@ No network access is needed.
 
 """
 
+import os
+import shutil
+import tempfile
 import unittest
-from nmpi import nmpi_user
+from nmpi import nmpi_user, nmpi_files
 
 SERVER = "https://mock.hbpneuromorphic.eu"
 ENTRYPOINT = SERVER + "/api/v2"
@@ -188,6 +191,43 @@ class UserClientTest(unittest.TestCase):
         self.assertEqual(response, ["testfoo/job_43/" + DATAFILE1,
                                     "testfoo/job_43/" + DATAFILE2])
 
+    def test_download_data_with_checksums(self):
+        tmp_dir = tempfile.mkdtemp()
+        contents = {DATAFILE1: b"spikes", DATAFILE2: b"spikes"}
+        retrieved = []
+
+        def retrieve(url, local_path):
+            retrieved.append(url)
+            with open(local_path, "wb") as fp:
+                fp.write(contents[os.path.basename(url)])
+
+        source = os.path.join(tmp_dir, "source")
+        with open(source, "wb") as fp:
+            fp.write(b"spikes")
+        checksum = nmpi_files.file_checksum(source)
+        job = dict(JOB43, output_data=[dict(item, checksum=checksum) for item in JOB43["output_data"]])
+        nmpi_user.urlretrieve = retrieve
+        nmpi_user._mkdir_p = cache['_mkdir_p']
+        try:
+            # files with the same contents are only downloaded once
+            filenames = self.client.download_data(job, local_dir=tmp_dir)
+            self.assertEqual(len(retrieved), 1)
+            for filename in filenames:
+                with open(filename, "rb") as fp:
+                    self.assertEqual(fp.read(), b"spikes")
+            # files which are up to date are not downloaded again
+            self.client.download_data(job, local_dir=tmp_dir)
+            self.assertEqual(len(retrieved), 1)
+            # corrupted downloads are detected
+            contents[DATAFILE1] = b"garbage"
+            os.remove(filenames[0])
+            self.assertRaises(Exception, self.client.download_data, job, local_dir=tmp_dir)
+            self.assertFalse(os.path.exists(filenames[0]))
+        finally:
+            nmpi_user.urlretrieve = mock_urlretrieve
+            nmpi_user._mkdir_p = lambda dir: None
+            shutil.rmtree(tmp_dir)
+
     def test_copy_data_to_storage(self):
         response = self.client.copy_data_to_storage(43, destination="collab")
         # todo: check the response
@@ -0,0 +1,134 @@
+"""
+Tests of packing several jobs into one cluster job (nmpi_pack)
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+import unittest
+from nmpi import nmpi_pack
+from nmpi.nmpi_pack import JobPack, PackedJob
+from nmpi.nmpi_local import LocalJobService
+
+
+class Description(object):
+
+    def __init__(self, working_directory=None, executable=None, arguments=None):
+        self.working_directory = working_directory
+        self.executable = executable
+        self.arguments = arguments
+        self.environment = None
+        self.output = None
+        self.error = None
+        self.name = None
+        self.queue = None
+
+
+def job_description(tmp_dir, job_id, code):
+    working_directory = os.path.join(tmp_dir, "job_{}".format(job_id))
+    os.makedirs(working_directory)
+    description = Description(working_directory, sys.executable, ["-c", code])
+    description.environment = {"NMPI_TEST": "job {}".format(job_id)}
+    description.output = "saga_{}.out".format(job_id)
+    description.error = "saga_{}.err".format(job_id)
+    return description
+
+
+class JobPackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.service = LocalJobService()
+        self.orig_poll_interval = nmpi_pack.POLL_INTERVAL
+        nmpi_pack.POLL_INTERVAL = 0.05
+
+    def tearDown(self):
+        nmpi_pack.POLL_INTERVAL = self.orig_poll_interval
+        self.service.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def run_pack(self, descriptions, parallel=2):
+        pack_desc = nmpi_pack.describe_pack(Description(), os.path.join(self.tmp_dir, "pack_1"),
+                                            "nmpi_pack_1", descriptions, parallel=parallel, queue="tiny")
+        self.assertEqual(pack_desc.queue, "tiny")
+        pack_job = self.service.create_job(pack_desc)
+        pack_job.run()
+        pack = JobPack(pack_job)
+        return [PackedJob(pack, i, description) for i, description in enumerate(descriptions)]
+
+    def read(self, description, file_name):
+        with open(os.path.join(description.working_directory, file_name)) as fp:
+            return fp.read()
+
+    def test_member_job_id(self):
+        job_id = nmpi_pack.member_job_id("[slurm://localhost]-[1234]", 42)
+        self.assertEqual(job_id, "[slurm://localhost]-[1234]#42")
+        self.assertEqual(nmpi_pack.pack_job_id(job_id), "[slurm://localhost]-[1234]")
+        self.assertIsNone(nmpi_pack.pack_job_id("[slurm://localhost]-[1234]"))
+
+    def test_run_pack(self):
+        descriptions = [
+            job_description(self.tmp_dir, 1, "import os; print(os.environ['NMPI_TEST'])"),
+            job_description(self.tmp_dir, 2, "import sys; sys.stderr.write('oops'); sys.exit(3)"),
+            job_description(self.tmp_dir, 3, "print('it\\'s done')"),
+        ]
+        jobs = self.run_pack(descriptions)
+        states = [job.wait(30) for job in jobs]
+        self.assertEqual(states, [nmpi_pack.DONE, nmpi_pack.FAILED, nmpi_pack.DONE])
+        self.assertEqual([job.exit_code for job in jobs], [0, 3, 0])
+        self.assertEqual(self.read(descriptions[0], "saga_1.out").strip(), "job 1")
+        self.assertEqual(self.read(descriptions[1], "saga_2.err"), "oops")
+        self.assertEqual(self.read(descriptions[2], "saga_3.out").strip(), "it's done")
+        self.assertTrue(jobs[0].id.startswith(jobs[0].pack.id))
+
+    def test_pack_ends_early(self):
+        descriptions = [job_description(self.tmp_dir, 1, "import time; time.sleep(60)")]
+        jobs = self.run_pack(descriptions)
+        jobs[0].pack.saga_job.cancel()
+        self.assertEqual(jobs[0].wait(30), nmpi_pack.CANCELED)
+        self.assertIn("ended before the job did", self.read(descriptions[0], "saga_1.err"))
+
+    def test_cancel_waiting_job(self):
+        descriptions = [job_description(self.tmp_dir, 1, "import time; time.sleep(0.5)"),
+                        job_description(self.tmp_dir, 2, "print('should not run')")]
+        jobs = self.run_pack(descriptions, parallel=1)
+        jobs[1].cancel()
+        self.assertEqual(jobs[0].wait(30), nmpi_pack.DONE)
+        self.assertEqual(jobs[1].wait(30), nmpi_pack.CANCELED)
+        self.assertFalse(os.path.exists(os.path.join(descriptions[1].working_directory, "saga_2.out")))
+
+    def test_cancel_running_job(self):
+        descriptions = [job_description(self.tmp_dir, 1, "import time; time.sleep(60)"),
+                        job_description(self.tmp_dir, 2, "import time; time.sleep(2)")]
+        jobs = self.run_pack(descriptions)
+        for i in range(100):
+            if jobs[0].get_state() == nmpi_pack.RUNNING and os.path.exists(
+                    os.path.join(descriptions[0].working_directory, "saga_1.out")):
+                break
+            time.sleep(0.05)
+        jobs[0].cancel()
+        # the job is not reported as cancelled until it has been killed
+        self.assertEqual(jobs[0].get_state(), nmpi_pack.RUNNING)
+        self.assertEqual(jobs[0].wait(30), nmpi_pack.CANCELED)
+        self.assertEqual(jobs[0].exit_code, nmpi_pack.CANCELLED_EXIT_CODE)
+        # the other job of the pack is unaffected
+        self.assertEqual(jobs[1].wait(30), nmpi_pack.DONE)
+
+    def test_wall_time_limit(self):
+        descriptions = [job_description(self.tmp_dir, 1, "print('quick')"),
+                        job_description(self.tmp_dir, 2, "print('quick')")]
+        descriptions[0].wall_time_limit = 10
+        descriptions[1].wall_time_limit = 20
+        pack_desc = nmpi_pack.describe_pack(Description(), os.path.join(self.tmp_dir, "pack_1"),
+                                            "nmpi_pack_1", descriptions, parallel=2)
+        self.assertEqual(pack_desc.wall_time_limit, 35)
+        self.assertIn("timeout -k 30 600 ", self.read(descriptions[0], nmpi_pack.TASK_FILE))
+        jobs = self.run_pack(descriptions)
+        self.assertEqual([job.wait(30) for job in jobs], [nmpi_pack.DONE, nmpi_pack.DONE])
+        self.assertEqual(self.read(descriptions[1], "saga_2.out").strip(), "quick")
+
+
+if __name__ == "__main__":
+    unittest.main()
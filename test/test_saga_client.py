@@ -4,8 +4,11 @@
 """
 
 import os.path
+import sys
 import unittest
 import tempfile
+import time
+import threading
 import shutil
 from zipfile import ZipFile
 import tarfile
@@ -13,7 +16,7 @@ from datetime import datetime
 import saga
 import requests
 
-from nmpi import nmpi_saga, nmpi_user
+from nmpi import nmpi_saga, nmpi_user, nmpi_cache, nmpi_journal, nmpi_scheduler, nmpi_local, nmpi_gc, nmpi_files
 
 
 NMPI_HOST = "https://nmpi-staging.hbpneuromorphic.eu"
@@ -253,7 +256,7 @@ class CodeRetrievalTest(unittest.TestCase):
     def setUp(self):
         self.tmpdir = os.path.join(os.getenv("TMPDIR") or "/tmp/", "nmpi-saga-test")
         self.tmp_src_dir = self.tmpdir
-        self.tmp_run_dir = self.tmpdir
+        self.tmp_run_dir = os.path.join(self.tmpdir, "job_42")
         os.mkdir(self.tmpdir)
 
     def tearDown(self):
@@ -265,22 +268,13 @@ class CodeRetrievalTest(unittest.TestCase):
         zf.writestr("run.py", simulation_test_script)
         zf.close()
 
-        job_runner = nmpi_saga.JobRunner(dict(
-            JOB_SERVICE_ADAPTOR="fork://localhost",
-            AUTH_USER="nmpi",
-            AUTH_TOKEN=HARDWARE_TOKEN,
-            NMPI_HOST=NMPI_HOST,
-            NMPI_API=NMPI_API,
-            PLATFORM_NAME="nosetest_platform",
-            VERIFY_SSL=VERIFY
-        ))
-        job = MockSagaJob("submitted", working_directory=self.tmp_run_dir)
         mock_nmpi_job = {
             "code": "file://{}".format(zipfile)
         }
-        job_runner._get_code(mock_nmpi_job, job)
-        self.assertEqual(set(os.listdir(self.tmp_run_dir)),
-                         set(["run.py", "testcode.zip"]))
+        err = nmpi_saga.get_code(self.tmp_run_dir, mock_nmpi_job)
+        self.assertIsNone(err)
+        # the archive is extracted without keeping a copy
+        self.assertEqual(os.listdir(self.tmp_run_dir), ["run.py"])
         with open(os.path.join(self.tmp_run_dir, "run.py")) as fp:
             self.assertEqual(fp.read(), simulation_test_script)
 
@@ -291,21 +285,1315 @@ class CodeRetrievalTest(unittest.TestCase):
                 fp.write(simulation_test_script)
             tf.add("run.py")
             os.remove("run.py")
-        job_runner = nmpi_saga.JobRunner(dict(
-            JOB_SERVICE_ADAPTOR="fork://localhost",
-            AUTH_USER="nmpi",
-            AUTH_TOKEN=HARDWARE_TOKEN,
-            NMPI_HOST=NMPI_HOST,
-            NMPI_API=NMPI_API,
-            PLATFORM_NAME="nosetest_platform",
-            VERIFY_SSL=VERIFY
-        ))
-        job = MockSagaJob("submitted", working_directory=self.tmp_run_dir)
         mock_nmpi_job = {
             "code": "file://{}".format(archive)
         }
-        job_runner._get_code(mock_nmpi_job, job)
-        self.assertEqual(set(os.listdir(self.tmp_run_dir)),
-                         set(["run.py", "testcode.tar.gz"]))
+        err = nmpi_saga.get_code(self.tmp_run_dir, mock_nmpi_job)
+        self.assertIsNone(err)
+        self.assertEqual(os.listdir(self.tmp_run_dir), ["run.py"])
         with open(os.path.join(self.tmp_run_dir, "run.py")) as fp:
             self.assertEqual(fp.read(), simulation_test_script)
+
+    def test_get_code_malformed_archive(self):
+        archive = os.path.join(self.tmp_src_dir, "testcode.tar.gz")
+        with open(archive, "w") as fp:
+            fp.write("this is not an archive")
+        err = nmpi_saga.get_code(self.tmp_run_dir, {"code": "file://{}".format(archive)})
+        self.assertIn("malformed archive", err)
+
+    def test_failed_clone_is_an_error(self):
+        class FailingGitCache(object):
+            def clone(self, url, target):
+                return 128
+
+        script = os.path.join(self.tmp_run_dir, "run.py")
+        err = nmpi_saga.get_code(self.tmp_run_dir, {"code": "https://example.com/repo.git"},
+                                 script_name=script, git_cache=FailingGitCache())
+        self.assertIn("Unable to clone repository", err)
+        self.assertFalse(os.path.exists(script))
+
+
+class InputDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.working_directory = os.path.join(self.tmpdir, "job_42")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_input_data(self):
+        input_data = []
+        for i in range(5):
+            file_path = os.path.join(self.tmpdir, "input{}.dat".format(i))
+            with open(file_path, "w") as fp:
+                fp.write(str(i))
+            input_data.append({"url": "file://" + file_path})
+        nmpi_job = {"id": 42, "input_data": input_data}
+        for input_cache in (None, nmpi_cache.InputDataCache(os.path.join(self.tmpdir, "cache"))):
+            err = nmpi_saga.get_input_data(MockHardwareClient(), nmpi_job, self.working_directory,
+                                           input_cache=input_cache)
+            self.assertIsNone(err)
+            self.assertEqual(sorted(os.listdir(self.working_directory)),
+                             ["input{}.dat".format(i) for i in range(5)])
+            shutil.rmtree(self.working_directory)
+
+    def test_get_input_data_missing(self):
+        nmpi_job = {"id": 42, "input_data": [{"url": "file:///nonexistent/input.dat"}]}
+        err = nmpi_saga.get_input_data(MockHardwareClient(), nmpi_job, self.working_directory)
+        self.assertIn("/nonexistent/input.dat", err)
+
+
+class MockHardwareClient(object):
+    claim_jobs = False
+    update_queue = None
+
+    def __init__(self):
+        self.data_items = []
+        self.checksums = {}
+        self.updated_jobs = []
+        self.logs = {}
+
+    def create_data_item(self, url, checksum=None):
+        self.data_items.append(url)
+        if checksum:
+            self.checksums[url] = checksum
+            return {"url": url, "checksum": checksum}
+        return {"url": url}
+
+    def create_data_items(self, urls, threads=1, checksums=None):
+        return [(url, self.create_data_item(url, (checksums or {}).get(url)), None) for url in urls]
+
+    def append_log(self, job_id, content):
+        self.logs.setdefault(job_id, []).append(content)
+
+    def update_job(self, job):
+        self.updated_jobs.append(job)
+        return job
+
+
+class OutputDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.working_directory = os.path.join(self.tmpdir, "work", "job_42")
+        self.data_directory = os.path.join(self.tmpdir, "data")
+        os.makedirs(self.working_directory)
+        self.client = MockHardwareClient()
+        self.nmpi_job = {"id": 42, "output_data": []}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_handle_output_data_with_output_directory(self):
+        output_directory = os.path.join(self.tmpdir, "output", "job_42")
+        os.makedirs(os.path.join(output_directory, "spikes"))
+        for name in ("results.h5", os.path.join("spikes", "pop1.dat")):
+            with open(os.path.join(output_directory, name), "w") as fp:
+                fp.write("42\n")
+        # files in the working directory are not output, however new they are
+        with open(os.path.join(self.working_directory, "run.py"), "w") as fp:
+            fp.write(simple_test_script)
+
+        err = nmpi_saga.handle_output_data(self.client, "http://example.com",
+                                           self.data_directory, self.working_directory,
+                                           0, self.nmpi_job,
+                                           output_directory=output_directory)
+        self.assertIsNone(err)
+        self.assertEqual(sorted(self.client.data_items),
+                         ["http://example.com/job_42/results.h5",
+                          "http://example.com/job_42/spikes/pop1.dat"])
+        self.assertTrue(os.path.exists(os.path.join(self.data_directory, "job_42", "spikes", "pop1.dat")))
+        self.assertFalse(os.path.exists(os.path.join(self.data_directory, "job_42", "run.py")))
+        self.assertEqual(len(self.client.updated_jobs), 1)
+        # the checksums are registered with the data items, and kept in the provenance
+        checksum = nmpi_files.file_checksum(os.path.join(self.data_directory, "job_42", "results.h5"))
+        self.assertEqual(self.client.checksums["http://example.com/job_42/results.h5"], checksum)
+        self.assertEqual(self.nmpi_job["provenance"]["output_checksums"], self.client.checksums)
+
+    def test_checksums_without_copying(self):
+        output_directory = os.path.join(self.data_directory, "job_42")
+        os.makedirs(output_directory)
+        with open(os.path.join(output_directory, "results.h5"), "w") as fp:
+            fp.write("42\n")
+        err = nmpi_saga.handle_output_data(self.client, "http://example.com",
+                                           self.data_directory, self.working_directory,
+                                           0, self.nmpi_job,
+                                           output_directory=output_directory)
+        self.assertIsNone(err)
+        self.assertEqual(self.nmpi_job["output_data"][0]["checksum"],
+                         nmpi_files.file_checksum(os.path.join(output_directory, "results.h5")))
+
+
+class LogArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.working_directory = os.path.join(self.tmpdir, "job_42")
+        os.mkdir(self.working_directory)
+        self.data_directory = os.path.join(self.tmpdir, "data")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_archive_logs(self):
+        stdout = os.path.join(self.working_directory, "saga_42.out")
+        stderr = os.path.join(self.working_directory, "saga_42.err")
+        with open(stdout, "w") as fp:
+            fp.write("spike\n" * 10000)
+        with open(stderr, "w") as fp:
+            fp.write("a short warning\n")
+        client = MockHardwareClient()
+        resource_uris, err = nmpi_saga.archive_logs(client, "http://example.com", self.data_directory,
+                                                    self.working_directory, [stdout, stderr])
+        self.assertIsNone(err)
+        # only the file that does not fit in the job log is kept
+        self.assertEqual(client.data_items, ["http://example.com/job_42/saga_42.out.gz"])
+        self.assertEqual(len(resource_uris), 1)
+        self.assertTrue(os.path.exists(os.path.join(self.data_directory, "job_42", "saga_42.out.gz")))
+
+
+class MockJobDescription(object):
+
+    def __init__(self, working_directory, job_id=42):
+        self.working_directory = working_directory
+        self.output = "saga_{}.out".format(job_id)
+        self.error = "saga_{}.err".format(job_id)
+        self.environment = {}
+
+
+class LogFollowerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.client = MockHardwareClient()
+        self.follower = nmpi_saga.LogFollower(self.client, interval=1000, chunk_size=10, max_length=25)
+        self.saga_job = MockSagaJob(saga.job.RUNNING, working_directory=self.tmpdir)
+        self.saga_job.get_description = lambda: MockJobDescription(self.tmpdir)
+        self.stdout = os.path.join(self.tmpdir, "saga_42.out")
+
+    def tearDown(self):
+        self.follower.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, content):
+        with open(self.stdout, "a") as fp:
+            fp.write(content)
+
+    def test_follow(self):
+        self.follower.follow({"id": 42}, self.saga_job)
+        self.follower.poll()  # no output yet
+        self.assertEqual(self.client.logs, {})
+        self._write("step 1\n")
+        self.follower.poll()
+        self.follower.poll()  # nothing new
+        self._write("step 2\nstep 3\n")
+        self.follower.poll()
+        self._write("step 4\nstep 5\n")
+        self.follower.poll()
+        self._write("step 6\n")
+        self.follower.poll()  # limit reached
+        self.assertEqual(self.client.logs[42],
+                         ["step 1\n",
+                          "\n... 4 bytes skipped ...\n 2\nstep 3\n",
+                          "\n... 6 bytes skipped ...\n\nstep 5\n"
+                          "\n... further output will be shown when the job has finished ...\n"])
+
+    def test_unfollow(self):
+        self.follower.follow({"id": 42}, self.saga_job)
+        self._write("step 1\n")
+        self.follower.unfollow({"id": 42})
+        self.follower.poll()
+        self.assertEqual(self.client.logs, {})
+
+    def test_send_without_lock(self):
+        sending, release = threading.Event(), threading.Event()
+
+        def append_log(job_id, content):
+            sending.set()
+            release.wait(30)
+            self.client.logs.setdefault(job_id, []).append(content)
+        self.client.append_log = append_log
+        self.follower.follow({"id": 42}, self.saga_job)
+        self._write("step 1\n")
+        poll = threading.Thread(target=self.follower.poll)
+        poll.start()
+        self.assertTrue(sending.wait(30))
+        # other jobs can be followed while the output is being sent
+        self.follower.follow({"id": 43}, self.saga_job)
+        self.follower.unfollow({"id": 43})
+        # but unfollowing the job waits until its output has been sent
+        unfollow = threading.Thread(target=self.follower.unfollow, args=({"id": 42},))
+        unfollow.start()
+        unfollow.join(0.2)
+        self.assertTrue(unfollow.is_alive())
+        release.set()
+        unfollow.join(30)
+        poll.join(30)
+        self.assertEqual(self.client.logs, {42: ["step 1\n"]})
+
+
+class RecordingHardwareClient(nmpi_saga.HardwareClient):
+
+    def __init__(self):
+        self.job_server = ""
+        self.requests = []
+
+    def _put(self, resource_uri, data):
+        self.requests.append((resource_uri, dict(data)))
+        return data
+
+
+class PagedHardwareClient(RecordingHardwareClient):
+    """Serves lists of jobs in pages of two, as the queue server does (with more per page)."""
+
+    def __init__(self, jobs):
+        RecordingHardwareClient.__init__(self)
+        self.job_server = "https://nmpi.example.com"
+        self.resource_map = {"queue": "/api/v2/queue"}
+        self.platform = "TestPlatform"
+        self.jobs = jobs
+        self.pages = []
+
+    def _get(self, resource_uri):
+        self.pages.append(resource_uri)
+        status = resource_uri.split("/")[-2]
+        offset = int(resource_uri.partition("&offset=")[2] or 0)
+        jobs = [job for job in self.jobs if job["status"] == status]
+        next_page = None
+        if offset + 2 < len(jobs):
+            next_page = "/api/v2/queue/{}/?hardware_platform=TestPlatform&offset={}".format(status, offset + 2)
+        return {"meta": {"next": next_page, "offset": offset, "total_count": len(jobs)},
+                "objects": jobs[offset:offset + 2]}
+
+
+class PaginationTest(unittest.TestCase):
+
+    def test_all_pages_are_fetched(self):
+        jobs = [{"id": i, "resource_uri": "/api/v2/queue/{}".format(i), "status": "running"} for i in range(5)]
+        jobs.append({"id": 5, "resource_uri": "/api/v2/queue/5", "status": "submitted"})
+        client = PagedHardwareClient(jobs)
+        self.assertEqual(client.running_jobs(), ["/api/v2/queue/{}".format(i) for i in range(5)])
+        self.assertEqual(len(client.pages), 3)
+        self.assertEqual(client.pages[1], "https://nmpi.example.com/api/v2/queue/running/?hardware_platform=TestPlatform&offset=2")
+        self.assertEqual(client.queued_jobs(verbose=True), jobs[5:])
+
+
+class LeaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = RecordingHardwareClient()
+        self.client.runner_id = "runner-a"
+        self.client.lease_duration = 600
+
+    def test_running_jobs_get_a_lease(self):
+        job = {"id": 1, "resource_uri": "/api/v2/queue/1", "status": "running", "provenance": {"a": 1}}
+        self.client.update_job(job)
+        sent = self.client.requests[0][1]
+        self.assertEqual(sent["provenance"]["lease"]["runner"], "runner-a")
+        self.assertAlmostEqual(sent["provenance"]["lease"]["expires"], time.time() + 600, delta=5)
+        self.assertEqual(sent["provenance"]["a"], 1)
+        self.assertNotIn("lease", job["provenance"])
+        self.assertFalse(nmpi_saga.lease_expired(sent))
+        self.assertTrue(nmpi_saga.lease_expired(sent, now=time.time() + 601))
+
+    def test_lease_removed_when_job_finishes(self):
+        job = {"id": 1, "resource_uri": "/api/v2/queue/1", "status": "finished",
+               "provenance": {"lease": {"runner": "runner-a", "expires": 0}}}
+        self.client.update_job(job)
+        self.assertEqual(self.client.requests[0][1]["provenance"], {})
+
+    def test_requeue_expired_jobs(self):
+        now = time.time()
+        running = [
+            {"id": 1, "resource_uri": "/api/v2/queue/1", "status": "running", "provenance": None},
+            {"id": 2, "resource_uri": "/api/v2/queue/2", "status": "running",
+             "provenance": {"lease": {"runner": "runner-b", "expires": now + 100}}},
+            {"id": 3, "resource_uri": "/api/v2/queue/3", "status": "running",
+             "provenance": {"lease": {"runner": "runner-b", "expires": now - 100}}},
+            {"id": 4, "resource_uri": "/api/v2/queue/4", "status": "running",
+             "provenance": {"lease": {"runner": "runner-a", "expires": now - 100}}},
+        ]
+        self.client.running_jobs = lambda verbose=False: running
+        requeued = self.client.requeue_expired_jobs(exclude={4})
+        self.assertEqual([job["id"] for job in requeued], [3])
+        reset = [data for uri, data in self.client.requests if uri == "/api/v2/queue/3"]
+        self.assertEqual(reset[0]["status"], "submitted")
+        self.assertNotIn("lease", reset[0]["provenance"])
+
+
+class StatusUpdateQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = RecordingHardwareClient()
+        self.client.update_queue = nmpi_saga.StatusUpdateQueue(self.client, delay=1000)
+
+    def tearDown(self):
+        self.client.update_queue.close()
+
+    def _job(self, job_id, status, log):
+        return {"id": job_id, "resource_uri": "/api/v2/queue/{}".format(job_id),
+                "status": status, "log": log}
+
+    def test_updates_are_merged(self):
+        job = self._job(42, "submitted", "pending\n")
+        self.client.update_job_later(job)
+        self.assertNotIn("log", job)
+        self.client.update_job_later(self._job(43, "submitted", "pending\n"))
+        self.client.update_job_later(self._job(42, "running", "running\n"))
+        self.client.update_job_later(self._job(42, "finished", "finished\n"))
+        self.assertEqual(self.client.requests, [])
+        self.assertEqual(len(self.client.update_queue), 2)
+        self.client.update_queue.flush()
+        self.assertEqual(self.client.requests, [
+            ("/api/v2/queue/42", {"id": 42, "resource_uri": "/api/v2/queue/42", "status": "finished"}),
+            ("/api/v2/log/42", {"content": "pending\nrunning\nfinished\n"}),
+            ("/api/v2/queue/43", {"id": 43, "resource_uri": "/api/v2/queue/43", "status": "submitted"}),
+            ("/api/v2/log/43", {"content": "pending\n"}),
+        ])
+
+    def test_synchronous_update_supersedes_queued_update(self):
+        self.client.update_job_later(self._job(42, "running", "running\n"))
+        self.client.kill_job(self._job(42, "running", ""), "out of memory")
+        self.client.update_queue.flush()
+        self.assertEqual(len(self.client.requests), 2)
+        self.assertEqual(self.client.requests[0][1]["status"], "error")
+        self.assertEqual(self.client.requests[1][1]["content"],
+                         "running\nInternal error. Please resubmit the job\nout of memory")
+
+    def test_when_sent(self):
+        sent = []
+        self.client.update_queue.when_sent(41, lambda: sent.append(41))
+        self.assertEqual(sent, [41])
+        self.client.update_job_later(self._job(42, "finished", "finished\n"))
+        self.client.update_queue.when_sent(42, lambda: sent.append(42))
+        self.assertEqual(sent, [41])
+        self.client.update_queue.flush()
+        self.assertEqual(sent, [41, 42])
+
+    def test_close_sends_updates(self):
+        self.client.update_job_later(self._job(42, "running", "running\n"))
+        self.client.update_queue.close()
+        self.assertEqual(len(self.client.requests), 2)
+        self.assertRaises(Exception, self.client.update_job_later, self._job(42, "finished", ""))
+
+    def test_failed_update_is_retried(self):
+        client = UnreachableHardwareClient(failures=2)
+        client.update_queue = nmpi_saga.StatusUpdateQueue(client, delay=0, retries=0, retry_delay=0.01)
+        sent = threading.Event()
+        client.update_job_later(self._job(42, "finished", "finished\n"))
+        client.update_queue.when_sent(42, sent.set)
+        sent.wait(5)
+        client.update_queue.close()
+        self.assertTrue(sent.is_set())
+        self.assertEqual(client.requests, [
+            ("/api/v2/queue/42", {"id": 42, "resource_uri": "/api/v2/queue/42", "status": "finished"}),
+            ("/api/v2/log/42", {"content": "finished\n"}),
+        ])
+
+    def test_failed_update_keeps_its_place_before_later_updates(self):
+        client = UnreachableHardwareClient(failures=1)
+        client.update_queue = nmpi_saga.StatusUpdateQueue(client, delay=0, retries=0, retry_delay=1000)
+        client.update_job_later(self._job(42, "running", "running\n"))
+        while client.failures:
+            time.sleep(0.01)
+        client.update_job_later(self._job(42, "finished", "finished\n"))
+        self.assertEqual(client.requests, [])
+        client.update_queue.close()  # tries the failed update once more
+        self.assertEqual(client.requests, [
+            ("/api/v2/queue/42", {"id": 42, "resource_uri": "/api/v2/queue/42", "status": "finished"}),
+            ("/api/v2/log/42", {"content": "running\nfinished\n"}),
+        ])
+
+
+class UnreachableHardwareClient(RecordingHardwareClient):
+    """Fails the first `failures` requests."""
+
+    def __init__(self, failures):
+        RecordingHardwareClient.__init__(self)
+        self.failures = failures
+
+    def _put(self, resource_uri, data):
+        if self.failures:
+            self.failures -= 1
+            raise Exception("Error 503: service unavailable")
+        return RecordingHardwareClient._put(self, resource_uri, data)
+
+
+class FlakyHardwareClient(nmpi_saga.HardwareClient):
+
+    def __init__(self, failures, lost_responses=()):
+        self.failures = failures
+        self.lost_responses = lost_responses
+        self.attempts = {}
+        self.created = {}
+
+    def create_data_item(self, url, checksum=None):
+        self.attempts[url] = self.attempts.get(url, 0) + 1
+        if self.attempts[url] <= self.failures.get(url, 0):
+            raise Exception("Error 503: service unavailable")
+        self.created[url] = self.created.get(url, 0) + 1
+        if url in self.lost_responses:
+            raise Exception("Connection reset by peer")
+        return "/api/v2/dataitem/{}".format(url)
+
+    def find_data_item(self, url):
+        if url in self.created:
+            return "/api/v2/dataitem/{}".format(url)
+        return None
+
+
+class DataItemRegistrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.retry_delay = nmpi_saga.RETRY_DELAY
+        nmpi_saga.RETRY_DELAY = 0.0
+
+    def tearDown(self):
+        nmpi_saga.RETRY_DELAY = self.retry_delay
+
+    def test_create_data_items(self):
+        urls = ["file{}".format(i) for i in range(20)]
+        client = FlakyHardwareClient({"file3": 2, "file7": 10})
+        results = client.create_data_items(urls, threads=4, retries=3)
+        self.assertEqual([url for url, _, _ in results], urls)
+        for url, resource_uri, err in results:
+            if url == "file7":
+                self.assertIsNone(resource_uri)
+                self.assertIn("503", err)
+            else:
+                self.assertEqual(resource_uri, "/api/v2/dataitem/" + url)
+                self.assertIsNone(err)
+        self.assertEqual(client.attempts["file3"], 3)
+        self.assertEqual(client.attempts["file7"], 4)
+
+    def test_item_created_by_failed_request_is_not_created_again(self):
+        client = FlakyHardwareClient({}, lost_responses=["file1"])
+        results = client.create_data_items(["file0", "file1"], threads=2, retries=3)
+        self.assertEqual(results, [("file0", "/api/v2/dataitem/file0", None),
+                                   ("file1", "/api/v2/dataitem/file1", None)])
+        self.assertEqual(client.created, {"file0": 1, "file1": 1})
+
+
+class MockJobService(object):
+    """Job service knowing the jobs given as a dict of job id: (state, queue[, name])."""
+
+    def __init__(self, known_jobs):
+        self.known_jobs = known_jobs
+        self.cancelled = []
+
+    def list(self):
+        return list(self.known_jobs)
+
+    def get_job(self, job_id):
+        if job_id not in self.known_jobs:
+            raise saga.NoSuccess("job {} not found".format(job_id))
+        state, queue = self.known_jobs[job_id][:2]
+        saga_job = MockSagaJob(state)
+        saga_job.id = job_id
+        saga_job.description = saga.job.Description()
+        saga_job.description.queue = queue
+        saga_job.description.name = self.known_jobs[job_id][2] if len(self.known_jobs[job_id]) > 2 else None
+        saga_job.get_description = lambda: saga_job.description
+        saga_job.cancel = lambda: self.cancelled.append(job_id)
+        return saga_job
+
+
+class ResettingHardwareClient(MockHardwareClient):
+
+    def __init__(self, queued_jobs=()):
+        MockHardwareClient.__init__(self)
+        self.reset_job_ids = []
+        self.queued_jobs = list(queued_jobs)
+
+    def reset_job(self, job):
+        self.reset_job_ids.append(job["id"])
+
+    def reset_jobs(self, jobs, threads=1):
+        return [(job, self.reset_job(job)) for job in jobs]
+
+    def get_next_job(self):
+        # like the queue server, keep returning the oldest job until it is taken
+        return self.queued_jobs[0] if self.queued_jobs else None
+
+
+def make_job_runner(config, client, services):
+    """Create a JobRunner without calling __init__, which needs the job server."""
+    job_runner = nmpi_saga.JobRunner.__new__(nmpi_saga.JobRunner)
+    job_runner.config = dict({"JOB_EXECUTABLE_PYNN_7": "/usr/bin/python",
+                              "JOB_QUEUE": None,
+                              "JOB_SERVICE_ADAPTOR": "mock://localhost",
+                              "DEFAULT_PYNN_BACKEND": "nest"}, **config)
+    job_runner.client = client
+    job_runner.scheduler = nmpi_scheduler.scheduler_from_config(job_runner.config)
+    job_runner.claimed_jobs = set()
+    job_runner.lease_renewed = {}
+    job_runner.last_lease_check = None
+    job_runner.last_reconciliation = None
+    job_runner.last_cancellation_check = None
+    job_runner.copy_back_pool = None
+    job_runner.copying = []
+    job_runner.collector = None
+    job_runner.services = services
+    job_runner.log_follower = None
+    job_runner.journal = None
+    job_runner.result_cache = None
+    job_runner.result_cache_rules = []
+    job_runner.fair_share = None
+    job_runner.resource_units = "hours"
+    job_runner.usage_cache = {}
+    return job_runner
+
+
+class JobRecoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.job_runner = make_job_runner(
+            {"WORKING_DIRECTORY": self.tmp_dir},
+            ResettingHardwareClient(),
+            {"mock://localhost": MockJobService({"slurm-1": (saga.job.RUNNING, None)})})
+        self.job_runner.journal = nmpi_journal.RunnerJournal(os.path.join(self.tmp_dir, "journal.sqlite"))
+
+    def tearDown(self):
+        self.job_runner.journal.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_recover_jobs(self):
+        journal = self.job_runner.journal
+        jobs = [{"id": i, "hardware_config": None, "command": ""} for i in (1, 2, 3)]
+        journal.record(jobs[0], nmpi_journal.STAGING)
+        journal.record(jobs[1], nmpi_journal.RUNNING, saga_job_id="slurm-1", start_time=1000.0)
+        journal.record(jobs[2], nmpi_journal.OUTPUT, saga_job_id="slurm-2", start_time=1000.0)
+        reattached, to_submit = self.job_runner.recover_jobs()
+        self.assertEqual(to_submit, [jobs[0]])
+        self.assertEqual(len(reattached), 1)
+        nmpi_job, saga_job = reattached[0]
+        self.assertEqual(nmpi_job["id"], 2)
+        self.assertEqual(nmpi_job["status"], "running")
+        self.assertEqual(saga_job.start_time, 1000.0)
+        self.assertEqual(nmpi_saga.job_description(saga_job).output, "saga_2.out")
+        self.assertEqual(self.job_runner.scheduler.default.running, 1)
+        # the job which can no longer be found on the cluster goes back in the queue
+        self.assertEqual(self.job_runner.client.reset_job_ids, [3])
+        self.assertEqual([entry["job_id"] for entry in journal.jobs()], [1, 2])
+
+    def test_recover_jobs_being_submitted(self):
+        self.job_runner.services["mock://localhost"].known_jobs["slurm-4"] = (saga.job.RUNNING, None, "nmpi_4")
+        journal = self.job_runner.journal
+        jobs = [{"id": i, "hardware_config": None, "command": ""} for i in (4, 5)]
+        for job in jobs:
+            journal.record(job, nmpi_journal.SUBMITTING, job_name="nmpi_{}".format(job["id"]), start_time=1000.0)
+        reattached, to_submit = self.job_runner.recover_jobs()
+        # the job which reached the cluster is not submitted a second time
+        self.assertEqual([(nmpi_job["id"], saga_job.id) for nmpi_job, saga_job in reattached], [(4, "slurm-4")])
+        self.assertEqual(to_submit, [jobs[1]])
+        self.assertEqual(journal.jobs(nmpi_journal.RUNNING)[0]["saga_job_id"], "slurm-4")
+
+    def test_journal_kept_until_final_update_is_sent(self):
+        client = RecordingHardwareClient()
+        client.update_queue = nmpi_saga.StatusUpdateQueue(client, delay=1000)
+        self.job_runner.client = client
+        journal = self.job_runner.journal
+        job = {"id": 5, "resource_uri": "/api/v2/queue/5", "status": "finished", "log": "done\n"}
+        journal.record(job, nmpi_journal.OUTPUT, saga_job_id="slurm-5", start_time=1000.0)
+        client.update_job_later(job)
+        self.job_runner._forget(job)
+        # a runner killed at this point, before the update has been sent, leaves the job in the journal
+        self.assertEqual(client.requests, [])
+        self.assertEqual([entry["job_id"] for entry in journal.jobs()], [5])
+        client.update_queue.close()
+        self.assertEqual(client.requests[0][1]["status"], "finished")
+        self.assertEqual(journal.jobs(), [])
+
+
+class AdmissionControlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queued_jobs = [{"id": i, "hardware_config": None} for i in range(10)]
+        self.client = ResettingHardwareClient(self.queued_jobs)
+        self.cluster_jobs = {"slurm-1": (saga.job.PENDING, "intel"),
+                             "slurm-2": (saga.job.RUNNING, "intel"),
+                             "slurm-3": (saga.job.PENDING, "other")}
+        self.services = {"mock://localhost": MockJobService(self.cluster_jobs)}
+
+    def test_no_limit(self):
+        job_runner = make_job_runner({}, self.client, self.services)
+        self.assertIsNone(job_runner.admission_limit())
+        # the server keeps returning the same job, which must only be claimed once
+        self.assertEqual(job_runner.retrieve_pending_jobs(), self.queued_jobs[:1])
+        self.assertEqual(job_runner.retrieve_pending_jobs(), [])
+
+    def test_cluster_occupancy(self):
+        occupancy = nmpi_saga.cluster_occupancy(self.services["mock://localhost"], "mock://localhost")
+        self.assertEqual(occupancy, {"intel": (1, 1), "other": (1, 0)})
+
+    def test_limit_from_cluster_queue(self):
+        job_runner = make_job_runner({"JOB_QUEUE": "intel", "MAX_QUEUED_JOBS": "3"},
+                                     self.client, self.services)
+        self.assertEqual(job_runner.admission_limit(), 2)
+        self.cluster_jobs["slurm-4"] = (saga.job.NEW, "intel")
+        self.cluster_jobs["slurm-5"] = (saga.job.PENDING, "intel")
+        self.assertEqual(job_runner.admission_limit(), 0)
+        self.assertEqual(job_runner.retrieve_pending_jobs(), [])
+
+    def test_default_queue_of_cluster(self):
+        tmp_dir = tempfile.mkdtemp()
+        tmp_path = os.environ["PATH"]
+        scripts = {"squeue": "echo '11|nmpi_1|PENDING|batch'\n"
+                             "echo '12|nmpi_2|PENDING|batch'\n"
+                             "echo '13|nmpi_3|PENDING|debug'\n",
+                   "scontrol": "echo 'PartitionName=debug Default=NO State=UP'\n"
+                               "echo 'PartitionName=batch Default=YES State=UP'\n"}
+        for name, script in scripts.items():
+            with open(os.path.join(tmp_dir, name), "w") as fp:
+                fp.write("#!/bin/sh\n" + script)
+            os.chmod(os.path.join(tmp_dir, name), 0o755)
+        os.environ["PATH"] = tmp_dir + os.pathsep + tmp_path
+        try:
+            job_runner = make_job_runner({"JOB_SERVICE_ADAPTOR": "slurm://localhost", "MAX_QUEUED_JOBS": "3"},
+                                         self.client, {"slurm://localhost": MockJobService({})})
+            # with no JOB_QUEUE, jobs go to the default partition reported by SLURM
+            self.assertEqual(job_runner.admission_limit(), 1)
+        finally:
+            os.environ["PATH"] = tmp_path
+            shutil.rmtree(tmp_dir)
+
+    def test_local_backlog(self):
+        job_runner = make_job_runner({"JOB_QUEUE": "intel", "MAX_QUEUED_JOBS": "3", "LOCAL_BACKLOG": "1"},
+                                     self.client, self.services)
+        self.assertEqual(job_runner.admission_limit(), 1)
+        job_runner.scheduler.add(self.queued_jobs[5])
+        self.assertEqual(job_runner.admission_limit(), 0)
+
+
+class ReconciliationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.client = ResettingHardwareClient()
+        self.client.lease_duration = None
+        self.client.update_queue = None
+        self.server_jobs = [
+            {"id": 1, "status": "running", "hardware_config": None},  # handled by the runner
+            {"id": 2, "status": "running", "hardware_config": None},  # orphaned
+            {"id": 3, "status": "running", "hardware_config": None},  # finished but unreported
+            {"id": 4, "status": "submitted", "hardware_config": None},
+        ]
+        self.client.running_jobs = lambda verbose=False: [job for job in self.server_jobs
+                                                          if job["status"] == "running"]
+        self.client.queued_jobs = lambda verbose=False: [job for job in self.server_jobs
+                                                         if job["status"] == "submitted"]
+        self.service = MockJobService({
+            "[mock://localhost]-[101]": (saga.job.RUNNING, None, "nmpi_1"),
+            "[mock://localhost]-[102]": (saga.job.RUNNING, None, "nmpi_2"),
+            "[mock://localhost]-[103]": (saga.job.DONE, None, "nmpi_3"),
+            "[mock://localhost]-[105]": (saga.job.PENDING, None, "nmpi_5"),  # ghost
+            "[mock://localhost]-[106]": (saga.job.RUNNING, None, "something_else"),
+        })
+        self.job_runner = make_job_runner({"WORKING_DIRECTORY": self.tmp_dir, "RECONCILE_INTERVAL": "60"},
+                                          self.client, {"mock://localhost": self.service})
+        self.job_runner.claimed_jobs.add(1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_native_job_id(self):
+        self.assertEqual(nmpi_saga.native_job_id("[slurm://localhost]-[1234]"), "1234")
+        self.assertEqual(nmpi_saga.native_job_id("1234"), "1234")
+
+    def test_classify_jobs(self):
+        cluster = nmpi_saga.cluster_jobs(self.service, "mock://localhost")
+        found = nmpi_saga.classify_jobs(self.server_jobs, {1}, cluster, lambda job: True)
+        self.assertEqual([(job["id"], cluster_job.saga_job_id) for job, cluster_job in found["orphaned"]],
+                         [(2, "[mock://localhost]-[102]")])
+        self.assertEqual([job["id"] for job in found["unreported"]], [3])
+        self.assertEqual([cluster_job.saga_job_id for cluster_job in found["ghost"]],
+                         ["[mock://localhost]-[105]"])
+        # jobs claimed by other runners are left alone
+        found = nmpi_saga.classify_jobs(self.server_jobs, {1}, cluster, lambda job: False)
+        self.assertEqual((found["orphaned"], found["unreported"]), ([], []))
+
+    def test_reconcile(self):
+        adopted = self.job_runner.reconcile()
+        self.assertEqual([(nmpi_job["id"], saga_job.id) for nmpi_job, saga_job in adopted],
+                         [(2, "[mock://localhost]-[102]")])
+        self.assertIn(2, self.job_runner.claimed_jobs)
+        self.assertEqual(self.client.reset_job_ids, [3])
+        self.assertEqual(self.service.cancelled, ["[mock://localhost]-[105]"])
+        # not again until RECONCILE_INTERVAL has passed
+        self.assertEqual(self.job_runner.reconcile(), [])
+        self.assertEqual(self.client.reset_job_ids, [3])
+
+    def test_jobs_beyond_the_first_page_are_not_ghosts(self):
+        # job 5 is on the second page of running jobs
+        self.server_jobs.append({"id": 5, "status": "running", "hardware_config": None})
+        server = PagedHardwareClient([dict(job, resource_uri="/api/v2/queue/{}".format(job["id"]))
+                                      for job in self.server_jobs])
+        self.client.running_jobs = server.running_jobs
+        self.client.queued_jobs = server.queued_jobs
+        self.job_runner.reconcile()
+        self.assertEqual(self.service.cancelled, [])
+        self.assertEqual(self.client.reset_job_ids, [3])
+
+    def test_slurm_states(self):
+        tmp_path = os.environ["PATH"]
+        squeue = os.path.join(self.tmp_dir, "squeue")
+        with open(squeue, "w") as fp:
+            fp.write("#!/bin/sh\n"
+                     "echo '201|nmpi_1|RUNNING|batch'\n"
+                     "echo '202|nmpi_7|FAILED|batch'\n"
+                     "echo '203|nmpi_8|TIMEOUT|batch'\n")
+        os.chmod(squeue, 0o755)
+        os.environ["PATH"] = self.tmp_dir + os.pathsep + tmp_path
+        try:
+            cluster = nmpi_saga.cluster_jobs(None, "slurm://localhost")
+        finally:
+            os.environ["PATH"] = tmp_path
+        self.assertEqual(dict((job_id, job.state) for job_id, job in cluster.items()),
+                         {"201": saga.job.RUNNING, "202": saga.job.FAILED, "203": saga.job.FAILED})
+        # jobs which have ended on the cluster are not ghosts
+        found = nmpi_saga.classify_jobs(self.server_jobs, {1}, cluster, lambda job: True)
+        self.assertEqual(found["ghost"], [])
+
+
+class JobServiceTest(unittest.TestCase):
+
+    def test_local_job_service(self):
+        service = nmpi_saga.make_job_service("process://localhost",
+                                             {"LOCAL_CPUS": "0-3", "LOCAL_CPUS_PER_JOB": "2",
+                                              "LOCAL_WALL_TIME": "60", "LOCAL_MEMORY_LIMIT": "1G"})
+        try:
+            self.assertIsInstance(service, nmpi_local.LocalJobService)
+            self.assertEqual(service.max_jobs, 2)
+            self.assertEqual(service.wall_time, 60.0)
+            self.assertEqual(service.memory_limit, 2**30)
+        finally:
+            service.close()
+
+
+class UpdatingHardwareClient(ResettingHardwareClient):
+
+    def update_job_later(self, job):
+        return self.update_job(job)
+
+
+class JobPackingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.service = nmpi_local.LocalJobService()
+        self.job_runner = make_job_runner({"WORKING_DIRECTORY": self.tmp_dir,
+                                           "JOB_SERVICE_ADAPTOR": "process://localhost",
+                                           "JOB_EXECUTABLE_PYNN_7": sys.executable,
+                                           "PACK_SIZE": "3",
+                                           "PACK_PARALLEL": "2"},
+                                          UpdatingHardwareClient(),
+                                          {"process://localhost": self.service})
+        self.job_runner.git_cache = self.job_runner.archive_cache = self.job_runner.input_cache = None
+        self.job_runner.config["DEFAULT_PYNN_BACKEND"] = "nest"
+
+    def tearDown(self):
+        self.service.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_jobs_are_packed(self):
+        jobs = [{"id": i, "hardware_config": None, "command": "", "input_data": [],
+                 "code": "import sys\nprint('job {}')\nsys.exit({})\n".format(i, i % 2)}
+                for i in range(4)]
+        saga_jobs = self.job_runner.submit_jobs(jobs)
+        self.assertEqual(len(saga_jobs), 4)
+        # three jobs in the first pack, the last on its own
+        self.assertEqual(len(set(saga_job.pack.id for nmpi_job, saga_job in saga_jobs[:3])), 1)
+        self.assertFalse(hasattr(saga_jobs[3][1], "pack"))
+        self.assertIn(saga_jobs[0][1].pack.id, self.service.list())
+        self.assertEqual(len(self.service.list()), 2)
+        for nmpi_job, saga_job in saga_jobs:
+            saga_job.wait(30)
+            self.job_runner._update_status(nmpi_job, saga_job, nmpi_saga.default_job_states)
+        self.assertEqual([nmpi_job["status"] for nmpi_job, saga_job in saga_jobs],
+                         ["finished", "error", "finished", "error"])
+        self.assertIn("job 2", saga_jobs[2][0]["log"])
+        self.assertNotIn("job 0", saga_jobs[2][0]["log"])
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.service = nmpi_local.LocalJobService()
+        self.job_runner = make_job_runner({"WORKING_DIRECTORY": os.path.join(self.tmp_dir, "work"),
+                                           "JOB_SERVICE_ADAPTOR": "process://localhost",
+                                           "JOB_EXECUTABLE_PYNN_7": sys.executable},
+                                          UpdatingHardwareClient(),
+                                          {"process://localhost": self.service})
+        self.job_runner.git_cache = self.job_runner.archive_cache = self.job_runner.input_cache = None
+        self.job_runner.result_cache = nmpi_cache.ResultCache(os.path.join(self.tmp_dir, "results"))
+        self.job_runner.result_cache_rules = nmpi_scheduler.parse_rules("platform_variant=ESS")
+
+    def tearDown(self):
+        self.service.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _job(self, job_id, code="open('result.txt', 'w').write('42')\nprint('done')\n", variant="ESS"):
+        return {"id": job_id, "hardware_config": {"platform_variant": variant}, "command": "",
+                "input_data": [], "code": code}
+
+    def _run(self, nmpi_job):
+        saga_job, err = self.job_runner.run(nmpi_job)
+        self.assertFalse(err)
+        self.assertEqual(saga_job.wait(30), saga.job.DONE)
+        self.job_runner._store_result(nmpi_job, saga_job)
+        return saga_job
+
+    def test_identical_job_reuses_results(self):
+        self._run(self._job(1))
+        job = self._job(2)
+        saga_job = self._run(job)
+        self.assertIsInstance(saga_job, nmpi_saga.CachedResultJob)
+        self.assertIn("identical job 1", job["log"])
+        working_directory = os.path.join(self.tmp_dir, "work", "job_2")
+        with open(os.path.join(working_directory, "result.txt")) as fp:
+            self.assertEqual(fp.read(), "42")
+        self.job_runner._update_status(job, saga_job, nmpi_saga.default_job_states)
+        self.assertEqual(job["status"], "finished")
+        self.assertIn("done", job["log"])
+
+    def test_different_or_nondeterministic_jobs_run(self):
+        self._run(self._job(1))
+        self.assertNotIsInstance(self._run(self._job(2, code="print('other')\n")), nmpi_saga.CachedResultJob)
+        self.assertNotIsInstance(self._run(self._job(3, variant="wafer")), nmpi_saga.CachedResultJob)
+
+
+class CancellationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.service = nmpi_local.LocalJobService()
+        self.client = UpdatingHardwareClient()
+        self.client.update_queue = None
+        self.job_runner = make_job_runner({"WORKING_DIRECTORY": self.tmp_dir,
+                                           "JOB_SERVICE_ADAPTOR": "process://localhost",
+                                           "JOB_EXECUTABLE_PYNN_7": sys.executable,
+                                           "WALL_TIME_LIMIT": "1",
+                                           "WALL_TIME_GRACE": "0",
+                                           "CANCELLATION_CHECK_INTERVAL": "60"},
+                                          self.client,
+                                          {"process://localhost": self.service})
+        self.job_runner.git_cache = self.job_runner.archive_cache = self.job_runner.input_cache = None
+        self.job_runner.result_cache = None
+
+    def tearDown(self):
+        self.service.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _run(self, job_id):
+        nmpi_job = {"id": job_id, "hardware_config": None, "command": "", "input_data": [],
+                    "code": "import time\nprint('started')\ntime.sleep(60)\n"}
+        saga_job, err = self.job_runner.run(nmpi_job)
+        self.assertFalse(err)
+        self.assertEqual(nmpi_saga.job_description(saga_job).wall_time_limit, 1)
+        self.job_runner.scheduler.started(saga_job.partition)
+        return nmpi_job, saga_job
+
+    def test_wall_time_limit(self):
+        nmpi_job, saga_job = self._run(1)
+        while saga_job.get_state() != saga.job.RUNNING:
+            saga_job.wait(0.05)
+        self.assertEqual(self.job_runner._enforce_wall_time(saga_job, saga.job.RUNNING), saga.job.RUNNING)
+        saga_job.running_since -= 61
+        self.assertEqual(self.job_runner._enforce_wall_time(saga_job, saga.job.RUNNING), saga.job.CANCELED)
+        self.job_runner._update_status(nmpi_job, saga_job, nmpi_saga.default_job_states)
+        self.assertEqual(nmpi_job["status"], "error")
+        self.assertIn("cancelled", nmpi_job["log"])
+        self.assertIn("wall-time limit of 1 minutes", nmpi_job["log"])
+
+    def test_cancel_removed_jobs(self):
+        pending_jobs = [self._run(1), self._run(2)]
+        self.job_runner.scheduler.add({"id": 3, "hardware_config": None})
+        self.job_runner.scheduler.add({"id": 4, "hardware_config": None})
+        self.job_runner.claimed_jobs.update([1, 2, 3, 4])
+        self.client.running_jobs = lambda verbose=False: ["/api/v2/queue/1"]
+        self.client.queued_jobs = lambda verbose=False: ["/api/v2/queue/3/"]
+        self.job_runner.cancel_removed_jobs(pending_jobs)
+        self.assertEqual([nmpi_job["id"] for nmpi_job, saga_job in pending_jobs], [1])
+        self.assertEqual(self.job_runner.claimed_jobs, set([1, 3]))
+        self.assertEqual([job["id"] for job in self.job_runner.scheduler.default.queued], [3])
+        self.assertEqual(self.job_runner.scheduler.default.running, 1)
+        self.assertIn(pending_jobs[0][1].get_state(), (saga.job.PENDING, saga.job.RUNNING))
+        # the removed job has been cancelled, and the server not told about it
+        removed = [job for job in self.service.list() if job != pending_jobs[0][1].id]
+        self.assertEqual(self.service.get_job(removed[0]).wait(30), saga.job.CANCELED)
+        self.assertEqual(self.client.updated_jobs, [])
+        # the working directory of the removed job can be collected
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, "job_2", nmpi_gc.FINISHED_FILE)))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "job_1", nmpi_gc.FINISHED_FILE)))
+
+
+class ScratchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.service = nmpi_local.LocalJobService()
+        self.client = UpdatingHardwareClient()
+        self.client.lease_duration = None
+        self.client.update_queue = None
+        self.job_runner = make_job_runner({"WORKING_DIRECTORY": os.path.join(self.tmp_dir, "work"),
+                                           "SCRATCH_DIRECTORY": os.path.join(self.tmp_dir, "scratch"),
+                                           "DATA_DIRECTORY": os.path.join(self.tmp_dir, "data"),
+                                           "DATA_SERVER": "http://data.example.com",
+                                           "JOB_SERVICE_ADAPTOR": "process://localhost",
+                                           "JOB_EXECUTABLE_PYNN_7": sys.executable},
+                                          self.client,
+                                          {"process://localhost": self.service})
+        self.job_runner.git_cache = self.job_runner.archive_cache = self.job_runner.input_cache = None
+
+    def tearDown(self):
+        self.job_runner.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_job_runs_in_scratch(self):
+        jobs = [{"id": i, "hardware_config": None, "command": "", "input_data": [], "output_data": [],
+                 "code": "import os\nprint(os.getcwd())\nopen('result.txt', 'w').write('{}')\n".format(i)}
+                for i in (1, 2)]
+        saga_jobs = self.job_runner.submit_jobs(jobs)
+        self.assertEqual(nmpi_saga.job_description(saga_jobs[0][1]).working_directory,
+                         os.path.join(self.tmp_dir, "scratch", "job_1"))
+        self.job_runner.wait_on_completion(saga_jobs)
+        self.assertEqual(self.job_runner.copying, [])
+        for job in jobs:
+            self.assertEqual(job["status"], "finished")
+            self.assertIn(os.path.join(self.tmp_dir, "scratch"), job["log"])
+            self.assertIn("http://data.example.com/job_{}/result.txt".format(job["id"]),
+                          [item["url"] for item in job["output_data"]])
+            with open(os.path.join(self.tmp_dir, "data", "job_{}".format(job["id"]), "result.txt")) as fp:
+                self.assertEqual(fp.read(), str(job["id"]))
+        # the scratch directories are removed once the output has been copied back
+        self.assertEqual(os.listdir(os.path.join(self.tmp_dir, "scratch")), [])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "work", "job_1")))
+
+    def test_copy_back_works_on_a_copy_of_the_job(self):
+        handled = []
+
+        def handle_output_data(nmpi_job, saga_job):
+            handled.append(nmpi_job)
+            nmpi_job["output_data"] = ["/api/v2/dataitem/1"]
+            nmpi_job.setdefault("provenance", {})["output_checksums"] = {}
+
+        self.job_runner._handle_output_data = handle_output_data
+        self.job_runner._store_result = self.job_runner._archive_logs = lambda nmpi_job, saga_job: None
+        self.job_runner._update_status = lambda nmpi_job, saga_job, states: nmpi_job
+        saga_job = MockSagaJob(saga.job.DONE, working_directory=os.path.join(self.tmp_dir, "scratch", "job_1"))
+        job = {"id": 1, "status": "running", "output_data": [], "log": "pending\n"}
+        self.job_runner._start_copy_back(job, saga_job)
+        # meanwhile, the main thread may send and change the job, e.g. to renew its lease
+        job.pop("log")
+        job["log"] = "more\n"
+        self.job_runner._finish_copy_backs(wait=True)
+        self.assertIsNot(handled[0], job)
+        self.assertNotIn("log", handled[0])
+        self.assertEqual(job["output_data"], ["/api/v2/dataitem/1"])
+        self.assertIn("provenance", job)
+        self.assertEqual(job["log"], "more\n")
+
+    def test_output_directory_emptied_when_job_is_run_again(self):
+        self.job_runner.config["OUTPUT_DIRECTORY"] = os.path.join(self.tmp_dir, "output")
+        stale_file = os.path.join(self.tmp_dir, "output", "job_1", "result.txt")
+        os.makedirs(os.path.dirname(stale_file))
+        with open(stale_file, "w") as fp:
+            fp.write("from an earlier run")
+        job = {"id": 1, "hardware_config": None, "command": "", "input_data": [], "code": "pass\n"}
+        job_desc, err = self.job_runner._stage(job, self.job_runner.scheduler.route(job))
+        self.assertIsNone(err)
+        self.assertEqual(job_desc.environment[nmpi_saga.OUTPUT_DIRECTORY_VARIABLE],
+                         os.path.dirname(stale_file))
+        self.assertEqual(os.listdir(os.path.dirname(stale_file)), [])
+
+    def test_working_directory_emptied_when_job_is_run_again(self):
+        stale_file = os.path.join(self.tmp_dir, "scratch", "job_1", "partial_clone.txt")
+        os.makedirs(os.path.dirname(stale_file))
+        with open(stale_file, "w") as fp:
+            fp.write("from an earlier run")
+        job = {"id": 1, "hardware_config": None, "command": "", "input_data": [], "code": "pass\n"}
+        job_desc, err = self.job_runner._stage(job, self.job_runner.scheduler.route(job))
+        self.assertIsNone(err)
+        self.assertEqual(job_desc.working_directory, os.path.dirname(stale_file))
+        self.assertEqual(os.listdir(job_desc.working_directory), ["run.py"])
+
+    def test_building_job_description_creates_no_directories(self):
+        self.job_runner.config["OUTPUT_DIRECTORY"] = os.path.join(self.tmp_dir, "output")
+        job = {"id": 1, "hardware_config": None, "command": "", "input_data": [], "code": "pass\n"}
+        job_desc = self.job_runner._build_job_description(job)
+        self.assertFalse(os.path.exists(job_desc.environment[nmpi_saga.OUTPUT_DIRECTORY_VARIABLE]))
+
+
+class ResourceUsageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.service = nmpi_local.LocalJobService()
+        self.client = UpdatingHardwareClient()
+        self.client.lease_duration = None
+        self.client.update_queue = None
+        self.job_runner = make_job_runner({"WORKING_DIRECTORY": os.path.join(self.tmp_dir, "work"),
+                                           "DATA_DIRECTORY": os.path.join(self.tmp_dir, "data"),
+                                           "DATA_SERVER": "http://data.example.com",
+                                           "JOB_SERVICE_ADAPTOR": "process://localhost",
+                                           "JOB_EXECUTABLE_PYNN_7": sys.executable},
+                                          self.client,
+                                          {"process://localhost": self.service})
+        self.job_runner.git_cache = self.job_runner.archive_cache = self.job_runner.input_cache = None
+        self.path = os.environ["PATH"]
+
+    def tearDown(self):
+        os.environ["PATH"] = self.path
+        self.job_runner.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_local_job_usage(self):
+        self.job_runner.resource_units = "core-hours"
+        job = {"id": 1, "hardware_config": None, "command": "", "input_data": [], "output_data": [],
+               "provenance": {"claim": {"runner": "nmpi@here"}},
+               "code": "import time\nstart = time.time()\nwhile time.time() - start < 0.2: pass\n"}
+        self.job_runner.wait_on_completion(self.job_runner.submit_jobs([job]))
+        self.assertEqual(job["status"], "finished")
+        usage = job["provenance"]["resource_usage"]
+        self.assertEqual(usage["units"], "core-hours")
+        self.assertGreaterEqual(usage["wall_time"], 0.2)
+        self.assertGreater(usage["cpu_time"], 0.1)
+        self.assertAlmostEqual(job["resource_usage"], usage["wall_time"] / 3600.0)
+        self.assertEqual(job["provenance"]["claim"], {"runner": "nmpi@here"})
+
+    def test_slurm_usage_is_batched(self):
+        with open(os.path.join(self.tmp_dir, "sacct"), "w") as fp:
+            fp.write("#!/bin/sh\n"
+                     "echo x >> {0}/calls\n"
+                     "echo '101|COMPLETED|7200|01:00:00|100M|4'\n"
+                     "echo '102|COMPLETED|3600|01:00:00|100M|2'\n".format(self.tmp_dir))
+        os.chmod(os.path.join(self.tmp_dir, "sacct"), 0o755)
+        os.environ["PATH"] = self.tmp_dir + os.pathsep + self.path
+        partition = nmpi_scheduler.Partition("default", adaptor="slurm://localhost")
+        saga_jobs = []
+        for job_id in (101, 102):
+            saga_job = MockSagaJob(saga.job.DONE)
+            saga_job.id = "[slurm://localhost]-[{}]".format(job_id)
+            saga_job.partition = partition
+            saga_jobs.append(({"id": job_id, "hardware_config": {"wafers": [1, 2]}}, saga_job))
+        self.job_runner.resource_units = "wafer-hours"
+        for nmpi_job, saga_job in saga_jobs:
+            usage = self.job_runner._account(nmpi_job, saga_job, saga_jobs)
+        with open(os.path.join(self.tmp_dir, "calls")) as fp:
+            self.assertEqual(len(fp.readlines()), 1)
+        self.assertEqual(usage["cores"], 2)
+        self.assertEqual(usage["value"], 2.0)
+        nmpi_job = nmpi_saga.record_usage(*saga_jobs[0])
+        self.assertEqual(nmpi_job["resource_usage"], 4.0)
+        self.assertEqual(nmpi_job["provenance"]["resource_usage"]["max_rss"], 100 * 1024 ** 2)
+
+
+class LocalQueue(object):
+    """
+    Stand-in for the queue server, shared by several runners, with
+    conditional updates: each job has a version, which changes whenever the
+    job is updated, and which is given as its ETag.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = dict((job["id"], (dict(job, resource_uri="/api/v2/queue/{}".format(job["id"])), 0))
+                         for job in jobs)
+        self.lock = threading.Lock()
+
+    def get(self, resource_uri):
+        with self.lock:
+            job, version = self.jobs[int(resource_uri.split("/")[-1])]
+            return dict(job), str(version)
+
+    def put(self, resource_uri, data, etag=None):
+        with self.lock:
+            job, version = self.jobs[int(resource_uri.split("/")[-1])]
+            if etag is not None and etag != str(version):
+                return False
+            self.jobs[job["id"]] = (dict(data), version + 1)
+            return True
+
+    def with_status(self, status):
+        with self.lock:
+            return [dict(job) for job, version in sorted(self.jobs.values(), key=lambda item: item[0]["id"])
+                    if job["status"] == status]
+
+
+class LocalQueueClient(ResettingHardwareClient, nmpi_saga.HardwareClient):
+    """Client of a `LocalQueue`, which claims jobs as `HardwareClient` does."""
+
+    def __init__(self, queue, runner_id):
+        ResettingHardwareClient.__init__(self)
+        self.queue = queue
+        self.runner_id = runner_id
+        self.claim_jobs = True
+        self.update_queue = None
+
+    def get_next_job(self):
+        submitted = self.queue.with_status("submitted")
+        return submitted[0] if submitted else None
+
+    def _get_versioned(self, resource_uri):
+        return self.queue.get(resource_uri)
+
+    def _put_if_match(self, resource_uri, data, etag):
+        time.sleep(0.001)  # let other runners get in between reading and updating
+        return self.queue.put(resource_uri, data, etag)
+
+    def update_job(self, job):
+        self.queue.put(job["resource_uri"], self._stamp_lease(job))
+        return job
+
+    def update_job_later(self, job):
+        return self.update_job(job)
+
+    def running_jobs(self, verbose=False):
+        return self.queue.with_status("running")
+
+    def reset_job(self, job):
+        ResettingHardwareClient.reset_job(self, job)
+        self.update_job(dict(job, status="submitted"))
+
+
+class JobClaimTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = LocalQueue([{"id": i, "status": "submitted", "hardware_config": None}
+                                 for i in range(60)])
+
+    def test_claim_job(self):
+        client = LocalQueueClient(self.queue, "runner-a")
+        job = client.get_next_job()
+        claimed = client.claim_job(job)
+        self.assertEqual(claimed["status"], "running")
+        self.assertEqual(claimed["provenance"]["claim"]["runner"], "runner-a")
+        self.assertEqual(self.queue.get(job["resource_uri"])[0]["status"], "running")
+        # the job has been taken
+        self.assertIsNone(LocalQueueClient(self.queue, "runner-b").claim_job(job))
+        # a claimed job pending on the cluster is not put back in the queue
+        client.update_job(dict(claimed, status="submitted"))
+        self.assertEqual(self.queue.get(job["resource_uri"])[0]["status"], "running")
+
+    def test_claim_lost_to_concurrent_update(self):
+        client = LocalQueueClient(self.queue, "runner-a")
+        job = client.get_next_job()
+        get_versioned = client._get_versioned
+
+        def read_then_lose(resource_uri):
+            current, etag = get_versioned(resource_uri)
+            self.queue.put(resource_uri, dict(current, status="running"))
+            return current, etag
+        client._get_versioned = read_then_lose
+        self.assertIsNone(client.claim_job(job))
+
+    def test_no_claim_without_etag(self):
+        client = LocalQueueClient(self.queue, "runner-a")
+        job = client.get_next_job()
+        client._get_versioned = lambda resource_uri: (self.queue.get(resource_uri)[0], None)
+        self.assertIsNone(client.claim_job(job))
+        self.assertEqual(self.queue.get(job["resource_uri"])[0]["status"], "submitted")
+
+    def test_runners_share_queue(self):
+        runners = [make_job_runner({}, LocalQueueClient(self.queue, "runner-{}".format(i)), {})
+                   for i in range(4)]
+        for job_runner in runners:
+            job_runner.client.claim_jobs = True
+        claimed = dict((job_runner.client.runner_id, []) for job_runner in runners)
+
+        def run(job_runner):
+            while True:
+                jobs = job_runner.retrieve_pending_jobs()
+                if not jobs and not self.queue.with_status("submitted"):
+                    return
+                claimed[job_runner.client.runner_id].extend(job["id"] for job in jobs)
+
+        threads = [threading.Thread(target=run, args=(job_runner,)) for job_runner in runners]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        job_ids = [job_id for ids in claimed.values() for job_id in ids]
+        self.assertEqual(sorted(job_ids), list(range(60)))
+        for runner_id, ids in claimed.items():
+            for job_id in ids:
+                job = self.queue.get("/api/v2/queue/{}".format(job_id))[0]
+                self.assertEqual(job["provenance"]["claim"]["runner"], runner_id)
+
+
+    def test_leases_of_claimed_jobs_are_renewed(self):
+        queue = LocalQueue([{"id": i, "status": "submitted", "hardware_config": None} for i in range(2)])
+        runners = []
+        for runner_id in ("runner-a", "runner-b"):
+            client = LocalQueueClient(queue, runner_id)
+            client.lease_duration = 1.0
+            runners.append(make_job_runner({}, client, {}))
+        job_runner, other_runner = runners
+        submitted, held = job_runner.retrieve_pending_jobs()
+        # one job is pending on the cluster, the other waits for a free slot
+        saga_job = MockSagaJob(saga.job.PENDING)
+        nmpi_saga.job_pending(submitted, saga_job)
+        job_runner.scheduler.add(held)
+        pending_jobs = [(submitted, saga_job)]
+        for i in range(4):
+            time.sleep(0.4)
+            job_runner._renew_leases(pending_jobs)
+            self.assertEqual(other_runner.client.requeue_expired_jobs(), [])
+        for job in queue.with_status("running"):
+            self.assertEqual(job["provenance"]["lease"]["runner"], "runner-a")
+        self.assertEqual(len(queue.with_status("running")), 2)
+        # without renewal, the other runner takes the jobs back
+        time.sleep(1.1)
+        self.assertEqual(sorted(job["id"] for job in other_runner.client.requeue_expired_jobs()), [0, 1])
+
+
+class FairShareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queued = [{"id": i, "collab_id": 1, "user_id": "alice", "hardware_config": None} for i in range(8)]
+        self.queued += [{"id": 8, "collab_id": 2, "user_id": "bob", "hardware_config": None}]
+        self.client = ResettingHardwareClient()
+        self.client.queued_jobs = lambda verbose=False: list(self.queued)
+
+    def test_retrieve_pending_jobs(self):
+        job_runner = make_job_runner({"FAIR_SHARE": "collab_id,user_id", "LOCAL_BACKLOG": "3"},
+                                     self.client, {})
+        job_runner.fair_share = job_runner._make_fair_share(job_runner.config)
+        self.assertEqual([job["id"] for job in job_runner.retrieve_pending_jobs()], [0, 8, 1])
+        # jobs which have been claimed are not claimed again
+        job_runner.config["LOCAL_BACKLOG"] = "2"
+        self.assertEqual([job["id"] for job in job_runner.retrieve_pending_jobs()], [2, 3])
+
+    def test_window_per_flow(self):
+        # alice has more jobs queued than the window, all older than bob's
+        self.queued = [{"id": i, "collab_id": 1, "user_id": "alice", "hardware_config": None} for i in range(20)]
+        self.queued += [{"id": 20, "collab_id": 2, "user_id": "bob", "hardware_config": None}]
+        job_runner = make_job_runner({"FAIR_SHARE": "collab_id,user_id", "FAIR_SHARE_WINDOW": "5",
+                                      "LOCAL_BACKLOG": "2"}, self.client, {})
+        job_runner.fair_share = job_runner._make_fair_share(job_runner.config)
+        self.assertEqual([job["id"] for job in job_runner.retrieve_pending_jobs()], [0, 20])
+
+    def test_late_user_gets_next_free_slot(self):
+        self.queued = [{"id": i, "collab_id": 1, "user_id": "alice", "hardware_config": None} for i in range(6)]
+        job_runner = make_job_runner({"FAIR_SHARE": "collab_id,user_id", "MAX_RUNNING_JOBS": "2"},
+                                     self.client, {})
+        job_runner.fair_share = job_runner._make_fair_share(job_runner.config)
+        # only as many jobs are claimed as can start
+        self.assertEqual([job["id"] for job in job_runner.retrieve_pending_jobs()], [0, 1])
+        job_runner.scheduler.started(job_runner.scheduler.default)
+        job_runner.scheduler.started(job_runner.scheduler.default)
+        self.assertEqual(job_runner.retrieve_pending_jobs(), [])
+        # bob submits a job after alice's, and gets the next slot to free up
+        self.queued.append({"id": 6, "collab_id": 2, "user_id": "bob", "hardware_config": None})
+        job_runner.scheduler.release(job_runner.scheduler.default)
+        self.assertEqual([job["id"] for job in job_runner.retrieve_pending_jobs()], [6])
+
+    def test_quota_weights(self):
+        self.client.remaining_quota = lambda collab_id: {1: 1.0, 2: 0.0}[collab_id]
+        job_runner = make_job_runner({"FAIR_SHARE": "collab_id", "FAIR_SHARE_QUOTA_WEIGHTS": "True"},
+                                     self.client, {})
+        job_runner.fair_share = job_runner._make_fair_share(job_runner.config)
+        # a collab without quota left only gets its jobs claimed last
+        self.assertEqual([job["id"] for job in job_runner.retrieve_pending_jobs()], list(range(9)))
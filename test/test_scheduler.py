@@ -0,0 +1,192 @@
+"""
+Tests of the routing of jobs to partitions (nmpi_scheduler)
+"""
+
+import unittest
+from nmpi.nmpi_scheduler import Rule, parse_rules, scheduler_from_config, FairShare
+
+
+def make_job(job_id, **hardware_config):
+    return {"id": job_id, "hardware_config": hardware_config or None}
+
+
+CONFIG = {
+    "JOB_QUEUE": "intel",
+    "JOB_SERVICE_ADAPTOR": "slurm://localhost",
+    "MAX_RUNNING_JOBS": "1",
+    "PARTITIONS": "short, wafer",
+    "PARTITION_short_QUEUE": "ess",
+    "PARTITION_short_MAX_JOBS": "2",
+    "PARTITION_short_PRIORITY": "10",
+    "PARTITION_short_RULES": "platform_variant=ESS;expected_duration<=600",
+    "PARTITION_wafer_QUEUE": "wafer",
+    "PARTITION_wafer_ADAPTOR": "slurm://wafer-head",
+    "PARTITION_wafer_MAX_JOBS": "1",
+    "PARTITION_wafer_RULES": "platform_variant=wafer",
+}
+
+
+class RuleTest(unittest.TestCase):
+
+    def test_numeric_and_string_comparison(self):
+        self.assertTrue(Rule("expected_duration<=600").matches({"expected_duration": 600}))
+        self.assertFalse(Rule("expected_duration<=600").matches({"expected_duration": "1200"}))
+        self.assertTrue(Rule("pyNN_version!=0.7").matches({"pyNN_version": "0.8"}))
+        self.assertTrue(Rule("platform_variant = ESS").matches({"platform_variant": "ESS"}))
+
+    def test_missing_entry_does_not_match(self):
+        self.assertFalse(Rule("expected_duration<600").matches({}))
+        self.assertFalse(Rule("expected_duration<600").matches(None))
+
+    def test_invalid_rule(self):
+        self.assertRaises(ValueError, parse_rules, "platform_variant ESS")
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = scheduler_from_config(CONFIG)
+
+    def test_routing(self):
+        self.assertEqual(self.scheduler.route(make_job(1, platform_variant="ESS", expected_duration=60)).name, "short")
+        self.assertEqual(self.scheduler.route(make_job(2, platform_variant="ESS", expected_duration=6000)).name, "default")
+        wafer = self.scheduler.route(make_job(3, platform_variant="wafer"))
+        self.assertEqual((wafer.name, wafer.queue, wafer.adaptor), ("wafer", "wafer", "slurm://wafer-head"))
+        default = self.scheduler.route(make_job(4))
+        self.assertEqual((default.queue, default.adaptor), ("intel", "slurm://localhost"))
+
+    def test_concurrency_limits_and_priority(self):
+        for job_id in (1, 2, 3):
+            self.scheduler.add(make_job(job_id, platform_variant="wafer"))
+        for job_id in (4, 5, 6):
+            self.scheduler.add(make_job(job_id, platform_variant="ESS", expected_duration=10))
+        started = []
+        while True:
+            scheduled = self.scheduler.pop()
+            if scheduled is None:
+                break
+            started.append(scheduled)
+        # the short partition has the highest priority, but only two slots
+        self.assertEqual([job["id"] for job, _ in started], [4, 5, 1])
+        self.assertEqual(self.scheduler.queued(), 3)
+        # a short job finishing lets the next short job start, ahead of the wafer jobs
+        self.scheduler.release(started[0][1])
+        job, partition = self.scheduler.pop()
+        self.assertEqual((job["id"], partition.name), (6, "short"))
+        self.assertIsNone(self.scheduler.pop())
+        self.scheduler.release(started[2][1])
+        job, partition = self.scheduler.pop()
+        self.assertEqual((job["id"], partition.name), (2, "wafer"))
+
+    def test_admission_limit(self):
+        self.assertIsNone(self.scheduler.admission_limit({}))
+        config = dict(CONFIG, MAX_QUEUED_JOBS="2", PARTITION_short_MAX_QUEUED="3",
+                      PARTITION_wafer_MAX_QUEUED="1")
+        scheduler = scheduler_from_config(config)
+        self.assertEqual(scheduler.admission_limit({}), 6)
+        self.assertEqual(scheduler.admission_limit({"ess": 5, "wafer": 1, "intel": 1}), 1)
+        scheduler.add(make_job(1))
+        self.assertEqual(scheduler.admission_limit({"ess": 5, "wafer": 1, "intel": 1}), 0)
+
+    def test_admission_limit_of_shared_queue(self):
+        config = dict(CONFIG, MAX_QUEUED_JOBS="2", PARTITION_short_MAX_QUEUED="3",
+                      PARTITION_wafer_MAX_QUEUED="1", PARTITION_wafer_QUEUE="ess",
+                      PARTITION_wafer_ADAPTOR="slurm://localhost")
+        scheduler = scheduler_from_config(config)
+        # the jobs waiting in the shared queue are only counted once
+        self.assertEqual(scheduler.admission_limit({"ess": 3, "intel": 1}), 2)
+
+    def test_free_slots(self):
+        self.assertEqual(self.scheduler.free_slots(), 1 + 2 + 1)
+        self.scheduler.started(self.scheduler.default)
+        self.scheduler.add(make_job(1))
+        self.assertEqual(self.scheduler.free_slots(), 2)
+        config = dict(CONFIG)
+        del config["PARTITION_short_MAX_JOBS"]
+        self.assertIsNone(scheduler_from_config(config).free_slots())
+
+    def test_reattached_jobs_take_slots(self):
+        self.scheduler.started(self.scheduler.default)
+        self.scheduler.add(make_job(7))
+        self.assertIsNone(self.scheduler.pop())
+
+    def test_pop_pack(self):
+        scheduler = scheduler_from_config(dict(CONFIG, PARTITION_short_PACK_SIZE="3",
+                                               PARTITION_short_MAX_JOBS="4"))
+        jobs = [make_job(i, platform_variant="ESS", expected_duration=10, pyNN_version=version)
+                for i, version in enumerate(["0.7", "0.8", "0.7", "0.7", "0.7", "0.7"])]
+        for job in jobs:
+            scheduler.add(job)
+        key = lambda job: job["hardware_config"]["pyNN_version"]
+        packed, partition = scheduler.pop_pack(key)
+        self.assertEqual(partition.name, "short")
+        self.assertEqual([job["id"] for job in packed], [0, 2, 3])
+        self.assertEqual(partition.running, 3)
+        # only one slot left
+        packed, partition = scheduler.pop_pack(key)
+        self.assertEqual([job["id"] for job in packed], [1])
+        self.assertIsNone(scheduler.pop_pack(key))
+        self.assertEqual([job["id"] for job in partition.queued], [4, 5])
+
+    def test_wall_time_limit(self):
+        scheduler = scheduler_from_config(dict(CONFIG, WALL_TIME_LIMIT="60", PARTITION_short_WALL_TIME_LIMIT="15"))
+        self.assertEqual(scheduler.default.wall_time_limit, 60)
+        self.assertEqual([partition.wall_time_limit for partition in scheduler.partitions], [15, 60])
+        self.assertIsNone(self.scheduler.default.wall_time_limit)
+
+    def test_scratch_directory(self):
+        scheduler = scheduler_from_config(dict(CONFIG, SCRATCH_DIRECTORY="/tmp/nmpi",
+                                               PARTITION_short_SCRATCH_DIRECTORY="/dev/shm/nmpi"))
+        self.assertEqual(scheduler.default.scratch_directory, "/tmp/nmpi")
+        self.assertEqual([partition.scratch_directory for partition in scheduler.partitions],
+                         ["/dev/shm/nmpi", None])
+
+    def test_discard(self):
+        for job_id in (1, 2, 3):
+            self.scheduler.add(make_job(job_id))
+        self.assertEqual([job["id"] for job in self.scheduler.discard(set([2, 3, 4]))], [2, 3])
+        self.assertEqual(self.scheduler.queued(), 1)
+
+
+def queued_job(job_id, collab_id, user_id="alice"):
+    return {"id": job_id, "collab_id": collab_id, "user_id": user_id}
+
+
+class FairShareTest(unittest.TestCase):
+
+    def test_flows_take_turns(self):
+        jobs = [queued_job(i, 1) for i in range(10)] + [queued_job(i, 2) for i in (10, 11)]
+        selected = FairShare(keys=("collab_id",)).select(jobs, limit=6)
+        self.assertEqual([job["id"] for job in selected], [0, 10, 1, 11, 2, 3])
+
+    def test_users_within_a_collab(self):
+        jobs = [queued_job(1, 1, "alice"), queued_job(2, 1, "alice"), queued_job(3, 1, "bob")]
+        selected = FairShare().select(jobs)
+        self.assertEqual([job["id"] for job in selected], [1, 3, 2])
+
+    def test_weights(self):
+        jobs = [queued_job(i, 1) for i in range(6)] + [queued_job(i, 2) for i in range(6, 12)]
+        fair_share = FairShare(keys=("collab_id",), weight=lambda flow: 2.0 if flow == (1,) else 1.0)
+        selected = fair_share.select(jobs, limit=6)
+        self.assertEqual(sum(1 for job in selected if job["collab_id"] == 1), 4)
+
+    def test_fairness_across_calls(self):
+        fair_share = FairShare(keys=("collab_id",))
+        jobs = [queued_job(i, 1) for i in range(5)] + [queued_job(i, 2) for i in range(5, 10)]
+        claimed = []
+        for i in range(6):
+            job = fair_share.select([job for job in jobs if job not in claimed], limit=1)[0]
+            claimed.append(job)
+        self.assertEqual([job["collab_id"] for job in claimed], [1, 2, 1, 2, 1, 2])
+
+    def test_idle_flow_gets_no_credit(self):
+        fair_share = FairShare(keys=("collab_id",))
+        fair_share.select([queued_job(i, 1) for i in range(4)])
+        # collab 2 arrives late: it does not get four jobs in a row
+        jobs = [queued_job(i, 1) for i in range(4, 8)] + [queued_job(i, 2) for i in range(8, 12)]
+        selected = fair_share.select(jobs, limit=4)
+        self.assertEqual(sorted(job["collab_id"] for job in selected), [1, 1, 2, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()